@@ -0,0 +1,5 @@
+"""
+Benchmarks of the kang code paths, runnable without any hardware
+
+See python -m benchmarks --help
+"""
@@ -0,0 +1,181 @@
+"""
+Run the benchmarks or compare two runs
+
+    python -m benchmarks run -o results.json
+    python -m benchmarks compare base.json results.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Relative change above which a benchmark is reported as a regression
+THRESHOLD = 0.15
+
+
+def _git_revision():
+    try:
+        process = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+    except OSError:
+        return None
+    return process.stdout.decode("ascii").strip() or None
+
+
+def _measure(operation, count, repeat, min_time):
+    """
+    @return: the list of the times per operation of each run
+    """
+    # Run the operation enough times for each run to last at least min_time
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            operation()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        loops *= 2
+
+    times = [elapsed]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            operation()
+        times.append(time.perf_counter() - start)
+    return [elapsed / loops / count for elapsed in times]
+
+
+def run(args):
+    # Don't let the code under test log or create files in the working directory
+    logging.disable(logging.CRITICAL)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    revision = _git_revision()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            results = _run_suite(args)
+        finally:
+            os.chdir(cwd)
+
+    data = {
+        "revision": revision,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as fd:
+            json.dump(data, fd, indent=2, sort_keys=True)
+    return 0
+
+
+def _run_suite(args):
+    from benchmarks import suite
+
+    results = {}
+    for name, setup in suite.BENCHMARKS.items():
+        if args.filter and args.filter not in name:
+            continue
+        operation, count = setup()
+        times = _measure(operation, count, args.repeat, args.min_time)
+        results[name] = {
+            "min": min(times),
+            "median": statistics.median(times),
+            "repeat": len(times),
+        }
+        print(
+            "{:<28} {:>12} {:>12}".format(
+                name, _format_time(min(times)), _format_time(statistics.median(times))
+            )
+        )
+    suite.cleanup()
+    return results
+
+
+def _format_time(seconds):
+    for unit, scale in [("s", 1), ("ms", 1e-3), ("us", 1e-6)]:
+        if seconds >= scale:
+            return "{:.2f} {}".format(seconds / scale, unit)
+    return "{:.0f} ns".format(seconds / 1e-9)
+
+
+def compare(args):
+    """
+    Compare the minimum times per operation of two runs
+
+    @return: 1 if a benchmark is slower by more than the threshold
+    """
+    with open(args.base) as fd:
+        base = json.load(fd)
+    with open(args.new) as fd:
+        new = json.load(fd)
+    print(
+        "Comparing {} to {}".format(
+            base.get("revision") or args.base, new.get("revision") or args.new
+        )
+    )
+
+    regressions = 0
+    for name in sorted(set(base["results"]) | set(new["results"])):
+        if name not in base["results"] or name not in new["results"]:
+            print("{:<28} only in one run".format(name))
+            continue
+        before = base["results"][name]["min"]
+        after = new["results"][name]["min"]
+        change = after / before - 1 if before else 0
+        status = ""
+        if change > args.threshold:
+            status = "REGRESSION"
+            regressions += 1
+        elif change < -args.threshold:
+            status = "faster"
+        print(
+            "{:<28} {:>12} {:>12} {:>+8.1%} {}".format(
+                name, _format_time(before), _format_time(after), change, status
+            )
+        )
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("-o", "--output", help="JSON file to write the results to")
+    run_parser.add_argument("-k", "--filter", help="only run the matching benchmarks")
+    run_parser.add_argument("--repeat", type=int, default=5, help="number of runs")
+    run_parser.add_argument(
+        "--min-time", type=float, default=0.1, help="minimum duration of a run"
+    )
+    run_parser.set_defaults(function=run)
+
+    compare_parser = commands.add_parser("compare", help="compare two runs")
+    compare_parser.add_argument("base", help="results of the reference run")
+    compare_parser.add_argument("new", help="results of the run to check")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=THRESHOLD,
+        help="relative slowdown reported as a regression",
+    )
+    compare_parser.set_defaults(function=compare)
+
+    args = parser.parse_args()
+    sys.exit(args.function(args))
+
+
+if __name__ == "__main__":
+    main()
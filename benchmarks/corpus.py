@@ -0,0 +1,103 @@
+"""
+Synthetic inputs of the benchmarks, generated from a fixed seed
+"""
+
+import random
+
+SEED = 20240107
+
+NUMBER = "+33123456789"
+
+# Commands as users send them, each one paired with its reverse to keep the state
+# of the relays and scheduler stable between runs
+VALID_COMMANDS = [
+    "Démarrer",
+    "Arrêter",
+    "Allumer forcé dans l'église",
+    "Éteindre forcé dans l'église",
+    "Démarrer dans le hall le 12/03/2099 à 18h pendant 2h",
+    "Annuler dans le hall le 12/03/2099 à 18h pendant 2h",
+    "Etat",
+    "Lister",
+    "Lister les 5 prochaines dans le hall du 01/03 au 15/03",
+    "Suite",
+    "Aide",
+    "Aide programmer",
+    "Merci",
+    "Afficher l'heure",
+]
+
+INVALID_COMMANDS = [
+    "Bonjour",
+    "Démarrer dans la sacristie",
+    "Démarrer le 35/13 à 25h pendant 2h",
+    "Lister les numéros",
+    "?",
+    "",
+]
+
+
+def adversarial_commands():
+    """
+    @return: inputs crafted to stress the normalization and the regular expressions
+    """
+    return [
+        "a" * 1000,
+        " " * 2000 + "demarrer",
+        "demarrer dans " + "le hall " * 150,
+        "demarrer le 1 a 1h pendant " + "1" * 2000,
+        "demarrer dans l'eglise le 12 " + "/" * 500 + " a 18h pendant 2h",
+        "lister les 99999 prochaines dans " + "x " * 300,
+        "annuler le 12/03 a 18h pendant " + "9" * 500 + "h",
+        "éèêëàâäîïôöùûüç" * 60,
+        "\U0001f525" * 200,
+    ]
+
+
+def random_commands(count, seed=SEED):
+    """
+    @return: a mix of valid, invalid and adversarial commands
+    """
+    rng = random.Random(seed)
+    pool = VALID_COMMANDS * 4 + INVALID_COMMANDS * 2 + adversarial_commands()
+    return [rng.choice(pool) for _ in range(count)]
+
+
+def schedule(count, seed=SEED, start=4070908800.0):
+    """
+    @return: a list of (time, priority, action name, argument, kwargs) tuples of start
+             and stop events, alternating between the places
+    """
+    rng = random.Random(seed)
+    events = []
+    when = start
+    for index in range(count // 2):
+        place = 22 if index % 2 else 24
+        when += rng.randint(1, 72) * 1800
+        duration = rng.randint(1, 6) * 1800
+        events.append((when, 0, "start", (place,), {}))
+        events.append((when + duration, 0, "stop", (place,), {}))
+    return events
+
+
+def long_reply(length, seed=SEED, alphabet=None):
+    """
+    @return: a reply text of the given length, using only GSM characters by default
+    """
+    rng = random.Random(seed)
+    alphabet = alphabet or "abcdefghijklmnopqrstuvwxyzéèàù ,.:-0123456789\n"
+    return "".join(rng.choice(alphabet) for _ in range(length))
+
+
+def deliver_pdus(count, seed=SEED):
+    """
+    PDUs of received messages, as the modem lists them
+    """
+    from smspdu import SMS_DELIVER
+
+    rng = random.Random(seed)
+    commands = VALID_COMMANDS + INVALID_COMMANDS
+    return [
+        "00" + SMS_DELIVER.create(NUMBER, "+33600000000", rng.choice(commands)).toPDU()
+        for _ in range(count)
+    ]
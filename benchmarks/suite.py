@@ -0,0 +1,262 @@
+"""
+Benchmarks of the command parsing and dispatch, scheduling and PDU encoding and decoding paths
+
+Each benchmark is a setup function returning an (operation, count) tuple: the operation
+runs count times the measured code path. The modules are imported from the setup
+functions as kang.kang creates its events file in the current directory.
+"""
+
+import json
+import os
+
+from benchmarks import corpus
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """
+    Register a benchmark setup function
+    """
+
+    def decorator(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return decorator
+
+
+def _setup_relays():
+    """
+    Drive the relays with the mock backend and pulses of no duration
+    """
+    import kang.gpio
+    import kang.relays
+
+    kang.relays.set_driver(kang.relays.PulseDriver(width=0, window=0))
+    kang.relays.setup(kang.gpio.MockBackend())
+    kang.relays.set_places(
+        [
+            kang.relays.Place(place.name, place.on_pin, place.off_pin, place.aliases, 0)
+            for place in kang.relays.DEFAULT_PLACES
+        ]
+    )
+
+
+def _process_commands(commands):
+    import kang.emulator
+    import kang.kang
+    import kang.sim
+
+    _setup_relays()
+    sim = kang.emulator.FakeModem()
+    messages = [kang.sim.Sms(corpus.NUMBER, command) for command in commands]
+
+    def operation():
+        for sms in messages:
+            try:
+                kang.kang.process_command(sms, sim)
+            except Exception:
+                # Like the dispatcher stage, keep going with the next message
+                pass
+
+    return operation, len(messages)
+
+
+@benchmark("command.valid")
+def command_valid():
+    return _process_commands(corpus.VALID_COMMANDS)
+
+
+@benchmark("command.invalid")
+def command_invalid():
+    return _process_commands(corpus.INVALID_COMMANDS)
+
+
+@benchmark("command.adversarial")
+def command_adversarial():
+    return _process_commands(corpus.adversarial_commands())
+
+
+@benchmark("command.mixed")
+def command_mixed():
+    return _process_commands(corpus.random_commands(200))
+
+
+@benchmark("command.match")
+def command_match():
+    """
+    Only the normalization and regular expressions, without running the commands
+    """
+    import kang.kang
+
+    messages = corpus.random_commands(200)
+
+    def operation():
+        for message in messages:
+            message = kang.kang._normalize(message)
+            for cmd in kang.kang.COMMANDS:
+                if cmd["pattern"].fullmatch(message):
+                    break
+
+    return operation, len(messages)
+
+
+def _write_schedule(path, count):
+    with open(path, "w") as fd:
+        for when, priority, action, argument, kwargs in corpus.schedule(count):
+            fd.write(
+                "{},{},{},{},{}\n".format(
+                    when, priority, action, json.dumps(argument), json.dumps(kwargs)
+                )
+            )
+
+
+def _functions():
+    def start(place):
+        pass
+
+    def stop(place):
+        pass
+
+    return [start, stop]
+
+
+@benchmark("scheduler.load.5000")
+def scheduler_load():
+    import kang.scheduler
+
+    _write_schedule("bench-events.txt", 5000)
+    functions = _functions()
+
+    def operation():
+        kang.scheduler.PersistedScheduler("bench-events.txt", functions)
+
+    return operation, 1
+
+
+@benchmark("scheduler.save.5000")
+def scheduler_save():
+    import kang.scheduler
+
+    _write_schedule("bench-events.txt", 5000)
+    scheduler = kang.scheduler.PersistedScheduler("bench-events.txt", _functions())
+    return scheduler.save, 1
+
+
+@benchmark("scheduler.cancel.5000")
+def scheduler_cancel():
+    """
+    Cancel and enter again the last event of a large queue, without saving the file
+    """
+    import kang.scheduler
+
+    _write_schedule("bench-events.txt", 5000)
+    thread = kang.scheduler.SchedulerThread("bench-events.txt", _functions())
+    thread.scheduler.path = None
+    last = thread.events[-1]
+
+    def operation():
+        thread.cancel(last.time, last.action, last.argument, last.kwargs)
+        thread.enterabs(last.time, last.priority, last.action, last.argument)
+
+    return operation, 1
+
+
+@benchmark("scheduler.select.5000")
+def scheduler_select():
+    """
+    Page through a large queue like the Lister and Suite commands
+    """
+    import kang.scheduler
+
+    _write_schedule("bench-events.txt", 5000)
+    thread = kang.scheduler.SchedulerThread("bench-events.txt", _functions())
+    start = thread.events[2500].time
+
+    def operation():
+        events, cursor = thread.select(argument=(22,), start=start, limit=8)
+        thread.select(argument=(22,), start=start, limit=8, after=cursor)
+
+    return operation, 2
+
+
+def _send(text, count):
+    import kang.emulator
+    import kang.sim
+
+    sim = kang.emulator.FakeModem()
+    messages = [kang.sim.Sms(corpus.NUMBER, text) for _ in range(count)]
+
+    def operation():
+        for sms in messages:
+            sms.send(sim)
+
+    return operation, count
+
+
+@benchmark("sms.send.short")
+def sms_send_short():
+    return _send("Démarré dans l'église, le hall", 20)
+
+
+@benchmark("sms.send.gsm7.1000")
+def sms_send_gsm7():
+    return _send(corpus.long_reply(1000), 5)
+
+
+@benchmark("sms.send.ucs2.500")
+def sms_send_ucs2():
+    return _send(corpus.long_reply(500, alphabet="ab€çœ\U0001f525 "), 5)
+
+
+def _inbox(count):
+    import kang.emulator
+
+    sim = kang.emulator.FakeModem()
+    for pdu in corpus.deliver_pdus(count):
+        sim.receive(pdu)
+    return sim
+
+
+@benchmark("sms.read.50")
+def sms_read():
+    import kang.sim
+
+    sim = _inbox(50)
+    ids = [str(idx) for idx in sim.inbox]
+
+    def operation():
+        for idx in ids:
+            kang.sim.Sms.read(sim, idx)
+
+    return operation, len(ids)
+
+
+@benchmark("sms.read_all.50")
+def sms_read_all():
+    import kang.sim
+
+    sim = _inbox(50)
+
+    def operation():
+        kang.sim.readAllSms(sim)
+
+    return operation, 50
+
+
+@benchmark("reply.pack.200")
+def reply_pack():
+    import kang.kang
+
+    lines = ["- {}".format(corpus.long_reply(40, seed=i)) for i in range(200)]
+
+    def operation():
+        kang.kang.Reply(corpus.NUMBER, "Programmation", lines).messages()
+
+    return operation, 1
+
+
+def cleanup():
+    if os.path.exists("bench-events.txt"):
+        os.remove("bench-events.txt")
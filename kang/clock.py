@@ -0,0 +1,86 @@
+"""
+Clocks used by the scheduler and the time-dependent commands
+
+The SystemClock follows the real time. The SimulatedClock only moves when advanced or
+slept on, which makes sleeping instantaneous: a scheduler using it jumps from one
+deadline to the next and months of events run in milliseconds.
+"""
+
+import datetime
+import threading
+import time
+
+
+class SystemClock:
+    """
+    The real time of the system
+    """
+
+    def time(self):
+        """
+        @return: the current UNIX timestamp
+        """
+        return time.time()
+
+    def sleep(self, seconds):
+        """
+        Let some time pass
+        """
+        time.sleep(seconds)
+
+    def idle(self, seconds):
+        """
+        Wait between two polls of a thread.
+
+        Unlike sleep() this doesn't make the time pass on a simulated clock.
+        """
+        time.sleep(seconds)
+
+    def localtime(self, secs=None):
+        """
+        @return: the struct_time of a timestamp, of the current time if None
+        """
+        return time.localtime(self.time() if secs is None else secs)
+
+    def now(self):
+        """
+        @return: the current local time as a datetime
+        """
+        return datetime.datetime.fromtimestamp(self.time())
+
+
+class SimulatedClock(SystemClock):
+    """
+    Clock only moving forward when told to
+    """
+
+    def __init__(self, start=0.0):
+        """
+        @param start: the initial UNIX timestamp
+        """
+        self._now = float(start)
+        self._lock = threading.Lock()
+
+    def time(self):
+        return self._now
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def idle(self, seconds):
+        # Let the other threads run, the time only moves when advanced
+        time.sleep(min(seconds, 0.01))
+
+    def advance(self, seconds):
+        """
+        Move the time forward
+        """
+        with self._lock:
+            self._now += max(0.0, seconds)
+
+    def advance_to(self, when):
+        """
+        Move the time forward to a timestamp, if it is in the future
+        """
+        with self._lock:
+            self._now = max(self._now, float(when))
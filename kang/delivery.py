@@ -0,0 +1,123 @@
+"""
+Tracking of the delivery of the sent SMS
+
+When delivery reports are requested, the modem answers each sent segment with a
+message reference and the network later sends a status report with that reference.
+The tracker correlates both in a bounded table: the oldest messages are forgotten
+first, whether their report came or not.
+"""
+
+import collections
+import threading
+import time
+
+import kang.metrics
+
+# Maximum number of sent segments tracked
+TABLE_SIZE = 256
+
+# Delivery states
+PENDING = "pending"
+DELIVERED = "delivered"
+FAILED = "failed"
+
+
+def delivery_state(status):
+    """
+    @param status: the TP-ST value of a status report
+    @return: the delivery state it means
+    """
+    if status < 0x20:
+        return DELIVERED
+    if status < 0x40:
+        # The service center is still trying
+        return PENDING
+    return FAILED
+
+
+class DeliveryTracker:
+    """
+    Delivery state of the recently sent segments, per modem and message reference
+    """
+
+    def __init__(self, size=TABLE_SIZE, clock=time.monotonic):
+        """
+        @param size: the maximum number of tracked segments
+        @param clock: function returning the current time in seconds
+        """
+        self.size = size
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def sent(self, modem, sms):
+        """
+        Track the segments of a sent SMS
+
+        @param modem: the name of the modem which sent the SMS
+        @param sms: the sent kang.sim.Sms, with its message references
+        """
+        now = self.clock()
+        with self._lock:
+            for reference in getattr(sms, "references", None) or []:
+                key = (modem, reference)
+                # The references wrap around: a reused one is a new message
+                self._entries.pop(key, None)
+                self._entries[key] = {
+                    "number": sms.number,
+                    "message": sms.message,
+                    "sent": now,
+                    "state": PENDING,
+                    "status": None,
+                }
+                if len(self._entries) > self.size:
+                    _, evicted = self._entries.popitem(last=False)
+                    if evicted["state"] == PENDING:
+                        kang.metrics.increment("delivery_untracked")
+
+    def report(self, modem, report):
+        """
+        Record a status report
+
+        @param modem: the name of the modem which received the report
+        @param report: the dictionary decoded by kang.pdu.decode_status_report()
+        @return: the delivery state, None if the message isn't tracked
+        """
+        state = delivery_state(report["status"])
+        with self._lock:
+            entry = self._entries.get((modem, report["reference"]))
+            if entry is None or entry["state"] != PENDING:
+                return None
+            entry["state"] = state
+            entry["status"] = report["status"]
+            elapsed = self.clock() - entry["sent"]
+        if state == DELIVERED:
+            kang.metrics.increment("sms_delivered")
+            kang.metrics.observe("sms_delivery_report", elapsed)
+        elif state == FAILED:
+            kang.metrics.increment("sms_undelivered")
+        return state
+
+    def state(self, modem, reference):
+        """
+        @return: the delivery state of a segment, None if it isn't tracked
+        """
+        with self._lock:
+            entry = self._entries.get((modem, reference))
+            return entry["state"] if entry else None
+
+    def entries(self, state=None, older_than=0):
+        """
+        List the tracked segments, for instance to send the undelivered ones again
+
+        @param state: only list the segments in that state
+        @param older_than: only list the segments sent at least that many seconds ago
+        @return: the list of (modem, reference, entry) tuples, oldest first
+        """
+        limit = self.clock() - older_than
+        with self._lock:
+            return [
+                (modem, reference, dict(entry))
+                for (modem, reference), entry in self._entries.items()
+                if (state is None or entry["state"] == state) and entry["sent"] <= limit
+            ]
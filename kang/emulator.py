@@ -0,0 +1,99 @@
+"""
+Simulated SIM7600E modem
+
+The FakeModem object can be used in place of the serial handle: it acknowledges the
+AT commands used by kang.sim and records the sent SMS segments, without any delay.
+Received messages can be stored in its inbox to be listed, read and deleted.
+"""
+
+
+class FakeModem:
+    """
+    Serial handle emulating the modem answers to the AT commands
+    """
+
+    def __init__(self):
+        # PDU hex strings of the sent segments
+        self.segments = []
+        self.written = 0
+        # PDU hex strings of the received messages, per index
+        self.inbox = {}
+        # CMS error code answered to the sent messages, None to accept them
+        self.error = None
+        # Lines waiting in the input buffer
+        self._lines = []
+
+    def receive(self, pdu):
+        """
+        Store a received message
+
+        @param pdu: the hex string of the SMS-DELIVER PDU, with its SMSC part
+        @return: the index of the message
+        """
+        idx = max(self.inbox, default=0) + 1
+        self.inbox[idx] = pdu
+        return str(idx)
+
+    def report(self, pdu, stored=True):
+        """
+        Receive a delivery report, announced with an unsolicited result waiting in the
+        input buffer
+
+        @param pdu: the hex string of the SMS-STATUS-REPORT PDU, with its SMSC part
+        @param stored: store the report in the inbox like with AT+CNMI=1,0,0,2,0,
+                       instead of sending it in the unsolicited result
+        """
+        if stored:
+            self._lines.append(b'+CDSI: "SM",%s\r\n' % self.receive(pdu).encode())
+        else:
+            self._lines.append(b"+CDS: %d\r\n" % (len(pdu) // 2 - 1))
+            self._lines.append(pdu.encode("ascii") + b"\r\n")
+
+    def reset_input_buffer(self):
+        # Also drops the unsolicited results, like the real serial handle
+        self._lines = []
+
+    def write(self, data):
+        self.written += len(data)
+        if data.endswith(b"\x1a") and self.error is not None:
+            self._lines += [b"\r\n", b"+CMS ERROR: %s\r\n" % self.error.encode("ascii")]
+        elif data.endswith(b"\x1a"):
+            self.segments.append(data[:-1].decode("ascii"))
+            self._lines += [
+                b"\r\n",
+                b"+CMGS: %d\r\n" % (len(self.segments) % 256),
+                b"\r\n",
+                b"OK\r\n",
+            ]
+        elif data.startswith(b"AT+CMGL="):
+            for idx, pdu in sorted(self.inbox.items()):
+                self._lines.append(b"+CMGL: %d,1,,%d\r\n" % (idx, len(pdu) // 2 - 1))
+                self._lines.append(pdu.encode("ascii") + b"\r\n")
+            self._lines.extend([b"\r\n", b"OK\r\n"])
+        elif data.startswith(b"AT+CMGR="):
+            pdu = self.inbox.get(int(data[8:].strip()))
+            if pdu is None:
+                self._lines += [b"\r\n", b"+CMS ERROR: 321\r\n"]
+            else:
+                self._lines += [
+                    b"\r\n",
+                    b"+CMGR: 1,,%d\r\n" % (len(pdu) // 2 - 1),
+                    pdu.encode("ascii") + b"\r\n",
+                    b"\r\n",
+                    b"OK\r\n",
+                ]
+        elif data.startswith(b"AT+CMGD="):
+            self.inbox.pop(int(data[8:].strip()), None)
+            self._lines += [b"\r\n", b"OK\r\n"]
+        elif not data.startswith(b"AT+CMGS="):
+            self._lines += [b"\r\n", b"OK\r\n"]
+
+    def read_until(self, expected):
+        # The PDU prompt is sent right away
+        return expected
+
+    def readline(self):
+        return self._lines.pop(0) if self._lines else b"OK\r\n"
+
+    def close(self):
+        pass
@@ -0,0 +1,118 @@
+"""
+SMS alphabets helpers
+
+An SMS segment holds 160 characters of the GSM 03.38 7 bit alphabet, characters of the
+extension table using two of them, or 70 UCS2 characters if any character isn't part of
+the GSM alphabet.
+"""
+
+GSM7_SEGMENT_LENGTH = 160
+UCS2_SEGMENT_LENGTH = 70
+
+# GSM 03.38 tables, imported on first use to keep smspdu out of the start-up path
+encoding_map = None
+extra_encoding_map = None
+
+
+def _load_maps():
+    global encoding_map, extra_encoding_map
+    if encoding_map is None:
+        from smspdu.gsm0338 import encoding_map as gsm_map, extra_encoding_map as extra
+
+        extra_encoding_map = extra
+        encoding_map = gsm_map
+
+
+def _gsm7_length(char):
+    """
+    @return: the number of septets of the character in the GSM alphabet, None if not part of it
+    """
+    code = ord(char)
+    value = encoding_map.get(code)
+    if value is not None:
+        return 2 if value > 255 else 1
+    if code in extra_encoding_map:
+        return 2
+    return None
+
+
+def _ucs2_length(char):
+    """
+    @return: the number of UCS2 characters needed to encode the character
+    """
+    return 2 if ord(char) > 0xFFFF else 1
+
+
+def encoded_length(text):
+    """
+    @param text: the text to measure
+    @return: a (septets, ucs2) tuple with the length of the text in both alphabets.
+             septets is None if the text can't be encoded with the GSM alphabet.
+    """
+    _load_maps()
+    septets = 0
+    for char in text:
+        length = _gsm7_length(char)
+        if length is None:
+            septets = None
+            break
+        septets += length
+    ucs2 = len(text) + sum(1 for char in text if ord(char) > 0xFFFF)
+    return septets, ucs2
+
+
+def add_lengths(*lengths):
+    """
+    @param lengths: (septets, ucs2) tuples returned by encoded_length()
+    @return: the length of the concatenated texts
+    """
+    septets = 0
+    ucs2 = 0
+    for length in lengths:
+        if septets is not None and length[0] is not None:
+            septets += length[0]
+        else:
+            septets = None
+        ucs2 += length[1]
+    return septets, ucs2
+
+
+def fits_segment(length):
+    """
+    @param length: (septets, ucs2) tuple returned by encoded_length()
+    @return: True if the text fits in a single SMS segment
+    """
+    if length[0] is not None:
+        return length[0] <= GSM7_SEGMENT_LENGTH
+    return length[1] <= UCS2_SEGMENT_LENGTH
+
+
+def split_segments(text, prefix=""):
+    """
+    Split a text into chunks fitting in a single SMS segment each
+
+    @param text: the text to split
+    @param prefix: text that will be prepended to each of the chunks
+    @return: the list of chunks
+    """
+    septets = encoded_length(prefix + text)[0]
+    if septets is not None:
+        budget = GSM7_SEGMENT_LENGTH
+        char_length = _gsm7_length
+    else:
+        budget = UCS2_SEGMENT_LENGTH
+        char_length = _ucs2_length
+    reserved = sum(char_length(char) for char in prefix)
+
+    chunks = []
+    start = 0
+    used = reserved
+    for index, char in enumerate(text):
+        length = char_length(char)
+        if used + length > budget and index > start:
+            chunks.append(text[start:index])
+            start = index
+            used = reserved
+        used += length
+    chunks.append(text[start:])
+    return chunks
@@ -0,0 +1,120 @@
+"""
+Aggregation of the errors reported to the administrators
+
+Each error is identified by its stage, type, the place it was raised from and the
+CMS error code if any. The first occurrence is reported right away, the repetitions
+are only counted and sent in a digest at the end of the interval: a failure repeating
+on every poll of the modem doesn't send an SMS each time.
+"""
+
+import os.path
+import threading
+import time
+import traceback
+
+from kang.cms_error import CmsError
+import kang.metrics
+
+# Time during which the repetitions of an error are only counted, in seconds
+DIGEST_INTERVAL = 3600
+
+# Maximum number of errors listed in a digest
+DIGEST_SIZE = 10
+
+
+def fingerprint(err, stage=None):
+    """
+    @param err: the exception
+    @param stage: the name of the component which failed
+    @return: a tuple identifying the repetitions of the error
+    """
+    frames = traceback.extract_tb(err.__traceback__)
+    location = None
+    if frames:
+        location = "{}:{}".format(
+            os.path.basename(frames[-1].filename), frames[-1].lineno
+        )
+    code = err.code if isinstance(err, CmsError) else None
+    return (stage, type(err).__name__, location, code)
+
+
+def _describe(err, stage):
+    text = "{}: {}".format(type(err).__name__, err)
+    return "{}: {}".format(stage, text) if stage else text
+
+
+class ErrorAggregator:
+    """
+    Count the errors and tell which ones to report
+    """
+
+    def __init__(self, interval=DIGEST_INTERVAL, clock=time.monotonic):
+        """
+        @param interval: seconds between two digests
+        @param clock: function returning the current time in seconds
+        """
+        self.interval = interval
+        self.clock = clock
+        self._lock = threading.Lock()
+        # Description and number of repetitions of the errors, per fingerprint
+        self._errors = {}
+        self._last_digest = clock()
+
+    def record(self, err, stage=None):
+        """
+        Count an error
+
+        @param err: the exception
+        @param stage: the name of the component which failed
+        @return: the message to send for the first occurrence of an error, None if it is
+                 a repetition left to the digest
+        """
+        key = fingerprint(err, stage)
+        with self._lock:
+            entry = self._errors.get(key)
+            if entry is not None:
+                entry[1] += 1
+                kang.metrics.increment("errors_suppressed")
+                return None
+            self._errors[key] = [_describe(err, stage), 0]
+        kang.metrics.increment("errors_reported")
+        return "Erreur inattendue: veuillez consulter les logs.\n > {}".format(
+            _describe(err, stage)
+        )
+
+    def digest(self, force=False):
+        """
+        Collect the repetitions counted since the previous digest.
+
+        The errors which repeated stay silenced for the next interval, the others will
+        be reported again on their next occurrence.
+
+        @param force: build the digest even if the interval isn't elapsed
+        @return: the message to send, None if there is nothing to report yet
+        """
+        now = self.clock()
+        if not force and now - self._last_digest < self.interval:
+            return None
+        with self._lock:
+            repeated = sorted(
+                (entry for entry in self._errors.values() if entry[1]),
+                key=lambda entry: entry[1],
+                reverse=True,
+            )
+            self._errors = {
+                key: [entry[0], 0] for key, entry in self._errors.items() if entry[1]
+            }
+            elapsed = now - self._last_digest
+            self._last_digest = now
+        if not repeated:
+            return None
+
+        lines = [
+            "- {} fois {}".format(count, description)
+            for description, count in repeated[:DIGEST_SIZE]
+        ]
+        if len(repeated) > DIGEST_SIZE:
+            lines.append("- {} autres erreurs".format(len(repeated) - DIGEST_SIZE))
+        return "Erreurs répétées depuis {} min:\n{}".format(
+            int(elapsed // 60), "\n".join(lines)
+        )
@@ -0,0 +1,164 @@
+"""
+GPIO backends driving the relay board pins
+
+The relays are switched by pulling their input pin low, the pins are high when idle.
+"""
+
+import abc
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Backend(abc.ABC):
+    """
+    Interface of the GPIO backends
+    """
+
+    @abc.abstractmethod
+    def setup(self, pins):
+        """
+        Configure the pins as outputs, initially high
+
+        @param pins: list of the pins numbers
+        """
+
+    @abc.abstractmethod
+    def output(self, pins, high):
+        """
+        Set the level of several pins at once
+
+        @param pins: list of the pins numbers
+        @param high: True to set the pins high, False to set them low
+        """
+
+    def cleanup(self):
+        """
+        Release the pins
+        """
+
+
+class RPiGPIOBackend(Backend):
+    """
+    Backend using the RPi.GPIO module with BCM pin numbering
+    """
+
+    def __init__(self):
+        import RPi.GPIO as GPIO
+
+        self.GPIO = GPIO
+
+    def setup(self, pins):
+        self.GPIO.setmode(self.GPIO.BCM)
+        for pin in pins:
+            self.GPIO.setup(pin, self.GPIO.OUT, initial=self.GPIO.HIGH)
+
+    def output(self, pins, high):
+        self.GPIO.output(list(pins), self.GPIO.HIGH if high else self.GPIO.LOW)
+
+    def cleanup(self):
+        self.GPIO.cleanup()
+
+
+class GpiodBackend(Backend):
+    """
+    Backend using the GPIO character device through libgpiod 2.x python bindings.
+
+    All the pins are requested together so that setting several of them is a single ioctl.
+    """
+
+    def __init__(self, chip="/dev/gpiochip0"):
+        """
+        @param chip: path to the GPIO character device
+        """
+        import gpiod
+
+        self.gpiod = gpiod
+        self.chip = chip
+        self.request = None
+
+    def setup(self, pins):
+        # Release the previous request when setting up again
+        self.cleanup()
+        settings = self.gpiod.LineSettings(
+            direction=self.gpiod.line.Direction.OUTPUT,
+            output_value=self.gpiod.line.Value.ACTIVE,
+        )
+        self.request = self.gpiod.request_lines(
+            self.chip, consumer="kang", config={tuple(pins): settings}
+        )
+
+    def output(self, pins, high):
+        value = self.gpiod.line.Value.ACTIVE if high else self.gpiod.line.Value.INACTIVE
+        self.request.set_values({pin: value for pin in pins})
+
+    def cleanup(self):
+        if self.request:
+            self.request.release()
+            self.request = None
+
+
+class MockBackend(Backend):
+    """
+    In-memory backend recording the pins levels changes with their time
+    """
+
+    def __init__(self):
+        self.levels = {}
+        # List of (monotonic time, pins, high) tuples
+        self.history = []
+        self._lock = threading.Lock()
+
+    def setup(self, pins):
+        with self._lock:
+            for pin in pins:
+                self.levels[pin] = True
+
+    def output(self, pins, high):
+        with self._lock:
+            unknown = [pin for pin in pins if pin not in self.levels]
+            if unknown:
+                raise ValueError("Pins not set up: {}".format(unknown))
+            for pin in pins:
+                self.levels[pin] = high
+            self.history.append((time.monotonic(), list(pins), high))
+
+    def cleanup(self):
+        with self._lock:
+            self.levels.clear()
+
+    def pulses(self):
+        """
+        @return: the list of (pins, duration) of the recorded low pulses
+        """
+        result = []
+        low = {}
+        for timestamp, pins, high in self.history:
+            if not high:
+                low[tuple(pins)] = timestamp
+            elif tuple(pins) in low:
+                result.append((list(pins), timestamp - low.pop(tuple(pins))))
+        return result
+
+
+BACKENDS = {
+    "rpi": RPiGPIOBackend,
+    "gpiod": GpiodBackend,
+    "mock": MockBackend,
+}
+
+
+def get_backend(name="rpi", **options):
+    """
+    Create a GPIO backend
+
+    @param name: one of the BACKENDS keys
+    @param options: backend-specific options, like chip for gpiod
+    @return: the backend instance
+    """
+    if name not in BACKENDS:
+        raise ValueError("Unknown GPIO backend: {}".format(name))
+    log.debug("Using %s GPIO backend", name)
+    return BACKENDS[name](**options)
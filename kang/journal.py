@@ -0,0 +1,161 @@
+"""
+Journal of the received messages
+
+Each received SMS is recorded before being processed, marked as executing while its
+command runs, then as executed with its replies and finally as replied. After a
+restart, the messages still on the SIM are not executed a second time and the missing
+replies are sent again. A command interrupted while executing may have switched the
+relays already: it is not run again.
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+RECEIVED = "received"
+EXECUTING = "executing"
+EXECUTED = "executed"
+REPLIED = "replied"
+FAILED = "failed"
+
+# Number of times a message failing to be processed is tried again
+MAX_ATTEMPTS = 3
+
+
+class Journal:
+    """
+    SQLite-backed journal of the received messages
+    """
+
+    def __init__(self, path):
+        """
+        :param path: the path of the SQLite database file
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "key TEXT PRIMARY KEY, sender TEXT, text TEXT, state TEXT, "
+                "attempts INTEGER DEFAULT 0, replies TEXT, updated REAL)"
+            )
+
+    @staticmethod
+    def key(sms):
+        """
+        :return: the identifier of a received SMS
+        """
+        date = getattr(sms, "date", None)
+        data = "\0".join(
+            [
+                str(sms.number),
+                date.isoformat() if hasattr(date, "isoformat") else str(date),
+                str(sms.message),
+            ]
+        )
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def _execute(self, query, parameters=()):
+        with self._lock, self._db:
+            return self._db.execute(query, parameters).fetchall()
+
+    def state(self, key):
+        """
+        :return: the state of the message, None if unknown
+        """
+        rows = self._execute("SELECT state FROM messages WHERE key = ?", (key,))
+        return rows[0][0] if rows else None
+
+    def received(self, key, sms):
+        """
+        Record a message as received if it isn't known yet
+        """
+        self._execute(
+            "INSERT OR IGNORE INTO messages (key, sender, text, state, updated) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (key, sms.number, sms.message, RECEIVED, time.time()),
+        )
+
+    def executing(self, key):
+        """
+        Record that the command of a message is about to run
+        """
+        self._execute(
+            "UPDATE messages SET state = ?, updated = ? WHERE key = ?",
+            (EXECUTING, time.time(), key),
+        )
+
+    def executed(self, key, replies):
+        """
+        Record the command of a message as executed
+
+        :param replies: the SMS to send back
+        """
+        self._execute(
+            "UPDATE messages SET state = ?, replies = ?, updated = ? WHERE key = ?",
+            (
+                EXECUTED,
+                json.dumps([[reply.number, reply.message] for reply in replies]),
+                time.time(),
+                key,
+            ),
+        )
+
+    def replied(self, key):
+        """
+        Record that the replies of a message have been sent
+        """
+        self._execute(
+            "UPDATE messages SET state = ?, updated = ? WHERE key = ?",
+            (REPLIED, time.time(), key),
+        )
+
+    def failed(self, key, retry=True):
+        """
+        Record a failure to process a message
+
+        :param retry: False to never try the message again
+        :return: True if the message should be tried again
+        """
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE messages SET attempts = attempts + 1, updated = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            rows = self._db.execute(
+                "SELECT attempts FROM messages WHERE key = ?", (key,)
+            ).fetchall()
+            retry = retry and bool(rows) and rows[0][0] < MAX_ATTEMPTS
+            if not retry:
+                self._db.execute(
+                    "UPDATE messages SET state = ? WHERE key = ?", (FAILED, key)
+                )
+        return retry
+
+    def replies(self, key):
+        """
+        :return: the list of (number, message) replies recorded for an executed message
+        """
+        rows = self._execute("SELECT replies FROM messages WHERE key = ?", (key,))
+        if not rows or not rows[0][0]:
+            return []
+        return [tuple(reply) for reply in json.loads(rows[0][0])]
+
+    def prune(self, max_age):
+        """
+        Remove the finished messages older than max_age seconds
+        """
+        self._execute(
+            "DELETE FROM messages WHERE state IN (?, ?) AND updated < ?",
+            (REPLIED, FAILED, time.time() - max_age),
+        )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -2,30 +2,79 @@
 # -*- coding: utf-8 -*-
 
 from kang.cms_error import CmsError
+import kang.clock
+import kang.encoding
+import kang.errors
+import kang.gpio
+import kang.metrics
+import kang.modems
 import kang.relays
 import kang.scheduler
 import kang.sim
+import kang.timesync
+import kang.version
 
+import argparse
+import collections
 import datetime
+import itertools
 import json
 import locale
 import logging
 import os.path
 import re
-import subprocess
+import signal
 import sys
+import threading
 import time
 
 AUTH_FILE = os.path.expanduser("authorized.txt")
 CONFIG_FILE = os.path.expanduser("kang.json")
 EVENTS_FILE = os.path.expanduser("events.txt")
+STATE_FILE = os.path.expanduser("relays.json")
+JOURNAL_FILE = os.path.expanduser("journal.db")
+
+# Time the processed messages are kept in the journal, in seconds
+JOURNAL_RETENTION = 30 * 24 * 3600
+
+# Time between two checks of the pipeline stages, in seconds
+HEALTH_INTERVAL = 60
 
 log = logging.getLogger(__name__)
 
-scheduler_thread = kang.scheduler.SchedulerThread(
-    EVENTS_FILE, [kang.relays.start, kang.relays.stop]
+# Clock of the scheduler and the time-dependent commands
+clock = kang.clock.SystemClock()
+
+# Created on first use by get_scheduler_thread() as it loads the events file
+scheduler_thread = None
+
+
+def get_scheduler_thread():
+    """
+    @return: the thread running the scheduled events, created on first call
+    """
+    global scheduler_thread
+    if scheduler_thread is None:
+        scheduler_thread = kang.scheduler.SchedulerThread(
+            EVENTS_FILE, [kang.relays.start, kang.relays.stop], clock
+        )
+    return scheduler_thread
+
+
+# Number of scheduled events listed per page
+EVENTS_PAGE_SIZE = 8
+
+# Reply to the messages which aren't a valid command
+UNKNOWN_COMMAND = (
+    "Commande inconnue, envoyer 'aide' pour vérifier les commandes disponibles"
 )
 
+# Maximum number of paged events listings remembered
+MAX_LIST_CURSORS = 50
+
+# Cursors of the paged events listings, per number, the least recent first
+_list_cursors = collections.OrderedDict()
+
 
 def is_authorized(sender):
     """
@@ -35,34 +84,229 @@ def is_authorized(sender):
         return "%s\n" % sender in auth_fd.readlines()
 
 
-def load_configuration():
+def is_allowed(sender):
     """
-    Load and apply the configuration from kang.json
+    @return: True if the sender is authorized and didn't exceed the rate limit
     """
-    config = {}
-    if os.path.isfile(CONFIG_FILE):
-        with open(CONFIG_FILE, "r") as config_fd:
-            try:
-                config = json.loads(config_fd.read())
-            except:
-                log.error("Failed to load configuration from %s", CONFIG_FILE)
+    if not is_authorized(sender):
+        log.info("Unauthorized message from %s", sender)
+        return False
+    # The configuration may be reloaded meanwhile
+    with _config_lock:
+        limited = _rate_limited(sender)
+    if limited:
+        log.warning("Rate limit exceeded by %s", sender)
+        return False
+    return True
+
+
+def _rate_limited(sender):
+    """
+    Record a command from the sender, call with _config_lock held
 
+    @return: True if the sender sent too many commands recently
+    """
+    limit = _config.get("rate_limit")
+    if not limit:
+        return False
+    now = time.monotonic()
+    times = _recent_commands.setdefault(sender, collections.deque())
+    while times and times[0] <= now - limit["period"]:
+        times.popleft()
+    if len(times) >= limit["count"]:
+        return True
+    times.append(now)
+    return False
+
+
+# Currently applied configuration
+_config = {}
+# Held while applying the configuration or running a command
+_config_lock = threading.Lock()
+# Times of the recent commands, per number
+_recent_commands = {}
+
+
+def read_configuration():
+    """
+    Read the configuration from kang.json
+
+    @return: the configuration dictionary, empty if there is no configuration file
+    @raise ValueError: if the file isn't valid JSON
+    """
+    if not os.path.isfile(CONFIG_FILE):
+        return {}
+    with open(CONFIG_FILE, "r") as config_fd:
+        return json.loads(config_fd.read())
+
+
+def _get_log_level(config):
     level = config.get("log_level", "warning")
     all_levels = [logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR]
     matching = [
         lvl for lvl in all_levels if logging.getLevelName(lvl).lower() == level.lower()
     ]
+    return matching[0] if matching else logging.WARNING
+
+
+def apply_configuration(config, setup=False):
+    """
+    Apply the log level, places and rate limit of a configuration.
+    Nothing is changed if the configuration is invalid.
+
+    @param config: the configuration dictionary
+    @param setup: set the relays pins up again, between two pulses
+    @raise ValueError, KeyError, TypeError: if the configuration is invalid
+    """
+    global _config
+    level = _get_log_level(config)
+    places = [
+        kang.relays.Place.from_config(place) for place in config.get("places", [])
+    ]
+    limit = config.get("rate_limit")
+    if limit and (int(limit["count"]) < 1 or float(limit["period"]) <= 0):
+        raise ValueError("Invalid rate limit: {}".format(limit))
+
+    with _config_lock:
+        logging.getLogger().setLevel(level)
+        configure_places(places or kang.relays.DEFAULT_PLACES, setup)
+        _recent_commands.clear()
+        _config = config
+
+
+def load_configuration():
+    """
+    Load and apply the configuration from kang.json
+    """
+    config = {}
+    try:
+        config = read_configuration()
+    except ValueError:
+        log.error("Failed to load configuration from %s", CONFIG_FILE)
+
     logging.basicConfig(
-        format="%(asctime)s:%(levelname)s:%(message)s",
-        level=matching[0] if matching else logging.WARNING,
+        format="%(asctime)s:%(levelname)s:%(message)s", level=_get_log_level(config)
     )
-
+    apply_configuration(config)
     return config
 
 
+def reload_configuration():
+    """
+    Load and apply the configuration from kang.json again, without touching the modem.
+    The current configuration is kept if the new one is invalid.
+
+    @return: True if the configuration was reloaded
+    """
+    try:
+        config = read_configuration()
+        # Configure the pins of the added places without interrupting a pulse
+        apply_configuration(config, setup=True)
+    except (OSError, ValueError, KeyError, TypeError) as err:
+        log.error("Failed to reload configuration from %s: %s", CONFIG_FILE, err)
+        return False
+    log.warning("Configuration reloaded")
+    return True
+
+
+def _config_mtime():
+    try:
+        return os.stat(CONFIG_FILE).st_mtime
+    except OSError:
+        return None
+
+
+def check_configuration(config):
+    """
+    Validate a configuration without applying it nor touching the hardware
+
+    @param config: the configuration dictionary
+    @return: the list of the problems found, empty if the configuration is valid
+    """
+    if not isinstance(config, dict):
+        return ["the configuration must be a JSON object"]
+    errors = []
+    level = config.get("log_level", "warning")
+    if not isinstance(level, str) or logging.getLevelName(level.upper()) not in [
+        logging.DEBUG,
+        logging.INFO,
+        logging.WARNING,
+        logging.ERROR,
+    ]:
+        errors.append("unknown log_level: {}".format(level))
+
+    names = set()
+    for index, place in enumerate(config.get("places", [])):
+        try:
+            parsed = kang.relays.Place.from_config(place)
+        except (KeyError, TypeError, ValueError) as err:
+            errors.append("invalid place #{}: {!r}".format(index + 1, err))
+            continue
+        if parsed.name in names:
+            errors.append("duplicate place: {}".format(parsed.name))
+        names.add(parsed.name)
+
+    backend = config.get("gpio", {}).get("backend", "rpi")
+    if backend not in kang.gpio.BACKENDS:
+        errors.append("unknown GPIO backend: {}".format(backend))
+
+    policy = config.get("catch_up", "coalesce")
+    if policy not in kang.scheduler.CATCH_UP_POLICIES:
+        errors.append("unknown catch_up policy: {}".format(policy))
+
+    limit = config.get("rate_limit")
+    try:
+        if limit and (int(limit["count"]) < 1 or float(limit["period"]) <= 0):
+            raise ValueError
+    except (KeyError, TypeError, ValueError):
+        errors.append("invalid rate_limit: {}".format(limit))
+
+    for name in ["time_sync_interval", "error_digest_interval"]:
+        interval = config.get(name, 0)
+        if not isinstance(interval, (int, float)) or interval < 0:
+            errors.append("invalid {}: {}".format(name, interval))
+
+    admins = config.get("admins", [])
+    if not isinstance(admins, list) or not all(isinstance(a, str) for a in admins):
+        errors.append("admins must be a list of phone numbers")
+
+    if not isinstance(config.get("delivery_reports", False), bool):
+        errors.append("delivery_reports must be true or false")
+
+    modems = config.get("modems", [])
+    if not isinstance(modems, list) or not all(isinstance(m, str) for m in modems):
+        errors.append("modems must be a list of serial devices")
+    elif len(set(modems)) != len(modems):
+        errors.append("duplicate modem device")
+    return errors
+
+
+def check_config():
+    """
+    Check kang.json and the authorized numbers file and print the result
+
+    @return: the exit code, 0 if the configuration is valid
+    """
+    try:
+        errors = check_configuration(read_configuration())
+    except (OSError, ValueError) as err:
+        errors = ["unreadable: {}".format(err)]
+    if not os.path.isfile(AUTH_FILE):
+        errors.append("missing authorized numbers file {}".format(AUTH_FILE))
+    for error in errors:
+        print("{}: {}".format(CONFIG_FILE, error), file=sys.stderr)
+    if not errors:
+        print("{}: OK".format(CONFIG_FILE))
+    return 1 if errors else 0
+
+
 ACCENTS_MAP = {
     "[éèêë]": "e",
     "[àâ]": "a",
+    "[îï]": "i",
+    "[ôö]": "o",
+    "[ùûü]": "u",
+    "ç": "c",
 }
 
 ACCENTED_MONTHS = {
@@ -73,9 +317,11 @@ ACCENTED_MONTHS = {
 
 COMMANDS = [
     {
-        "pattern": re.compile("^(?:demarrer?|allumer?)$", re.IGNORECASE),
+        "pattern": re.compile(
+            "^(?:demarrer?|allumer?)(?: (?P<force>forcer?))?$", re.IGNORECASE
+        ),
         "fn": "start_heating",
-        "command": "Démarrer",
+        "command": "Démarrer [forcé]",
         "help": "démarre le chauffage dans l'église et le hall",
         "help_group": "demarrer",
     },
@@ -101,36 +347,57 @@ COMMANDS = [
     },
     {
         "pattern": re.compile(
-            "^(?:demarrer?|allumer?) dans (?P<place>.+)$", re.IGNORECASE
+            "^(?:demarrer?|allumer?)(?: (?P<force>forcer?))? dans (?P<place>.+)$",
+            re.IGNORECASE,
         ),
         "fn": "start_heating",
-        "command": "Démarrer dans ...",
+        "command": "Démarrer [forcé] dans ...",
         "help": "démarre le chauffage dans l'église ou le hall",
         "help_group": "demarrer",
     },
     {
-        "pattern": re.compile("^(?:arreter?|eteindre|eteind)$", re.IGNORECASE),
+        "pattern": re.compile(
+            "^(?:arreter?|eteindre|eteind)(?: (?P<force>forcer?))?$", re.IGNORECASE
+        ),
         "fn": "stop_heating",
-        "command": "Arrêter",
+        "command": "Arrêter [forcé]",
         "help": "arrête le chauffage dans l'église et le hall",
         "help_group": "arreter",
     },
     {
         "pattern": re.compile(
-            "^(?:arreter?|eteindre|eteind) dans (?P<place>.+)$", re.IGNORECASE
+            "^(?:arreter?|eteindre|eteind)(?: (?P<force>forcer?))? dans (?P<place>.+)$",
+            re.IGNORECASE,
         ),
         "fn": "stop_heating",
-        "command": "Arrêter dans ...",
+        "command": "Arrêter [forcé] dans ...",
         "help": "arrête le chauffage dans l'église ou dans le hall",
         "help_group": "arreter",
     },
     {
-        "pattern": re.compile("^(?:programmation|lister)$", re.IGNORECASE),
+        "pattern": re.compile("^etat$", re.IGNORECASE),
+        "fn": "show_state",
+        "command": "Etat",
+        "help": "Affiche l'état du chauffage dans l'église et le hall",
+        "help_group": "demarrer",
+    },
+    {
+        "pattern": re.compile(
+            r"^(?:programmation|lister?)(?: les (?P<count>[0-9]+) prochaines?)?(?: dans (?P<place>.+?))?(?: du (?P<start>[0-9]{1,2}/[0-9]{1,2}(?:/20[0-9]{2})?))?(?: au (?P<end>[0-9]{1,2}/[0-9]{1,2}(?:/20[0-9]{2})?))?$",
+            re.IGNORECASE,
+        ),
         "fn": "list_events",
-        "command": "Lister",
+        "command": "Lister [les 5 prochaines] [dans ...] [du 01/02] [au 15/02]",
         "help": "Liste des commandes programmées",
         "help_group": "programmer",
     },
+    {
+        "pattern": re.compile(r"^(?:lister? )?(?:la )?suite$", re.IGNORECASE),
+        "fn": "list_next_events",
+        "command": "Suite",
+        "help": "Affiche la suite de la liste des commandes programmées",
+        "help_group": "programmer",
+    },
     {
         "pattern": re.compile(
             r"^ajouter? (\+?[0-9. -]+) aux numeros autorises$", re.IGNORECASE
@@ -163,6 +430,24 @@ COMMANDS = [
         "help": "Afficher la date et l'heure du système",
         "help_group": "administrer",
     },
+    {
+        "pattern": re.compile(r"^stats$", re.IGNORECASE),
+        "fn": "show_stats",
+        "command": "Stats",
+        "help": "Afficher les temps de traitement mesurés",
+        "help_group": "administrer",
+    },
+    {
+        # Matched on the original text to broadcast it with its accents
+        "pattern": re.compile(
+            r"^diffuser? +(?P<text>\S.*)$", re.IGNORECASE | re.DOTALL
+        ),
+        "raw": True,
+        "fn": "broadcast",
+        "command": "Diffuser ...",
+        "help": "Envoyer le message à tous les numéros autorisés",
+        "help_group": "administrer",
+    },
     {
         "pattern": re.compile(r"^version$", re.IGNORECASE),
         "fn": "version",
@@ -187,23 +472,7 @@ def version(dest):
     """
     The running version of the code.
     """
-    path = os.path.dirname(os.path.abspath(__file__))
-    try:
-        version_file = open(os.path.join(path, "VERSION"))
-        version = version_file.read().strip()
-    except:
-        # Couldn't read the version file, use the last git commit id
-        process = subprocess.run(
-            ["git", "show", "--format=%h", "-s"],
-            capture_output=True,
-            cwd=path,
-            text=True,
-        )
-        if process.returncode != 0:
-            version = "unknown version"
-        else:
-            version = process.stdout.strip()
-    return kang.sim.Sms(dest, version)
+    return kang.sim.Sms(dest, kang.version.DESCRIPTION)
 
 
 def thanks(dest):
@@ -213,53 +482,106 @@ def thanks(dest):
     return kang.sim.Sms(dest, "De rien !")
 
 
+def _help_message(lines):
+    return "Taper une des {} commandes suivantes:\n{}".format(
+        len(lines), "\n".join(lines)
+    )
+
+
+def _build_help():
+    """
+    Compute the help messages from the commands
+
+    :return: the messages per help group, the None key holding the list of the groups
+    """
+    groups = list(
+        dict.fromkeys(cmd["help_group"] for cmd in COMMANDS if cmd.get("help_group"))
+    )
+    texts = {None: _help_message(["- Aide {}".format(group) for group in groups])}
+    for group in groups:
+        texts[group] = _help_message(
+            [
+                "- {}".format(cmd["command"])
+                for cmd in COMMANDS
+                if cmd.get("help_group") == group
+            ]
+        )
+    return texts
+
+
+# Help messages, computed once as the commands don't change
+HELP_TEXTS = _build_help()
+
+
 def help(dest, matcher):
     """
     Display the help in a returned SMS
 
     :param dest: number to send the SMS to
     """
-    commands_help = {
-        f"- Aide {cmd.get('help_group')}" for cmd in COMMANDS if cmd.get("help_group")
-    }
+    group = None
     if matcher.group(1):
         group = matcher.group(1).lower()
         for pattern, repl in ACCENTS_MAP.items():
             group = re.sub(pattern, repl, group)
 
-        commands_help = [
-            "- {}".format(cmd["command"])
-            for cmd in COMMANDS
-            if cmd.get("help_group") == group
-        ]
-
-    message = "Taper une des {} commandes suivantes:\n{}".format(
-        len(commands_help), "\n".join(commands_help)
-    )
+    message = HELP_TEXTS.get(group)
+    if message is None:
+        message = _help_message([])
     return kang.sim.Sms(dest, message)
 
 
+def _normalize(text):
+    """
+    Lower the case, replace the accented characters and squash the spaces of a text
+    """
+    text = text.lower().strip()
+    for pattern, repl in ACCENTS_MAP.items():
+        text = re.sub(pattern, repl, text)
+    return re.sub(" +", " ", text)
+
+
+# Map of the normalized place names and aliases to the place identifiers
+_place_aliases = {}
+
+
+def configure_places(places, setup=False):
+    """
+    Set the places controlled by the system and compile their aliases
+
+    :param places: list of kang.relays.Place objects
+    :param setup: set the relays pins up again, between two pulses
+    """
+    if setup:
+        kang.relays.reconfigure(places)
+    else:
+        kang.relays.set_places(places)
+    aliases = {}
+    for place in places:
+        for alias in [place.name] + place.aliases:
+            aliases[_normalize(alias)] = place.id
+    _place_aliases.clear()
+    _place_aliases.update(aliases)
+
+
+configure_places(kang.relays.places())
+
+
 def _get_places(matcher):
     """
     Convert the text sent by the user into a known place
     """
-    places = []
-    if matcher and matcher.group("place") is not None:
-        place_input = matcher.group("place").lower()
-        if place_input in ["l'église", "l'eglise"]:
-            places = [kang.relays.CHURCH]
-        elif place_input in ["le hall"]:
-            places = [kang.relays.HALL]
-    else:
-        places = [kang.relays.CHURCH, kang.relays.HALL]
-    return places
+    if matcher and matcher.groupdict().get("place") is not None:
+        place = _place_aliases.get(_normalize(matcher.group("place")))
+        return [place] if place is not None else []
+    return [place.id for place in kang.relays.places()]
 
 
 def _get_date_time(matcher):
     """
     Parse the input date into a struct_time
     """
-    now = time.localtime()
+    now = clock.localtime()
     day = int(matcher.group("day"))
     month = matcher.group("month") or now.tm_mon
     try:
@@ -276,10 +598,11 @@ def _get_date_time(matcher):
 
 def _format_places(places):
     """
-    Convert the places into user-readable strings
+    Convert the places into user-readable strings, the removed places are shown with
+    their identifier
     """
-    place_map = {kang.relays.CHURCH: "l'église", kang.relays.HALL: "le hall"}
-    return [place_map[place] for place in places]
+    known = {place.id: place.name for place in kang.relays.places()}
+    return [known.get(place, str(place)) for place in places]
 
 
 def start_heating(dest, matcher=None):
@@ -290,8 +613,10 @@ def start_heating(dest, matcher=None):
     :param matcher: the regexp matcher with the groups
     """
     places = _get_places(matcher)
-    for place in places:
-        kang.relays.start(place)
+    if places:
+        # Switch all the places at once and wait for the relays to be released
+        force = bool(matcher and matcher.groupdict().get("force"))
+        kang.relays.start(*places, force=force).result()
 
     return kang.sim.Sms(
         dest, "Démarré dans {}".format(", ".join(_format_places(places)))
@@ -306,14 +631,39 @@ def stop_heating(dest, matcher=None):
     :param matcher: the regexp matcher with the groups
     """
     places = _get_places(matcher)
-    for place in places:
-        kang.relays.stop(place)
+    if places:
+        # Switch all the places at once and wait for the relays to be released
+        force = bool(matcher and matcher.groupdict().get("force"))
+        kang.relays.stop(*places, force=force).result()
 
     return kang.sim.Sms(
         dest, "Arrêté dans {}".format(", ".join(_format_places(places)))
     )
 
 
+def show_state(dest):
+    """
+    Show the state of the heating, as known from the commands sent to the relays
+
+    :param dest: the number sending the command
+    """
+    state = kang.relays.state()
+    lines = []
+    for place in kang.relays.places():
+        place_state = state.get(place.id)
+        if place_state is None:
+            lines.append("- {}: inconnu".format(place.name))
+            continue
+        lines.append(
+            "- {}: {} depuis le {}".format(
+                place.name,
+                "allumé" if place_state["on"] else "éteint",
+                time.strftime("%d/%m/%Y %H:%M", time.localtime(place_state["since"])),
+            )
+        )
+    return kang.sim.Sms(dest, "Chauffage:\n{}".format("\n".join(lines)))
+
+
 def schedule_heating(dest, matcher):
     """
     Schedule the start and stop of the heating
@@ -329,9 +679,10 @@ def schedule_heating(dest, matcher):
     duration_minutes = int(matcher.group("duration_minutes") or "0")
     stop_time = start_time + duration * 3600 + duration_minutes * 60
 
+    scheduler = get_scheduler_thread()
     for place in places:
-        scheduler_thread.enterabs(start_time, 0, kang.relays.start, argument=(place,))
-        scheduler_thread.enterabs(stop_time, 0, kang.relays.stop, argument=(place,))
+        scheduler.enterabs(start_time, 0, kang.relays.start, argument=(place,))
+        scheduler.enterabs(stop_time, 0, kang.relays.stop, argument=(place,))
 
     return kang.sim.Sms(
         dest, "Programmé dans {}".format(", ".join(_format_places(places)))
@@ -353,10 +704,11 @@ def cancel_heating(dest, matcher):
     duration_minutes = int(matcher.group("duration_minutes") or "0")
     stop_time = start_time + duration * 3600 + duration_minutes * 60
 
+    scheduler = get_scheduler_thread()
     errors = {}
     for place in places:
         try:
-            scheduler_thread.cancel(start_time, kang.relays.start, argument=(place,))
+            scheduler.cancel(start_time, kang.relays.start, argument=(place,))
         except ValueError:
             place_errors = errors.get(place, [])
             place_errors.append(
@@ -365,7 +717,7 @@ def cancel_heating(dest, matcher):
             errors[place] = place_errors
 
         try:
-            scheduler_thread.cancel(stop_time, kang.relays.stop, argument=(place,))
+            scheduler.cancel(stop_time, kang.relays.stop, argument=(place,))
         except ValueError:
             place_errors = errors.get(place, [])
             place_errors.append(
@@ -382,44 +734,187 @@ def cancel_heating(dest, matcher):
     return kang.sim.Sms(dest, "Démarrage et arrêt annulés")
 
 
-def cut(l, n):
-    n = max(1, n)
-    return [l[i : i + n] for i in range(0, len(l), n)]
+class Reply:
+    """
+    Reply made of a stream of lines, packed into as few SMS segments as possible.
+
+    Each SMS starts with a "<title> i/N:" header line.
+    """
+
+    def __init__(self, dest, title, lines):
+        """
+        :param dest: the number to send the reply to
+        :param title: the title of the header of each SMS
+        :param lines: iterable of the lines of the reply
+        """
+        self.number = dest
+        self.title = title
+        self.lines = lines
+
+    def _pack(self, lines, width):
+        """
+        Pack the lines into pages
+
+        :param lines: list of (line, length) tuples
+        :param width: number of digits reserved for the page numbers in the header
+        """
+        header = "{} {}/{}:\n".format(self.title, "9" * width, "9" * width)
+        header_length = kang.encoding.encoded_length(header)
+        newline_length = kang.encoding.encoded_length("\n")
+
+        pages = []
+        page = []
+        page_length = header_length
+        for line, length in lines:
+            if page:
+                new_length = kang.encoding.add_lengths(
+                    page_length, newline_length, length
+                )
+            else:
+                new_length = kang.encoding.add_lengths(page_length, length)
+
+            if kang.encoding.fits_segment(new_length):
+                page.append(line)
+                page_length = new_length
+                continue
+
+            if page:
+                pages.append(page)
+            page = []
+            page_length = header_length
+            new_length = kang.encoding.add_lengths(header_length, length)
+            if kang.encoding.fits_segment(new_length):
+                page.append(line)
+                page_length = new_length
+            else:
+                # The line doesn't even fit alone: hard wrap it
+                chunks = kang.encoding.split_segments(line, header)
+                pages.extend([chunk] for chunk in chunks[:-1])
+                page.append(chunks[-1])
+                page_length = kang.encoding.add_lengths(
+                    header_length, kang.encoding.encoded_length(chunks[-1])
+                )
+        if page:
+            pages.append(page)
+        return pages
+
+    def messages(self):
+        """
+        :return: the list of SMS to send
+        """
+        lines = [(line, kang.encoding.encoded_length(line)) for line in self.lines]
+        width = 1
+        pages = self._pack(lines, width)
+        while len(str(len(pages))) > width:
+            width += 1
+            pages = self._pack(lines, width)
+
+        return [
+            kang.sim.Sms(
+                self.number,
+                "{} {}/{}:\n{}".format(self.title, i + 1, len(pages), "\n".join(page)),
+            )
+            for i, page in enumerate(pages)
+        ]
+
+
+def _format_event(event):
+    """
+    Convert a scheduled event into a user-readable string
+    """
+    name_map = {
+        kang.relays.start: "démarrer",
+        kang.relays.stop: "arrêter",
+    }
+    return "- {}: {} - {}".format(
+        time.strftime("%d/%m/%Y %H:%M", time.localtime(event.time)),
+        name_map[event.action],
+        "".join(_format_places(event.argument)),
+    )
+
+
+def _get_day(text):
+    """
+    Parse a dd/mm or dd/mm/yyyy date into the timestamp of the start of that day
 
+    @raise ValueError: if the date doesn't exist
+    """
+    now = clock.localtime()
+    parts = [int(part) for part in text.split("/")]
+    year = parts[2] if len(parts) > 2 else now.tm_year
+    try:
+        day = datetime.date(year, parts[1], parts[0])
+        return time.mktime((day.year, day.month, day.day, 0, 0, 0, 0, 1, -1))
+    except OverflowError as err:
+        raise ValueError(str(err))
 
-def list_events(dest):
+
+def _list_events_page(dest, filters, limit, after=None):
     """
-    List the scheduled events
+    Format one page of the scheduled events
 
     :param dest: the number sending the command
+    :param filters: the filters to pass to the scheduler
+    :param limit: the maximum number of events in the page
+    :param after: the cursor of the previous page, None for the first page
     """
-    events = scheduler_thread.events
-    if events:
-        name_map = {
-            kang.relays.start: "démarrer",
-            kang.relays.stop: "arrêter",
-        }
-        messages = []
-        chunks = cut(events, 4)
-        for i, batch in enumerate(chunks):
-            events_message = [
-                "- {}: {} - {}".format(
-                    time.strftime("%d/%m/%Y %H:%M", time.localtime(event.time)),
-                    name_map[event.action],
-                    "".join(_format_places(event.argument)),
-                )
-                for event in batch
-            ]
-            messages.append(
-                kang.sim.Sms(
-                    dest,
-                    "Programmation {}/{}:\n{}".format(
-                        i + 1, len(chunks), "\n".join(events_message)
-                    ),
-                )
+    events, cursor = get_scheduler_thread().select(limit=limit, after=after, **filters)
+    if not events:
+        _list_cursors.pop(dest, None)
+        return kang.sim.Sms(dest, "Aucune programmation")
+
+    if cursor is None:
+        _list_cursors.pop(dest, None)
+    else:
+        _list_cursors[dest] = (filters, limit, cursor)
+        _list_cursors.move_to_end(dest)
+        if len(_list_cursors) > MAX_LIST_CURSORS:
+            _list_cursors.popitem(last=False)
+
+    lines = (_format_event(event) for event in events)
+    if cursor is not None:
+        lines = itertools.chain(lines, ["Envoyer 'Suite' pour la suite"])
+    return Reply(dest, "Programmation", lines)
+
+
+def list_events(dest, matcher):
+    """
+    List the scheduled events, optionally filtered by place and date
+
+    :param dest: the number sending the command
+    :param matcher: the regexp matcher with the groups
+    """
+    filters = {}
+    if matcher.group("place") is not None:
+        places = _get_places(matcher)
+        if not places:
+            return kang.sim.Sms(dest, "Lieu inconnu")
+        filters["argument"] = (places[0],)
+    try:
+        if matcher.group("start"):
+            filters["start"] = _get_day(matcher.group("start"))
+        if matcher.group("end"):
+            # Include the whole end day
+            end = time.localtime(_get_day(matcher.group("end")))
+            filters["end"] = time.mktime(
+                (end.tm_year, end.tm_mon, end.tm_mday + 1, 0, 0, 0, 0, 1, -1)
             )
-        return messages
-    return kang.sim.Sms(dest, "Aucune programmation")
+    except ValueError:
+        return kang.sim.Sms(dest, UNKNOWN_COMMAND)
+    limit = int(matcher.group("count") or EVENTS_PAGE_SIZE)
+    return _list_events_page(dest, filters, limit)
+
+
+def list_next_events(dest):
+    """
+    List the next page of the scheduled events
+
+    :param dest: the number sending the command
+    """
+    if dest not in _list_cursors:
+        return kang.sim.Sms(dest, "Aucune suite à afficher")
+    filters, limit, cursor = _list_cursors[dest]
+    return _list_events_page(dest, filters, limit, cursor)
 
 
 def add_authorized(dest, matcher):
@@ -476,6 +971,18 @@ def remove_authorized(dest, matcher):
     return kang.sim.Sms(dest, "Numéro supprimé")
 
 
+def _authorized_numbers():
+    """
+    :return: the list of the numbers of the authorized file
+    """
+    with open(AUTH_FILE, "r") as auth_fd:
+        return [
+            line.strip()
+            for line in auth_fd.readlines()
+            if line.strip() != "" and not line.startswith("#")
+        ]
+
+
 def list_authorized(dest):
     """
     List the authorized numbers
@@ -486,146 +993,473 @@ def list_authorized(dest):
 
     log.debug("Listing authorized numbers")
 
-    with open(AUTH_FILE, "r+") as auth_fd:
-        all_numbers = [
-            line.strip()
-            for line in auth_fd.readlines()
-            if line.strip() != "" and not line.startswith("#")
+    all_numbers = _authorized_numbers()
+    return Reply(dest, "Numéros autorisés", ("- " + number for number in all_numbers))
+
+
+class Broadcast:
+    """
+    Message sent to several numbers, followed by a summary reply to its sender.
+
+    It is sent like an SMS: the recipients already handled are not sent the message
+    again if the sending is retried on another modem, except the ones which failed
+    because of the modem. Its message is the summary: the journal sends it back to the
+    sender after a crash, but doesn't warn the recipients twice.
+    """
+
+    def __init__(self, dest, numbers, text):
+        """
+        :param dest: the number sending the command, getting the summary
+        :param numbers: the numbers to send the message to
+        :param text: the message
+        """
+        self.number = dest
+        self.text = text
+        self.numbers = numbers
+        # Error or None for the numbers already handled
+        self.results = {}
+
+    def _summary_lines(self):
+        failures = [(number, error) for number, error in self.results.items() if error]
+        lines = [
+            "Envoyé à {}/{} numéros".format(
+                len(self.results) - len(failures), len(self.numbers)
+            )
         ]
-        messages = []
-        chunks = cut(all_numbers, 10)
-        for i, batch in enumerate(chunks):
-            message_body = ["- " + number for number in batch]
-            messages.append(
-                kang.sim.Sms(
-                    dest,
-                    "Numéros autorisés {}/{}:\n{}".format(
-                        i + 1, len(chunks), "\n".join(message_body)
-                    ),
-                )
+        lines.extend("- {}: {}".format(number, error) for number, error in failures)
+        return lines
+
+    @property
+    def message(self):
+        return "Diffusion:\n{}".format("\n".join(self._summary_lines()))
+
+    def summary(self):
+        """
+        :return: the Reply describing the sending results
+        """
+        return Reply(self.number, "Diffusion", self._summary_lines())
+
+    def send(self, sim):
+        """
+        :param sim: the SIM serial handle
+        """
+        # Send to the numbers not handled yet or left out by a failing modem
+        pending = [
+            number
+            for number in self.numbers
+            if number not in self.results
+            or (
+                self.results[number] is not None
+                and kang.modems.modem_error(self.results[number])
+            )
+        ]
+        handled = set()
+        with kang.metrics.timer("sms_broadcast"):
+            try:
+                for number, error in kang.sim.sendAllSms(sim, pending, self.text):
+                    self.results[number] = error
+                    handled.add(number)
+                    if len(self.results) % 10 == 0:
+                        log.info(
+                            "Broadcast sent to %s/%s numbers",
+                            len(self.results),
+                            len(self.numbers),
+                        )
+            except Exception as err:
+                # Report the numbers left out, another modem may send them the
+                # message if the summary can't be sent either
+                log.error("Broadcast interrupted: %s: %s", type(err).__name__, err)
+                for number in pending:
+                    if number not in handled:
+                        self.results[number] = err
+        for message in self.summary().messages():
+            message.send(sim)
+
+
+def broadcast(dest, matcher):
+    """
+    Send a message to all the authorized numbers
+
+    :param dest: the number sending the command
+    :param matcher: the regexp matcher with the groups
+    """
+    if dest not in _config.get("admins", []):
+        return kang.sim.Sms(dest, "Commande réservée aux administrateurs")
+
+    numbers = [number for number in _authorized_numbers() if number != dest]
+    if not numbers:
+        return kang.sim.Sms(dest, "Aucun numéro à qui envoyer le message")
+    log.info("Broadcasting a message to %s numbers", len(numbers))
+    return Broadcast(dest, numbers, matcher.group("text").strip())
+
+
+def show_stats(dest):
+    """
+    Show the latency metrics to the administrators
+
+    :param dest: the number sending the command
+    """
+    if dest not in _config.get("admins", []):
+        return kang.sim.Sms(dest, "Commande réservée aux administrateurs")
+
+    histograms, counters = kang.metrics.snapshot()
+    lines = []
+    for name in sorted(histograms):
+        count, _, maximum, median, p95 = histograms[name]
+        lines.append(
+            "- {}: {} fois, médiane {:.3f}s, 95% {:.3f}s, max {:.3f}s".format(
+                name, count, median, p95, maximum
             )
-        return messages
+        )
+    lines.extend(
+        "- {}: {}".format(name, value) for name, value in sorted(counters.items())
+    )
+    return Reply(dest, "Statistiques", lines or ["Aucune mesure"])
 
 
 def show_date(dest):
     """
     Output the current date and time of the system
     """
-    now = datetime.datetime.now().isoformat(sep=" ", timespec="seconds")
+    now = clock.now().isoformat(sep=" ", timespec="seconds")
     return kang.sim.Sms(dest, now)
 
 
-def process_command(sms, sim):
+def handle_command(sms):
     """
-    Process the received message and trigger the proper action
+    Run the command of the received message
+
+    :param sms: the received message
+    :return: the list of SMS to send back
     """
-    # Replace the accented characters
-    message = sms.message.lower().strip()
-    for pattern, repl in ACCENTS_MAP.items():
-        message = re.sub(pattern, repl, message)
+    with _config_lock:
+        return _handle_command(sms)
 
-    # squash consecutive spaces
-    message = re.sub(" +", " ", message)
 
-    processed = False
+def match_command(text):
+    """
+    Find the command of a message text
+
+    :param text: the text of the message
+    :return: a (command, matcher) tuple, (None, None) if no command matches
+    """
+    # Replace the accented characters and squash consecutive spaces
+    message = _normalize(text)
+
+    start = time.monotonic()
     for cmd in COMMANDS:
-        matcher = cmd["pattern"].fullmatch(message)
+        matcher = cmd["pattern"].fullmatch(text.strip() if cmd.get("raw") else message)
         if matcher:
-            processed = True
+            kang.metrics.observe("command_match", time.monotonic() - start)
+            return cmd, matcher
+    return None, None
+
+
+def _handle_command(sms):
+    cmd, matcher = match_command(sms.message)
+    if cmd:
+        kang.metrics.increment("command_" + cmd["fn"])
+        with kang.metrics.timer("command_run"):
             if cmd["pattern"].groups > 0:
                 response = globals()[cmd["fn"]](sms.number, matcher)
             else:
                 response = globals()[cmd["fn"]](sms.number)
 
-            # Send the response SMS if needed
-            if response and isinstance(response, list):
-                for message in response:
-                    try:
-                        message.send(sim)
-                    except CmsError as err:
-                        log.error("Failed to send SMS to %s: %s", message.number, err)
-            else:
-                try:
-                    response.send(sim)
-                except CmsError as err:
-                    log.error("Failed to send SMS to %s: %s", response.number, err)
-            break
-    if not processed:
-        kang.sim.Sms(
-            sms.number,
-            "Commande inconnue, envoyer 'aide' pour vérifier les commandes disponibles",
-        )
+        if isinstance(response, Reply):
+            return response.messages()
+        if isinstance(response, list):
+            return response
+        return [response] if response else []
+    kang.metrics.increment("command_unknown")
+    return [kang.sim.Sms(sms.number, UNKNOWN_COMMAND)]
+
+
+def process_command(sms, sim):
+    """
+    Process the received message, trigger the proper action and send the replies
+    """
+    for message in handle_command(sms):
+        try:
+            message.send(sim)
+        except CmsError as err:
+            log.error("Failed to send SMS to %s: %s", message.number, err)
+
+
+def notify_admins(sim, config, message):
+    """
+    Send a message to all the administrators
+
+    :param sim: the SIM serial handle
+    :param config: the loaded configuration
+    :param message: the text to send
+    """
+    log.debug("admins {}".format(config.get("admins", [])))
+    for admin in config.get("admins", []):
+        try:
+            kang.sim.Sms(admin, message).send(sim)
+        except CmsError as cms_err:
+            log.error("Failed to send SMS to %s: %s", admin, cms_err)
 
 
-def setTime(ts):
+def catch_up(sim, config):
     """
-    Set the system time. Requires running as root
+    Handle the scheduled events missed while the system was off
 
-    @param ts: the timestamp
+    :param sim: the SIM serial handle
+    :param config: the loaded configuration
     """
-    process = subprocess.run(
-        ["date", ts.strftime("%m%d%H%M%y.%S")], capture_output=True
+    policy = config.get("catch_up", "coalesce")
+    applied, skipped = get_scheduler_thread().catch_up(policy)
+    if not applied and not skipped:
+        return
+
+    log.warning(
+        "Caught up missed events with %s policy: %s applied, %s skipped",
+        policy,
+        len(applied),
+        len(skipped),
+    )
+    notify_admins(
+        sim,
+        config,
+        _missed_events_message(
+            "Programmations manquées pendant l'arrêt", applied, skipped
+        ),
     )
-    if process.returncode != 0:
-        logging.error("Failed to set date: %s", process.stderr)
 
 
-def main():
-    locale.setlocale(locale.LC_ALL, "fr_FR.utf-8")
-    config = load_configuration()
-    log.info("Starting")
-    sim = kang.sim.setup()
-    kang.relays.setup()
+def _missed_events_message(title, applied, skipped):
+    """
+    Describe the events handled by a catch up to the administrators
+    """
+    message = "{}:\n".format(title)
+    if applied:
+        message += "Appliquées:\n{}\n".format(
+            "\n".join(_format_event(event) for event in applied)
+        )
+    if skipped:
+        message += "Ignorées: {}".format(len(skipped))
+    return message.strip()
+
+
+class App:
+    """
+    The running daemon.
+
+    Nothing touches the modem, the relays or the scheduled events before start(), so
+    that the other commands of the kang executable don't pay for the hardware setup.
+    """
 
-    # Set the time from the GSM network
-    now = kang.sim.getTime(sim)
-    if now:
-        setTime(now)
+    def __init__(self, config):
+        """
+        @param config: the loaded configuration
+        """
+        self.config = config
+        self.modems = None
+        self.sim = None
+        self.scheduler_thread = None
+        self.journal = None
+        self.tracker = None
+        self.pipeline = None
+        self.profiler = None
+        self.timesync = None
+        self.errors = kang.errors.ErrorAggregator(
+            config.get("error_digest_interval", kang.errors.DIGEST_INTERVAL)
+        )
 
-    scheduler_thread.start()
+    def start(self):
+        """
+        Set the modem, relays and scheduler up and start processing the messages
+        """
+        import kang.delivery
+        import kang.journal
+        import kang.pipeline
+        import kang.profiling
+
+        config = self.config
+        self.profiler = kang.profiling.Profiler.from_config(config.get("profiling"))
+        delivery_reports = config.get("delivery_reports", False)
+        # The first modem sets the time and sends the catch up notifications
+        self.modems = kang.modems.open_pool(config.get("modems"), delivery_reports)
+        self.sim = self.modems.modems[0].sim
+        gpio_config = dict(config.get("gpio", {}))
+        kang.relays.setup(
+            kang.gpio.get_backend(gpio_config.pop("backend", "rpi"), **gpio_config)
+        )
+        kang.relays.load_state(STATE_FILE)
+
+        self.scheduler_thread = get_scheduler_thread()
+        self.journal = kang.journal.Journal(JOURNAL_FILE)
+        self.journal.prune(JOURNAL_RETENTION)
+        if delivery_reports:
+            kang.sim.delivery_reports = True
+            self.tracker = kang.delivery.DeliveryTracker()
+
+        self.pipeline = kang.pipeline.Pipeline(
+            self.modems,
+            is_allowed,
+            handle_command,
+            poll_interval=config.get("poll_interval", kang.pipeline.POLL_INTERVAL),
+            on_error=self.report_error,
+            journal=self.journal,
+            tracker=self.tracker,
+        )
 
-    ret = 0
-    while True:
-        sms = None
+        # Set the time from the GSM network before handling the missed events
+        self.timesync = kang.timesync.TimeSync(
+            self.sim,
+            self.pipeline.modem_lock,
+            self.scheduler_thread,
+            config.get("catch_up", "coalesce"),
+            self.report_time_jump,
+            config.get("time_sync_interval", kang.timesync.SYNC_INTERVAL),
+        )
+        self.timesync.sync()
+        catch_up(self.sim, config)
+
+        self.scheduler_thread.start()
+        self.pipeline.start()
+        if self.timesync.interval:
+            self.timesync.start()
+
+    def report_time_jump(self, offset, applied, skipped):
+        if not applied and not skipped:
+            return
+        message = _missed_events_message(
+            "Programmations sautées par le changement d'heure", applied, skipped
+        )
+        self.notify(message)
+
+    def notify(self, message):
+        """
+        Queue a message to all the administrators
+        """
+        for admin in _config.get("admins", []):
+            self.pipeline.send(kang.sim.Sms(admin, message))
+
+    def report_error(self, stage, err):
+        message = self.errors.record(err, stage.stage_name)
+        if message:
+            self.notify(message)
+
+    def loop(self):
+        """
+        Watch the configuration, the profiling requests and the pipeline health
+
+        @return: the exit code
+        """
+        profiler = self.profiler
+
+        # Reload the configuration on SIGHUP
+        reload_requested = threading.Event()
+        signal.signal(signal.SIGHUP, lambda signum, frame: reload_requested.set())
+        config_mtime = _config_mtime()
+
+        # Dump the profiles on SIGUSR1, always handled to not be killed by it
+        profile_requested = threading.Event()
+        signal.signal(signal.SIGUSR1, lambda signum, frame: profile_requested.set())
+
+        ret = 0
         try:
-            ids = kang.sim.getAllSmsIds(sim)
-            for idx in ids:
-                try:
-                    sms = kang.sim.Sms.read(sim, idx)
-                    if is_authorized(sms.number):
-                        process_command(sms, sim)
+            for tick in itertools.count(1):
+                time.sleep(1)
+                if _config.get("watch_config") and _config_mtime() != config_mtime:
+                    reload_requested.set()
+                if reload_requested.is_set():
+                    reload_requested.clear()
+                    config_mtime = _config_mtime()
+                    reload_configuration()
+                if profile_requested.is_set():
+                    profile_requested.clear()
+                    if profiler:
+                        profiler.dump()
                     else:
-                        log.info("Unauthorized message from %s", sms.number)
-                finally:
-                    # Remove the message to avoid processing twice
-                    # Also remove if the message triggered an error while processing
-                    kang.sim.Sms.delete(sim, idx)
-
-                # How frequent do we need to check? are 15s OK?
-                time.sleep(15)
+                        log.warning("Profiling disabled, nothing to dump")
+                elif (
+                    profiler
+                    and profiler.snapshot_interval
+                    and not tick % profiler.snapshot_interval
+                ):
+                    profiler.dump_memory()
+
+                digest = self.errors.digest()
+                if digest:
+                    self.notify(digest)
+
+                metrics = _config.get("metrics", {})
+                if metrics.get("path") and not tick % metrics.get("interval", 60):
+                    kang.metrics.write_textfile(metrics["path"])
+
+                if tick % HEALTH_INTERVAL:
+                    continue
+                for health in self.pipeline.health():
+                    log.debug("Stage health: %s", health)
+                    if not health["alive"]:
+                        log.error("The %s stage died, exiting", health["name"])
+                        ret = 1
+                for health in self.modems.health():
+                    log.debug("Modem health: %s", health)
+                if ret:
+                    break
         except KeyboardInterrupt:
             log.warning("Stopped by user")
-            break
-        except Exception as err:
-            log.debug("admins {}".format(config.get("admins", [])))
-            message = (
-                "Erreur inattendue: veuillez consulter les logs.\n > {}: {}".format(
-                    type(err).__name__, err
-                )
-            )
-            for admin in config.get("admins", []):
-                try:
-                    kang.sim.Sms(admin, message).send(sim)
-                except CmsError as cms_err:
-                    log.error("Failed to send SMS to %s: %s", admin, cms_err)
-            # We want to stay alive as much as possible, log errors and continue
-            log.exception("Unexpected error")
-
-    scheduler_thread.stop()
-    scheduler_thread.join()
-    kang.relays.clean()
-    sim.close()
-    sys.exit(ret)
+        return ret
+
+    def stop(self):
+        """
+        Stop processing the messages and release the hardware
+        """
+        if self.timesync:
+            self.timesync.stop()
+        if self.pipeline:
+            self.pipeline.stop()
+        if self.profiler:
+            self.profiler.stop()
+        if self.journal:
+            self.journal.close()
+        if self.scheduler_thread and self.scheduler_thread.is_alive():
+            self.scheduler_thread.stop()
+            self.scheduler_thread.join()
+        kang.relays.clean()
+        if self.sim:
+            self.sim.close()
+
+    def run(self):
+        """
+        @return: the exit code
+        """
+        self.start()
+        try:
+            return self.loop()
+        finally:
+            self.stop()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == "replay":
+        import kang.replay
+
+        return kang.replay.main(argv[1:])
+
+    parser = argparse.ArgumentParser(
+        prog="kang",
+        description="SMS-controlled heating system",
+        epilog="Run 'kang replay --help' to replay recorded messages offline.",
+    )
+    parser.add_argument(
+        "--check-config",
+        action="store_true",
+        help="validate kang.json and exit without touching the hardware",
+    )
+    args = parser.parse_args(argv)
+    if args.check_config:
+        sys.exit(check_config())
+
+    locale.setlocale(locale.LC_ALL, "fr_FR.utf-8")
+    config = load_configuration()
+    log.info("Starting")
+    sys.exit(App(config).run())
 
 
 if __name__ == "__main__":
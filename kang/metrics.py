@@ -0,0 +1,186 @@
+"""
+Lightweight latency and event metrics
+
+The durations are kept in fixed-bucket histograms and the events in counters, so the
+memory used doesn't grow with the uptime. The metrics can be written in the Prometheus
+text format for the node_exporter textfile collector.
+"""
+
+import bisect
+import contextlib
+import functools
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of the histograms buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Prefix of the exported metrics names
+PREFIX = "kang_"
+
+
+class Histogram:
+    """
+    Distribution of durations in fixed buckets
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        # The last count is for the values above the last bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        @return: the upper bound of the bucket containing the q quantile, capped by the
+                 maximum, None if empty
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulated = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulated += count
+            if cumulated >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+
+
+def observe(name, seconds):
+    """
+    Record a duration
+
+    @param name: the name of the measured operation
+    @param seconds: the duration
+    """
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+
+def increment(name, value=1):
+    """
+    Increment a counter
+
+    @param name: the name of the counter
+    @param value: the value to add
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+@contextlib.contextmanager
+def timer(name):
+    """
+    Context manager recording the duration of its block, even if it fails
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - start)
+
+
+def timed(name):
+    """
+    Decorator recording the duration of the calls of a function
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def snapshot():
+    """
+    @return: a (histograms, counters) tuple of copies of the current metrics.
+             The histograms are (count, sum, max, p50, p95) tuples.
+    """
+    with _lock:
+        histograms = {
+            name: (h.count, h.sum, h.max, h.quantile(0.5), h.quantile(0.95))
+            for name, h in _histograms.items()
+        }
+        return histograms, dict(_counters)
+
+
+def reset():
+    """
+    Forget all the recorded metrics
+    """
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+def _format_bound(bound):
+    return "{:g}".format(bound)
+
+
+def render():
+    """
+    @return: the metrics in the Prometheus text exposition format
+    """
+    lines = []
+    with _lock:
+        for name in sorted(_histograms):
+            histogram = _histograms[name]
+            metric = "{}{}_seconds".format(PREFIX, name)
+            lines.append("# TYPE {} histogram".format(metric))
+            cumulated = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulated += count
+                lines.append(
+                    '{}_bucket{{le="{}"}} {}'.format(
+                        metric, _format_bound(bound), cumulated
+                    )
+                )
+            lines.append('{}_bucket{{le="+Inf"}} {}'.format(metric, histogram.count))
+            lines.append("{}_sum {:.6f}".format(metric, histogram.sum))
+            lines.append("{}_count {}".format(metric, histogram.count))
+        for name in sorted(_counters):
+            metric = "{}{}_total".format(PREFIX, name)
+            lines.append("# TYPE {} counter".format(metric))
+            lines.append("{} {}".format(metric, _counters[name]))
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path):
+    """
+    Write the metrics to a file for the node_exporter textfile collector.
+    The file is replaced atomically so that it is never read half-written.
+
+    @param path: the path of the .prom file
+    """
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(tmp_path, "w") as fd:
+            fd.write(render())
+        os.replace(tmp_path, path)
+    except OSError as err:
+        log.error("Failed to write the metrics to %s: %s", path, err)
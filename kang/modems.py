@@ -0,0 +1,186 @@
+"""
+Pool of modems, each with its own serial port and SIM
+
+The received messages are polled on all the modems. The SMS to send go to the least
+busy healthy modem: a modem failing several times in a row is left aside for a while
+and its messages are sent by the other ones.
+"""
+
+import logging
+import threading
+import time
+
+from kang.cms_error import CmsError
+import kang.metrics
+
+log = logging.getLogger(__name__)
+
+# Serial device of the modem when none is configured
+DEFAULT_DEVICE = "/dev/ttyAMA0"
+
+# Number of consecutive failures before leaving a modem aside
+MAX_FAILURES = 3
+
+# Time a failing modem is left aside, in seconds
+COOLDOWN = 300
+
+# CMS errors caused by the modem or its network rather than by the message
+MODEM_ERRORS = ["-1", "38", "41", "42", "47", "331", "332"]
+
+
+class Modem:
+    """
+    A modem and its health
+    """
+
+    def __init__(self, sim, name="modem", clock=time.monotonic):
+        """
+        @param sim: the SIM serial handle
+        @param name: the name of the modem in the logs
+        @param clock: function returning the current time in seconds
+        """
+        self.sim = sim
+        self.name = name
+        self.clock = clock
+        # Serializes the AT commands sent to the modem
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.retry_at = None
+        self.sent = 0
+        self.pending = 0
+        self.last_error = None
+
+    def healthy(self):
+        """
+        @return: False if the modem failed too often recently
+        """
+        return self.retry_at is None or self.clock() >= self.retry_at
+
+    def succeeded(self):
+        self.failures = 0
+        self.retry_at = None
+
+    def failed(self, err):
+        """
+        Record a failure of the modem
+        """
+        self.failures += 1
+        self.last_error = "{}: {}".format(type(err).__name__, err)
+        kang.metrics.increment("modem_failures")
+        if self.failures >= MAX_FAILURES:
+            if self.healthy():
+                log.error("Modem %s failed %s times", self.name, self.failures)
+            self.retry_at = self.clock() + COOLDOWN
+
+    def health(self):
+        """
+        @return: a dictionary describing the state of the modem
+        """
+        return {
+            "name": self.name,
+            "healthy": self.healthy(),
+            "failures": self.failures,
+            "sent": self.sent,
+            "last_error": self.last_error,
+        }
+
+
+def modem_error(err):
+    """
+    @return: True if the error is due to the modem, False if due to the message
+    """
+    return not isinstance(err, CmsError) or err.code in MODEM_ERRORS
+
+
+class ModemPool:
+    """
+    Modems used as one
+    """
+
+    def __init__(self, modems):
+        """
+        @param modems: the list of Modem objects, the first one being the main modem
+        """
+        if not modems:
+            raise ValueError("At least one modem is needed")
+        self.modems = modems
+        self._lock = threading.Lock()
+
+    def readable(self):
+        """
+        @return: the modems to poll for received messages, all of them if none is healthy
+        """
+        return [modem for modem in self.modems if modem.healthy()] or self.modems
+
+    def _pick(self, tried):
+        with self._lock:
+            candidates = [modem for modem in self.modems if modem not in tried]
+            if not candidates:
+                return None
+            modem = min(
+                candidates,
+                key=lambda modem: (not modem.healthy(), modem.pending, modem.sent),
+            )
+            modem.pending += 1
+            return modem
+
+    def send(self, sms):
+        """
+        Send an SMS with the least busy healthy modem, trying the others on failure
+
+        @raise CmsError: if the message is refused
+        @raise Exception: the error of the last modem if none could send the message
+        """
+        tried = []
+        while True:
+            modem = self._pick(tried)
+            if modem is None:
+                raise last_error
+            tried.append(modem)
+            try:
+                with modem.lock:
+                    sms.send(modem.sim)
+            except Exception as err:
+                if not modem_error(err):
+                    raise
+                modem.failed(err)
+                last_error = err
+                if len(tried) < len(self.modems):
+                    log.warning("Failed to send SMS with %s: %s", modem.name, err)
+                continue
+            else:
+                modem.succeeded()
+                modem.sent += 1
+                return modem
+            finally:
+                with self._lock:
+                    modem.pending -= 1
+
+    def health(self):
+        """
+        @return: the list of the modems health dictionaries
+        """
+        return [modem.health() for modem in self.modems]
+
+    def close(self):
+        for modem in self.modems:
+            modem.sim.close()
+
+
+def open_pool(devices=None, delivery_reports=False):
+    """
+    Set the modems up
+
+    @param devices: the list of the serial devices, the default one if empty
+    @param delivery_reports: get the delivery reports of the sent messages
+    @return: the ModemPool
+    """
+    import kang.sim
+
+    devices = devices or [DEFAULT_DEVICE]
+    return ModemPool(
+        [
+            Modem(kang.sim.setup(device, delivery_reports), name=device)
+            for device in devices
+        ]
+    )
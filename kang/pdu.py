@@ -0,0 +1,298 @@
+"""
+Decoding of the received SMS-DELIVER and SMS-STATUS-REPORT PDUs
+
+The hex digits read from the modem are converted to binary in a single step, straight
+from the read buffer, and the fields are read from that binary data: unlike
+smspdudecoder.easy.read_incoming_sms() no intermediate hex strings are built. The
+result has the same form as the one of read_incoming_sms().
+"""
+
+import binascii
+import datetime
+
+# Offset of the extension table characters in the GSM 03.38 decoding map
+_ESCAPE = 0x1B
+
+# Hex digits of the longest PDU: 12 bytes of SMSC address and 164 bytes of TPDU
+PDU_BUFFER_SIZE = 2 * (12 + 164)
+
+# GSM 03.38 tables, imported on first use
+_decoding_map = None
+_extra_decoding_map = None
+
+
+def _load_maps():
+    global _decoding_map, _extra_decoding_map
+    if _decoding_map is None:
+        from smspdu.gsm0338 import decoding_map, extra_decoding_map
+
+        _extra_decoding_map = extra_decoding_map
+        _decoding_map = decoding_map
+
+
+def _unpack_septets(data, count):
+    """
+    @param data: the packed 7 bit characters
+    @param count: the number of septets to read
+    @return: the list of the septets values
+    """
+    septets = []
+    bits = 0
+    available = 0
+    for byte in data:
+        bits |= byte << available
+        available += 8
+        while available >= 7 and len(septets) < count:
+            septets.append(bits & 0x7F)
+            bits >>= 7
+            available -= 7
+        if len(septets) == count:
+            break
+    return septets
+
+
+def _decode_gsm7(septets):
+    chars = []
+    escaped = False
+    for septet in septets:
+        if escaped:
+            escaped = False
+            chars.append(chr(_extra_decoding_map.get(septet, 0x20)))
+        elif septet == _ESCAPE:
+            escaped = True
+        else:
+            chars.append(chr(_decoding_map[septet]))
+    return "".join(chars)
+
+
+def _decode_semi_octets(data):
+    """
+    @return: the value of a semi-octet encoded byte, like in the timestamps
+    """
+    return (data & 0x0F) * 10 + (data >> 4)
+
+
+def _decode_address(data, digits, toa):
+    if toa & 0x70 == 0x50:
+        # Alphanumeric address
+        return _decode_gsm7(_unpack_septets(data, digits * 4 // 7))
+    number = binascii.hexlify(bytes((b & 0x0F) << 4 | b >> 4 for b in data))
+    number = number[:digits].decode("ascii")
+    return "+" + number if toa & 0x70 == 0x10 else number
+
+
+def _decode_timestamp(data):
+    """
+    @return: the timezone-aware service center timestamp, in UTC
+    """
+    year, month, day, hour, minute, second = [
+        _decode_semi_octets(byte) for byte in data[:6]
+    ]
+    quarters = (data[6] & 0x07) * 10 + (data[6] >> 4)
+    if data[6] & 0x08:
+        quarters = -quarters
+    tz = datetime.timezone(datetime.timedelta(minutes=15 * quarters))
+    date = datetime.datetime(2000 + year, month, day, hour, minute, second, tzinfo=tz)
+    return date.astimezone(datetime.timezone.utc)
+
+
+def _alphabet(dcs):
+    """
+    @return: gsm, binary or ucs2 depending on the data coding scheme
+    """
+    group = dcs >> 4
+    if group < 0x08:
+        if dcs & 0x20:
+            raise ValueError("Compressed messages are not supported")
+        return ["gsm", "binary", "ucs2", "gsm"][(dcs >> 2) & 0x03]
+    if group in [0x0C, 0x0D]:
+        return "gsm"
+    if group == 0x0E:
+        return "ucs2"
+    if group == 0x0F:
+        return "binary" if dcs & 0x04 else "gsm"
+    raise ValueError("Unsupported data coding scheme: {:02X}".format(dcs))
+
+
+def _decode_header(header):
+    """
+    @return: the concatenation information of the user data header, False if none
+    """
+    pos = 0
+    while pos + 2 <= len(header):
+        iei = header[pos]
+        length = header[pos + 1]
+        element = header[pos + 2 : pos + 2 + length]
+        pos += 2 + length
+        if iei == 0x00 and length == 3:
+            reference, count, number = element[0], element[1], element[2]
+        elif iei == 0x08 and length == 4:
+            reference = element[0] << 8 | element[1]
+            count, number = element[2], element[3]
+        else:
+            continue
+        return {
+            "reference": "{}-{}".format(reference, count),
+            "parts_count": count,
+            "part_number": number,
+        }
+    return False
+
+
+def decode_deliver(hex_data):
+    """
+    Decode a received message PDU
+
+    @param hex_data: the hex digits of the PDU, as a bytes-like object or an ASCII string
+    @return: a dictionary with the sender, content, date and partial values
+    @raise ValueError: if the PDU is invalid or not supported
+    """
+    try:
+        data = binascii.unhexlify(hex_data)
+    except (binascii.Error, TypeError) as err:
+        raise ValueError("Invalid PDU hex digits: {}".format(err)) from err
+
+    try:
+        pos = data[0] + 1
+        first = data[pos]
+        if first & 0x03 != 0x00:
+            raise ValueError("Not an SMS-DELIVER PDU")
+        digits = data[pos + 1]
+        toa = data[pos + 2]
+        pos += 3
+        length = (digits + 1) // 2
+        address = memoryview(data)[pos : pos + length]
+        if len(address) != length:
+            raise ValueError("Truncated PDU")
+        pos += length
+        dcs = data[pos + 1]
+        date = _decode_timestamp(data[pos + 2 : pos + 9])
+        pos += 9
+        user_data_length = data[pos]
+        user_data = memoryview(data)[pos + 1 :]
+    except IndexError as err:
+        raise ValueError("Truncated PDU") from err
+
+    _load_maps()
+    header_length = 0
+    partial = False
+    if first & 0x40 and len(user_data):
+        header_length = user_data[0] + 1
+        partial = _decode_header(user_data[1:header_length])
+
+    alphabet = _alphabet(dcs)
+    if alphabet == "gsm":
+        header_septets = (header_length * 8 + 6) // 7
+        septets = _unpack_septets(user_data, user_data_length)
+        if len(septets) < user_data_length:
+            raise ValueError("Truncated PDU")
+        content = _decode_gsm7(septets[header_septets:])
+    else:
+        payload = user_data[header_length:user_data_length]
+        if len(payload) < user_data_length - header_length:
+            raise ValueError("Truncated PDU")
+        if alphabet == "ucs2":
+            content = str(payload, "utf-16-be")
+        else:
+            content = bytes(payload)
+
+    return {
+        "date": date,
+        "sender": _decode_address(address, digits, toa),
+        "content": content,
+        "partial": partial,
+    }
+
+
+def is_status_report(hex_data):
+    """
+    @param hex_data: the hex digits of the PDU, as a bytes-like object or an ASCII string
+    @return: True if the PDU is an SMS-STATUS-REPORT
+    """
+    try:
+        smsc_length = binascii.unhexlify(hex_data[:2])[0]
+        first = binascii.unhexlify(hex_data[2 + 2 * smsc_length : 4 + 2 * smsc_length])[
+            0
+        ]
+    except (binascii.Error, IndexError, TypeError):
+        return False
+    return first & 0x03 == 0x02
+
+
+def decode_status_report(hex_data):
+    """
+    Decode a delivery report PDU
+
+    @param hex_data: the hex digits of the PDU, as a bytes-like object or an ASCII string
+    @return: a dictionary with the reference of the sent message, its recipient, the
+             date it was received by the service center, the date of the status and the
+             status value
+    @raise ValueError: if the PDU is invalid or not a status report
+    """
+    try:
+        data = binascii.unhexlify(hex_data)
+    except (binascii.Error, TypeError) as err:
+        raise ValueError("Invalid PDU hex digits: {}".format(err)) from err
+
+    try:
+        pos = data[0] + 1
+        if data[pos] & 0x03 != 0x02:
+            raise ValueError("Not an SMS-STATUS-REPORT PDU")
+        reference = data[pos + 1]
+        digits = data[pos + 2]
+        toa = data[pos + 3]
+        pos += 4
+        length = (digits + 1) // 2
+        address = memoryview(data)[pos : pos + length]
+        pos += length
+        if len(data) < pos + 15:
+            raise ValueError("Truncated PDU")
+        date = _decode_timestamp(data[pos : pos + 7])
+        discharge = _decode_timestamp(data[pos + 7 : pos + 14])
+        status = data[pos + 14]
+    except IndexError as err:
+        raise ValueError("Truncated PDU") from err
+
+    _load_maps()
+    return {
+        "reference": reference,
+        "recipient": _decode_address(address, digits, toa),
+        "date": date,
+        "discharge": discharge,
+        "status": status,
+    }
+
+
+class PduBuffer:
+    """
+    Preallocated buffer collecting the PDU hex digits from the lines read on the modem
+    """
+
+    def __init__(self, size=PDU_BUFFER_SIZE):
+        self._view = memoryview(bytearray(size))
+        self.length = 0
+
+    def clear(self):
+        self.length = 0
+
+    def append(self, line):
+        """
+        Add the content of a line, without its end of line characters
+        """
+        end = len(line)
+        while end and line[end - 1] in b"\r\n":
+            end -= 1
+        length = self.length + end
+        if length > len(self._view):
+            # Only happens with unexpected lines from the modem
+            grown = bytearray(max(length, 2 * len(self._view)))
+            grown[: self.length] = self._view[: self.length]
+            self._view = memoryview(grown)
+        self._view[self.length : length] = memoryview(line)[:end]
+        self.length = length
+
+    def data(self):
+        """
+        @return: a view on the collected hex digits, valid until the buffer changes
+        """
+        return self._view[: self.length]
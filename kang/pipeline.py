@@ -0,0 +1,502 @@
+"""
+Staged processing of the received SMS
+
+The messages go through three stages, each running in its own thread:
+ - the reader polls the modems and reads the new messages,
+ - the dispatcher checks the sender and runs the commands,
+ - the senders, one per modem, send the replies and delete the processed messages
+   from the modems.
+
+The stages are connected with bounded queues: a slow stage blocks the previous ones
+instead of piling up work. The accesses to each modem are serialized with its lock.
+
+With a journal, a message is only deleted from the modem once its replies are sent:
+messages still on the SIM after a crash are not executed again, only their replies
+are sent. The commands interrupted or failing while executing are not run again:
+their sender is asked to check the state first.
+"""
+
+import datetime
+import logging
+import queue
+import threading
+import time
+
+import kang.journal
+import kang.metrics
+import kang.modems
+import kang.sim
+
+log = logging.getLogger(__name__)
+
+# Time between two polls of the modem when no message was received
+POLL_INTERVAL = 15
+
+# Maximum number of items waiting between two stages
+QUEUE_SIZE = 10
+
+# Maximum number of processed messages waiting to be deleted from the modem
+DELETE_BATCH = 10
+
+# Maximum time between two polls of failing modems, in seconds
+MAX_POLL_BACKOFF = 60
+
+# Reply to the commands which may have been partially executed
+INTERRUPTED_MESSAGE = "Commande interrompue, vérifier l'état avant de la renvoyer: {}"
+
+
+class Stage(threading.Thread):
+    """
+    A pipeline stage processing the items of its input queue.
+
+    Errors are counted and reported per item without stopping the stage.
+    """
+
+    def __init__(self, name, process, inbox, outbox=None, on_error=None):
+        """
+        :param name: the name of the stage
+        :param process: function processing an item and returning an iterable of items
+                        for the next stage
+        :param inbox: the input queue
+        :param outbox: the output queue, None for the last stage
+        :param on_error: function called with the stage and the exception on errors
+        """
+        super().__init__(name="{} Stage".format(name.capitalize()), daemon=True)
+        self.stage_name = name
+        self.process = process
+        self.inbox = inbox
+        self.outbox = outbox
+        self.on_error = on_error
+        self.stopping = False
+        self.processed = 0
+        self.errors = 0
+        self.last_error = None
+        self.last_activity = time.monotonic()
+
+    def work(self):
+        """
+        Process one item from the input queue, if any
+
+        :return: the number of processed items
+        """
+        try:
+            item = self.inbox.get(timeout=0.5)
+        except queue.Empty:
+            return 0
+        try:
+            for result in self.process(item) or []:
+                self.put(result)
+        finally:
+            self.inbox.task_done()
+        return 1
+
+    def put(self, item):
+        """
+        Pass an item to the next stage, waiting for room in the queue
+        """
+        while not self.stopping:
+            try:
+                self.outbox.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def run(self):
+        while not self.stopping:
+            try:
+                self.processed += self.work()
+            except Exception as err:
+                self.errors += 1
+                self.last_error = "{}: {}".format(type(err).__name__, err)
+                log.exception("Error in the %s stage", self.stage_name)
+                if self.on_error:
+                    try:
+                        self.on_error(self, err)
+                    except Exception:
+                        log.exception(
+                            "Failed to report %s stage error", self.stage_name
+                        )
+            self.last_activity = time.monotonic()
+
+    def stop(self):
+        """
+        Request the stage to stop
+        """
+        self.stopping = True
+
+    def health(self):
+        """
+        :return: a dictionary describing the state of the stage
+        """
+        return {
+            "name": self.stage_name,
+            "alive": self.is_alive(),
+            "queue": self.inbox.qsize() if self.inbox else 0,
+            "processed": self.processed,
+            "errors": self.errors,
+            "last_error": self.last_error,
+            "idle": time.monotonic() - self.last_activity,
+        }
+
+
+class ReaderStage(Stage):
+    """
+    First stage polling the modems for the new messages
+
+    The messages are identified by their modem and index on that modem.
+    """
+
+    def __init__(self, pipeline, outbox, poll_interval, on_error=None):
+        super().__init__("reader", None, None, outbox, on_error)
+        self.pipeline = pipeline
+        self.poll_interval = poll_interval
+        # Messages read but not deleted yet, with the time they were read
+        self.in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        # Number of consecutive failed polls
+        self.failed_polls = 0
+
+    def done(self, message):
+        """
+        Mark a message as deleted from its modem
+        """
+        with self._in_flight_lock:
+            read = self.in_flight.pop(message, None)
+        if read is not None:
+            kang.metrics.observe("message_processing", time.monotonic() - read)
+
+    def work(self):
+        self.pipeline.process_status_reports()
+        count = 0
+        failures = []
+        for modem in self.pipeline.pool.readable():
+            if self.stopping:
+                break
+            try:
+                count += self._read(modem)
+            except Exception as err:
+                if len(self.pipeline.pool.modems) > 1:
+                    modem.failed(err)
+                failures.append((modem, err))
+
+        if not failures:
+            self.failed_polls = 0
+        else:
+            # Don't hammer a failing modem, poll it less and less often
+            self.failed_polls += 1
+            self.wait(
+                min(
+                    self.poll_interval * 2 ** (self.failed_polls - 1),
+                    MAX_POLL_BACKOFF,
+                )
+            )
+        if len(failures) == 1:
+            raise failures[0][1]
+        if failures:
+            raise RuntimeError(
+                "; ".join(
+                    "{}: {}: {}".format(modem.name, type(err).__name__, err)
+                    for modem, err in failures
+                )
+            )
+        if not count:
+            self.wait(self.poll_interval)
+        return count
+
+    def _read(self, modem):
+        """
+        Read the new messages of a modem
+
+        :return: the number of new messages
+        """
+        # The listing holds the messages PDUs: read them all with a single command
+        with self._in_flight_lock:
+            skip = {idx for other, idx in self.in_flight if other is modem}
+        with modem.lock:
+            messages = kang.sim.readAllSms(modem.sim, skip)
+        with self._in_flight_lock:
+            new_messages = [
+                ((modem, idx), sms)
+                for idx, sms in messages
+                if (modem, idx) not in self.in_flight
+            ]
+
+        invalid = []
+        for message, sms in new_messages:
+            if self.stopping:
+                break
+            with self._in_flight_lock:
+                self.in_flight[message] = time.monotonic()
+            if sms is None:
+                # Don't try to read an unreadable message again
+                self.pipeline.outbound.put(("delete", message))
+                invalid.append(message[1])
+                continue
+            if isinstance(sms, dict):
+                # Stored delivery report
+                self.pipeline.status_report(modem, sms)
+                self.pipeline.outbound.put(("delete", message))
+                continue
+            kang.metrics.increment("messages_received")
+            _observe_delivery(sms)
+
+            key = None
+            journal = self.pipeline.journal
+            if journal:
+                key = journal.key(sms)
+                state = journal.state(key)
+                if state in [kang.journal.REPLIED, kang.journal.FAILED]:
+                    log.info("Message %s already processed, deleting it", message[1])
+                    self.pipeline.outbound.put(("delete", message))
+                    continue
+                if state == kang.journal.EXECUTING:
+                    log.warning("Message %s interrupted while executing", message[1])
+                    journal.failed(key, retry=False)
+                    self.pipeline.outbound.put(("send", _interrupted_reply(sms)))
+                    self.pipeline.outbound.put(("delete", message))
+                    continue
+                if state == kang.journal.EXECUTED:
+                    log.info(
+                        "Message %s already executed, sending its replies", message[1]
+                    )
+                    replies = [
+                        kang.sim.Sms(number, text)
+                        for number, text in journal.replies(key)
+                    ]
+                    self.pipeline.outbound.put(("finish", message, key, replies))
+                    continue
+                journal.received(key, sms)
+            self.put((message, sms, key))
+
+        if invalid:
+            raise ValueError(
+                "Invalid PDU for messages {} on {}".format(
+                    ", ".join(invalid), modem.name
+                )
+            )
+        modem.succeeded()
+        return len(new_messages)
+
+    def wait(self, delay):
+        """
+        Sleep, but wake up early if the stage is stopped
+        """
+        deadline = time.monotonic() + delay
+        while not self.stopping and time.monotonic() < deadline:
+            time.sleep(min(0.5, deadline - time.monotonic()))
+
+
+def _interrupted_reply(sms):
+    """
+    @return: the SMS telling the sender that a command may have been partially executed
+    """
+    return kang.sim.Sms(sms.number, INTERRUPTED_MESSAGE.format(sms.message))
+
+
+def _observe_delivery(sms):
+    """
+    Record the time between the sending of a received message and its reading
+    """
+    date = getattr(sms, "date", None)
+    if isinstance(date, datetime.datetime) and date.tzinfo is not None:
+        delay = datetime.datetime.now(datetime.timezone.utc) - date
+        kang.metrics.observe("sms_delivery", max(0, delay.total_seconds()))
+
+
+class Pipeline:
+    """
+    Reader, dispatcher and sender stages processing the received commands
+    """
+
+    def __init__(
+        self,
+        modems,
+        authorize,
+        handle,
+        poll_interval=POLL_INTERVAL,
+        queue_size=QUEUE_SIZE,
+        on_error=None,
+        journal=None,
+        tracker=None,
+    ):
+        """
+        :param modems: the kang.modems.ModemPool, or the SIM serial handle of a single
+                       modem
+        :param authorize: function returning True if the number is allowed to send commands
+        :param handle: function running the command of an SMS and returning the replies
+        :param poll_interval: seconds between two polls of the modem when idle
+        :param queue_size: maximum number of items between two stages
+        :param on_error: function called with the stage and the exception on errors
+        :param journal: the kang.journal.Journal recording the messages processing
+        :param tracker: the kang.delivery.DeliveryTracker of the sent messages
+        """
+        if not isinstance(modems, kang.modems.ModemPool):
+            modems = kang.modems.ModemPool([kang.modems.Modem(modems)])
+        self.pool = modems
+        # The main modem, also used outside of the pipeline
+        self.sim = modems.modems[0].sim
+        self.modem_lock = modems.modems[0].lock
+        self.journal = journal
+        self.tracker = tracker
+        # Messages waiting to be deleted, shared by the senders
+        self._deletes = []
+        self._deletes_lock = threading.Lock()
+        self.authorize = authorize
+        self.handle = handle
+        self.commands = queue.Queue(queue_size)
+        self.outbound = queue.Queue(queue_size)
+        self.reader = ReaderStage(self, self.commands, poll_interval, on_error)
+        self.dispatcher = Stage(
+            "dispatcher", self._dispatch, self.commands, self.outbound, on_error
+        )
+        # One sender per modem: a modem waiting for the network doesn't block the others
+        self.senders = [
+            Stage(
+                "sender" if i == 0 else "sender {}".format(i + 1),
+                self._send,
+                self.outbound,
+                None,
+                on_error,
+            )
+            for i in range(len(modems.modems))
+        ]
+        self.sender = self.senders[0]
+        self.stages = [self.reader, self.dispatcher] + self.senders
+
+    def _dispatch(self, item):
+        message, sms, key = item
+        replies = []
+        try:
+            authorized = self.authorize(sms.number)
+        except Exception:
+            if self.journal and self.journal.failed(key):
+                # Nothing ran yet: leave the message on the modem to try again
+                self.reader.done(message)
+            else:
+                # Remove the message to avoid processing it forever
+                self.dispatcher.put(("delete", message))
+            raise
+
+        if authorized:
+            if self.journal:
+                self.journal.executing(key)
+            try:
+                replies = list(self.handle(sms))
+            except Exception:
+                # The relays may have been switched already: don't run it again
+                if self.journal:
+                    self.journal.failed(key, retry=False)
+                    self.dispatcher.put(("send", _interrupted_reply(sms)))
+                self.dispatcher.put(("delete", message))
+                raise
+        else:
+            # The authorize function logs the reason
+            log.debug("Ignoring message from %s", sms.number)
+        if self.journal:
+            self.journal.executed(key, replies)
+        return [("finish", message, key, replies)]
+
+    def _send(self, item):
+        action = item[0]
+        if action == "send":
+            self._track(self.pool.send(item[1]), item[1])
+        elif action == "finish":
+            _, message, key, replies = item
+            try:
+                for reply in replies:
+                    try:
+                        self._track(self.pool.send(reply), reply)
+                    except kang.sim.CmsError as err:
+                        log.error("Failed to send SMS to %s: %s", reply.number, err)
+            except Exception:
+                # Keep the message to send the replies again at the next poll
+                self.reader.done(message)
+                raise
+            if self.journal:
+                self.journal.replied(key)
+            with self._deletes_lock:
+                self._deletes.append(message)
+        elif action == "delete":
+            with self._deletes_lock:
+                self._deletes.append(item[1])
+
+        if self.outbound.empty() or len(self._deletes) >= DELETE_BATCH:
+            self._flush_deletes()
+
+    def _track(self, modem, sms):
+        if self.tracker:
+            self.tracker.sent(modem.name, sms)
+
+    def status_report(self, modem, report):
+        """
+        Record a delivery report received by a modem
+        """
+        state = None
+        if self.tracker:
+            state = self.tracker.report(modem.name, report)
+        log.info(
+            "Delivery report for message %s to %s on %s: %s",
+            report["reference"],
+            report["recipient"],
+            modem.name,
+            state or "untracked",
+        )
+
+    def process_status_reports(self):
+        """
+        Record the delivery reports received as unsolicited results
+        """
+        while kang.sim.status_reports:
+            sim, report = kang.sim.status_reports.popleft()
+            for modem in self.pool.modems:
+                if modem.sim is sim:
+                    self.status_report(modem, report)
+
+    def _flush_deletes(self):
+        """
+        Delete the processed messages from their modems
+        """
+        while True:
+            with self._deletes_lock:
+                if not self._deletes:
+                    return
+                message = self._deletes.pop(0)
+            modem, idx = message
+            try:
+                with modem.lock:
+                    kang.sim.Sms.delete(modem.sim, idx)
+            finally:
+                self.reader.done(message)
+
+    def send(self, sms):
+        """
+        Queue an SMS to send without waiting
+
+        :return: False if the outbound queue is full
+        """
+        try:
+            self.outbound.put_nowait(("send", sms))
+        except queue.Full:
+            log.error("Outbound queue full, dropping SMS to %s", sms.number)
+            return False
+        return True
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self):
+        """
+        Stop all the stages and wait for them
+        """
+        for stage in self.stages:
+            stage.stop()
+        for stage in self.stages:
+            if stage.ident is not None:
+                stage.join()
+
+    def health(self):
+        """
+        :return: the list of the stages health dictionaries
+        """
+        return [stage.health() for stage in self.stages]
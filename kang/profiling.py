@@ -0,0 +1,232 @@
+"""
+Opt-in profiling of the running daemon
+
+When enabled, a SIGUSR1 triggers:
+ - a CPU profile of all the threads, sampled for a bounded window,
+ - a tracemalloc snapshot compared with the one taken at startup.
+Memory snapshots can also be taken at regular intervals.
+
+The reports are written as text files to the profiling directory. Nothing is running
+and tracemalloc is not started while profiling is disabled.
+"""
+
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+log = logging.getLogger(__name__)
+
+# Default duration of the CPU sampling, in seconds
+CPU_WINDOW = 30
+
+# Default time between two stack samples, in seconds
+SAMPLE_INTERVAL = 0.01
+
+# Number of lines of the reports
+TOP = 30
+
+
+class Sampler(threading.Thread):
+    """
+    Sample the stacks of all the threads for a bounded time.
+
+    Unlike cProfile, which only traces the thread enabling it, this sees the scheduler
+    and pipeline threads as well, with an overhead bounded by the sampling interval.
+    """
+
+    def __init__(self, window, interval=SAMPLE_INTERVAL, on_done=None):
+        """
+        :param window: duration of the sampling in seconds
+        :param interval: time between two samples in seconds
+        :param on_done: function called with the sampler once the window is over
+        """
+        super().__init__(name="Profiling Thread", daemon=True)
+        self.window = window
+        self.interval = interval
+        self.on_done = on_done
+        self.samples = 0
+        # Number of samples where the function is running, or in the stack
+        self.own = collections.Counter()
+        self.cumulative = collections.Counter()
+        self.threads = collections.Counter()
+        self._stopping = threading.Event()
+
+    def run(self):
+        me = threading.get_ident()
+        deadline = time.monotonic() + self.window
+        while time.monotonic() < deadline and not self._stopping.is_set():
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                self.threads[names.get(ident, ident)] += 1
+                self.own[_location(frame)] += 1
+                seen = set()
+                while frame is not None:
+                    location = _location(frame)
+                    if location not in seen:
+                        seen.add(location)
+                        self.cumulative[location] += 1
+                    frame = frame.f_back
+            self.samples += 1
+            self._stopping.wait(self.interval)
+        if self.on_done:
+            self.on_done(self)
+
+    def stop(self):
+        self._stopping.set()
+
+    def report(self):
+        """
+        :return: the text report of the samples
+        """
+        lines = [
+            "{} samples every {}s".format(self.samples, self.interval),
+            "",
+            "Threads:",
+        ]
+        lines.extend(
+            "{:>8} {}".format(count, name) for name, count in self.threads.most_common()
+        )
+        lines.extend(["", "{:>8} {:>8}  function".format("own", "cumul.")])
+        for location, count in self.own.most_common(TOP):
+            lines.append(
+                "{:>8} {:>8}  {}".format(count, self.cumulative[location], location)
+            )
+        lines.extend(["", "{:>8}  function".format("cumul.")])
+        for location, count in self.cumulative.most_common(TOP):
+            lines.append("{:>8}  {}".format(count, location))
+        return "\n".join(lines) + "\n"
+
+
+def _location(frame):
+    code = frame.f_code
+    return "{} ({}:{})".format(code.co_name, code.co_filename, code.co_firstlineno)
+
+
+class Profiler:
+    """
+    CPU and memory profiling triggered on demand
+    """
+
+    def __init__(
+        self,
+        directory,
+        cpu_window=CPU_WINDOW,
+        memory=True,
+        memory_frames=10,
+        snapshot_interval=None,
+    ):
+        """
+        :param directory: where to write the reports
+        :param cpu_window: duration of the CPU sampling in seconds, 0 to disable it
+        :param memory: True to trace the memory allocations
+        :param memory_frames: number of frames stored per allocation
+        :param snapshot_interval: seconds between two memory reports, None to only
+                                  write them on demand
+        """
+        self.directory = directory
+        self.cpu_window = cpu_window
+        self.memory = memory
+        self.snapshot_interval = snapshot_interval if memory else None
+        self._sampler = None
+        self._baseline = None
+        if memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(memory_frames)
+            self._baseline = tracemalloc.take_snapshot()
+
+    @classmethod
+    def from_config(cls, config, environ=os.environ):
+        """
+        Create a profiler from the kang.json profiling section, or the
+        KANG_PROFILE_DIR environment variable.
+
+        :return: the profiler, None if profiling is disabled
+        """
+        config = dict(config or {})
+        if environ.get("KANG_PROFILE_DIR"):
+            config.setdefault("dir", environ["KANG_PROFILE_DIR"])
+        if not config.get("dir"):
+            return None
+        return cls(
+            config["dir"],
+            cpu_window=config.get("cpu_window", CPU_WINDOW),
+            memory=config.get("memory", True),
+            memory_frames=config.get("memory_frames", 10),
+            snapshot_interval=config.get("snapshot_interval"),
+        )
+
+    def _path(self, kind):
+        return os.path.join(
+            self.directory,
+            "{}-{}.txt".format(kind, time.strftime("%Y%m%d-%H%M%S")),
+        )
+
+    def _write(self, kind, text):
+        path = self._path(kind)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path, "w") as fd:
+                fd.write(text)
+        except OSError as err:
+            log.error("Failed to write the %s profile: %s", kind, err)
+            return None
+        log.warning("Wrote %s profile to %s", kind, path)
+        return path
+
+    def start_cpu(self):
+        """
+        Start sampling the CPU usage, the report is written once the window is over
+
+        :return: False if a sampling is already running
+        """
+        if not self.cpu_window:
+            return False
+        if self._sampler is not None and self._sampler.is_alive():
+            log.warning("CPU profiling already running")
+            return False
+        self._sampler = Sampler(
+            self.cpu_window,
+            on_done=lambda sampler: self._write("cpu", sampler.report()),
+        )
+        self._sampler.start()
+        return True
+
+    def dump_memory(self):
+        """
+        Write the biggest allocations and their growth since the profiler started
+
+        :return: the path of the report, None if memory tracing is disabled
+        """
+        if not self.memory:
+            return None
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+        current, peak = tracemalloc.get_traced_memory()
+        lines = ["Traced memory: {} B, peak {} B".format(current, peak), "", "Growth:"]
+        lines.extend(
+            str(stat) for stat in snapshot.compare_to(self._baseline, "lineno")[:TOP]
+        )
+        lines.extend(["", "Biggest:"])
+        lines.extend(str(stat) for stat in snapshot.statistics("lineno")[:TOP])
+        return self._write("memory", "\n".join(lines) + "\n")
+
+    def dump(self):
+        """
+        Write the memory report and start a CPU sampling window
+        """
+        self.dump_memory()
+        self.start_cpu()
+
+    def stop(self):
+        if self._sampler is not None:
+            self._sampler.stop()
+            self._sampler.join()
+        if self.memory:
+            tracemalloc.stop()
@@ -1,52 +1,482 @@
+import concurrent.futures
+import contextlib
+import json
 import logging
-import RPi.GPIO as GPIO
+import os.path
+import threading
 import time
 
+import kang.gpio
+import kang.metrics
+
 CHURCH = 22  # ON: 22, OFF: 23
 HALL = 24  # ON: 24, OFF: 25
 
-_PLACES = [CHURCH, HALL]
+# Duration of the low state of the pins to switch a relay
+PULSE_WIDTH = 0.2
+
+# Time to wait for other pulse requests to pulse them at the same time
+BATCH_WINDOW = 0.01
 
 log = logging.getLogger(__name__)
 
 
-def setup():
+class Place:
+    """
+    A place with its heating relay.
+
+    The place is identified by its ON pin number, which is the value passed to start()
+    and stop() and persisted in the scheduled events.
+    """
+
+    def __init__(self, name, on_pin, off_pin=None, aliases=(), pulse_width=None):
+        """
+        @param name: the user-readable name of the place, like "l'église"
+        @param on_pin: the pin starting the heating
+        @param off_pin: the pin stopping the heating, on_pin + 1 if None
+        @param aliases: other names the users can use for the place
+        @param pulse_width: duration of the pulses in seconds, the driver default if None
+        """
+        self.name = name
+        self.on_pin = on_pin
+        self.off_pin = off_pin if off_pin is not None else on_pin + 1
+        self.aliases = list(aliases)
+        self.pulse_width = pulse_width
+
+    @property
+    def id(self):
+        return self.on_pin
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create a place from its kang.json definition
+        """
+        return cls(
+            config["name"],
+            int(config["on_pin"]),
+            config.get("off_pin"),
+            config.get("aliases", []),
+            config.get("pulse_width"),
+        )
+
+
+DEFAULT_PLACES = [
+    Place("l'église", CHURCH, aliases=["l'eglise", "eglise", "église"]),
+    Place("le hall", HALL, aliases=["hall"]),
+]
+
+
+class PulseDriver:
+    """
+    Pulse the relays pins from a background thread.
+
+    The requests made at the same time are grouped to pulse all their pins together,
+    except if they would switch the same place on and off.
+    """
+
+    def __init__(self, width=PULSE_WIDTH, window=BATCH_WINDOW):
+        """
+        :param width: duration of the pulses in seconds
+        :param window: time to wait for more requests before pulsing
+        """
+        self.width = width
+        self.window = window
+        self._condition = threading.Condition()
+        self._pending = []
+        self._thread = None
+        self._stopping = False
+        # Held while pulsing
+        self._pulsing = threading.Lock()
+
+    def pulse(self, pins, width=None):
+        """
+        Request a pulse on the pins
+
+        :param pins: list of the pins to pulse
+        :param width: duration of the pulse, the driver's width if None
+        :return: a Future resolved once the pins are released
+        """
+        future = concurrent.futures.Future()
+        with self._condition:
+            self._pending.append((list(pins), width or self.width, future))
+            if self._thread is None:
+                self._stopping = False
+                self._thread = threading.Thread(
+                    target=self._run, name="Relays Thread", daemon=True
+                )
+                self._thread.start()
+            self._condition.notify()
+        return future
+
+    def stop(self):
+        """
+        Stop the background thread once the pending pulses are done
+        """
+        with self._condition:
+            thread = self._thread
+            self._stopping = True
+            self._condition.notify()
+        if thread:
+            thread.join()
+
+    @contextlib.contextmanager
+    def paused(self):
+        """
+        Context manager waiting for the current pulse and delaying the next ones
+        """
+        with self._pulsing:
+            yield
+
+    def _next_batch(self):
+        """
+        Take the pending requests that can be pulsed together
+        """
+        batch = []
+        places = {}
+        remaining = []
+        for request in self._pending:
+            pins = request[0]
+            conflict = any(places.get(_pin_places.get(pin), pin) != pin for pin in pins)
+            if conflict or remaining:
+                # Keep the requests order for the next pulses
+                remaining.append(request)
+                continue
+            for pin in pins:
+                places[_pin_places.get(pin)] = pin
+            batch.append(request)
+        self._pending = remaining
+        return batch
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopping:
+                    self._condition.wait()
+                if not self._pending:
+                    # Let the next pulse() start a new thread
+                    self._thread = None
+                    self._stopping = False
+                    return
+            time.sleep(self.window)
+            with self._pulsing:
+                self._pulse()
+
+    def _pulse(self):
+        """
+        Pulse the pins of the next batch of requests
+        """
+        with self._condition:
+            batch = self._next_batch()
+
+        # Pull all the pins low at once, then release them in groups of equal width
+        widths = {}
+        for pins, width, _ in batch:
+            for pin in pins:
+                widths[pin] = max(width, widths.get(pin, 0))
+        pins = sorted(widths)
+        start = time.monotonic()
+        try:
+            backend = _get_backend()
+            backend.output(pins, False)
+            elapsed = 0
+            for width in sorted(set(widths.values())):
+                time.sleep(width - elapsed)
+                elapsed = width
+                backend.output([pin for pin in pins if widths[pin] == width], True)
+        except Exception as err:
+            log.exception("Failed to pulse pins %s", pins)
+            for _, _, future in batch:
+                future.set_exception(err)
+        else:
+            kang.metrics.observe("relay_pulse", time.monotonic() - start)
+            kang.metrics.increment("relay_pulses")
+            for _, _, future in batch:
+                future.set_result(pins)
+
+
+_driver = PulseDriver()
+
+# Configured places, indexed by their identifier
+_places = {}
+# Map of the pins to the identifier of the place they switch
+_pin_places = {}
+
+# GPIO backend, set by setup()
+_backend = None
+
+# Known state of the places: place -> {"on": bool, "since": timestamp}
+# A place with unknown state has no entry.
+_state = {}
+_state_path = None
+_state_lock = threading.Lock()
+
+
+def set_driver(driver):
+    """
+    Replace the pulse driver, for instance to use shorter pulses in simulations
+
+    @param driver: the new PulseDriver
+    @return: the previous PulseDriver
+    """
+    global _driver
+    previous = _driver
+    _driver = driver
+    return previous
+
+
+def set_backend(backend):
+    """
+    Replace the GPIO backend, without setting its pins up
+
+    @param backend: the new kang.gpio backend, None to use RPi.GPIO
+    @return: the previous backend
+    """
+    global _backend
+    previous = _backend
+    _backend = backend
+    return previous
+
+
+def set_places(places):
+    """
+    Configure the places handled by the relay board. Call before setup().
+
+    @param places: list of Place objects
+    """
+    _places.clear()
+    _pin_places.clear()
+    for place in places:
+        _places[place.id] = place
+        _pin_places[place.on_pin] = place.id
+        _pin_places[place.off_pin] = place.id
+
+
+def places():
+    """
+    @return: the list of the configured places
+    """
+    return list(_places.values())
+
+
+def get_place(place):
+    """
+    @param place: the place identifier
+    @return: the Place object
+    """
+    return _places[place]
+
+
+set_places(DEFAULT_PLACES)
+
+
+def load_state(path):
+    """
+    Load the persisted state of the places
+
+    @param path: the file where the state is persisted
+    """
+    global _state_path
+    with _state_lock:
+        _state_path = path
+        _state.clear()
+        if os.path.isfile(path):
+            try:
+                with open(path, "r") as fd:
+                    data = json.load(fd)
+                _state.update(
+                    {
+                        int(place): value
+                        for place, value in data.items()
+                        if int(place) in _places
+                    }
+                )
+            except (ValueError, OSError):
+                log.exception("Failed to load the relays state from %s", path)
+
+
+def set_state(state, path=None):
+    """
+    Replace the known state of the places, for instance to simulate them
+
+    @param state: the place -> {"on": bool, "since": timestamp} dict
+    @param path: the file where the state is persisted, None to keep it in memory
+    @return: the previous (state, path) tuple
+    """
+    global _state_path
+    with _state_lock:
+        previous = (
+            {place: dict(value) for place, value in _state.items()},
+            _state_path,
+        )
+        _state.clear()
+        _state.update(state)
+        _state_path = path
+    return previous
+
+
+def _save_state():
+    """
+    Persist the state of the places, must be called with the state lock
+    """
+    if not _state_path:
+        return
+    with open(_state_path, "w") as fd:
+        json.dump({str(place): value for place, value in _state.items()}, fd)
+
+
+def state():
+    """
+    @return: the known state of the places as a place -> {"on": bool, "since": timestamp} dict.
+             Places with unknown state are not in the dict.
+    """
+    with _state_lock:
+        return {place: dict(value) for place, value in _state.items()}
+
+
+def _switch(places, on, pins, force):
+    """
+    Pulse the pins of the places that need to change state and record the new state
+
+    @param places: the places to switch
+    @param on: the new state of the places
+    @param pins: function returning the pin to pulse for a place
+    @param force: pulse even if the places are already in the requested state
+    @return: a Future resolved once the relays are switched
+    @raise ValueError: if none of the places is known
+    """
+    unknown = [place for place in places if place not in _places]
+    if unknown:
+        # The place may have been removed from the configuration after scheduling
+        log.warning("Skipping unknown places: %s", unknown)
+        places = [place for place in places if place in _places]
+        if not places:
+            raise ValueError("Unknown places: {}".format(unknown))
+    with _state_lock:
+        if not force:
+            places = [
+                place for place in places if _state.get(place, {}).get("on") is not on
+            ]
+        if not places:
+            future = concurrent.futures.Future()
+            future.set_result([])
+            return future
+
+        log.info(
+            "%s: %s",
+            "start" if on else "stop",
+            ", ".join(_places[place].name for place in places),
+        )
+        now = time.time()
+        for place in places:
+            _state[place] = {"on": on, "since": now}
+        _save_state()
+
+    # Group the places by pulse width, usually all of them have the same
+    requested = time.monotonic()
+    widths = {}
+    for place in places:
+        widths.setdefault(_places[place].pulse_width, []).append(pins(place))
+    futures = [_driver.pulse(width_pins, width) for width, width_pins in widths.items()]
+    future = futures[0] if len(futures) == 1 else _gather(futures)
+    future.add_done_callback(lambda done: _forget_on_failure(done, places))
+    future.add_done_callback(
+        lambda done: kang.metrics.observe("relay_switch", time.monotonic() - requested)
+    )
+    return future
+
+
+def _gather(futures):
+    """
+    @return: a Future resolved when all the futures are
+    """
+    result = concurrent.futures.Future()
+
+    def _done(_):
+        if all(future.done() for future in futures) and not result.done():
+            errors = [future.exception() for future in futures if future.exception()]
+            if errors:
+                result.set_exception(errors[0])
+            else:
+                result.set_result(sorted(pin for f in futures for pin in f.result()))
+
+    for future in futures:
+        future.add_done_callback(_done)
+    return result
+
+
+def _forget_on_failure(future, places):
+    """
+    Mark the state of the places as unknown if the pulse failed
+    """
+    if future.exception() is None:
+        return
+    with _state_lock:
+        for place in places:
+            _state.pop(place, None)
+        _save_state()
+
+
+def _get_backend():
+    """
+    @return: the GPIO backend, an RPi.GPIO one if setup() wasn't called
+    """
+    global _backend
+    if _backend is None:
+        _backend = kang.gpio.get_backend("rpi")
+    return _backend
+
+
+def setup(backend=None):
     """
     Initiliaze the GPIO pins for the relay board
+
+    @param backend: the kang.gpio backend to use, RPi.GPIO if None
+    """
+    global _backend
+    if backend is not None:
+        _backend = backend
+    _get_backend().setup(sorted(_pin_places))
+
+
+def reconfigure(places):
+    """
+    Change the places while running, the pins are set up again between two pulses
+
+    @param places: list of Place objects
     """
-    GPIO.setmode(GPIO.BCM)
-    for pin in [CHURCH, CHURCH + 1, HALL, HALL + 1]:
-        GPIO.setup(pin, GPIO.OUT, initial=GPIO.HIGH)
+    with _driver.paused():
+        set_places(places)
+        setup()
 
 
 def clean():
     """
     Reset the GPIO pins
     """
-    GPIO.cleanup()
+    _driver.stop()
+    _get_backend().cleanup()
 
 
-def start(place):
+def start(*places, force=False):
     """
-    Start the heating
-    @param place: place to start the heating in. Value is one of CHURCH or HALL
+    Start the heating, all places are switched with a single pulse.
+    Places known to be already started are skipped unless force is set.
+
+    @param places: identifiers of the places to start the heating in
+    @param force: pulse the relays even if the heating is already started
+    @return: a Future resolved once the relays are switched
     """
-    if place not in _PLACES:
-        raise ValueError
-    log.info("start: %s", "Church" if place == CHURCH else "Hall")
-    GPIO.output(place, GPIO.LOW)
-    time.sleep(0.2)
-    GPIO.output(place, GPIO.HIGH)
+    return _switch(places, True, lambda place: _places[place].on_pin, force)
 
 
-def stop(place):
+def stop(*places, force=False):
     """
-    Stop the heating
-    @param place: place to stop the heating in. Value is one of CHURCH or HALL
+    Stop the heating, all places are switched with a single pulse.
+    Places known to be already stopped are skipped unless force is set.
+
+    @param places: identifiers of the places to stop the heating in
+    @param force: pulse the relays even if the heating is already stopped
+    @return: a Future resolved once the relays are switched
     """
-    if place not in _PLACES:
-        raise ValueError
-    log.info("stop: %s", "Church" if place == CHURCH else "Hall")
-    GPIO.output(place + 1, GPIO.LOW)
-    time.sleep(0.2)
-    GPIO.output(place + 1, GPIO.HIGH)
+    return _switch(places, False, lambda place: _places[place].off_pin, force)
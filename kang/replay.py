@@ -0,0 +1,287 @@
+"""
+Replay recorded SMS traffic offline
+
+The messages of a JSONL file are processed like received SMS, with a simulated modem,
+mock relays and a virtual clock, as fast as possible. The scheduled events due between
+two messages are run when the virtual clock reaches them.
+
+Each line of the file is a JSON object with the text of the message in its message,
+text or body property. The optional number, sender or from property gives the sender,
+and date, time or timestamp gives when the message was received, as an ISO 8601
+string or a UNIX timestamp.
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import logging
+import os.path
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import kang.clock
+import kang.emulator
+import kang.gpio
+import kang.kang
+import kang.relays
+import kang.scheduler
+import kang.sim
+
+log = logging.getLogger(__name__)
+
+TEXT_KEYS = ("message", "text", "body")
+NUMBER_KEYS = ("number", "sender", "from")
+DATE_KEYS = ("date", "time", "timestamp")
+
+# Sender of the messages without one
+DEFAULT_NUMBER = "+33600000000"
+
+# Time between two messages without date, in seconds
+INTERVAL = 60
+
+
+def _parse_date(value):
+    """
+    @return: the timestamp of an ISO 8601 date or a UNIX timestamp
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def load_messages(path, interval=INTERVAL, start=None):
+    """
+    Read the messages to replay
+
+    @param path: the JSONL file
+    @param interval: seconds between two messages without date
+    @param start: timestamp of the first message without date, the current time if None
+    @return: the list of (timestamp, Sms) tuples, sorted by time
+    """
+    messages = []
+    when = time.time() if start is None else start
+    with open(path, "r") as fd:
+        for line_number, line in enumerate(fd, start=1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            text = next((record[key] for key in TEXT_KEYS if key in record), None)
+            if text is None:
+                log.warning("No message text on line %s, skipping it", line_number)
+                continue
+            number = next(
+                (record[key] for key in NUMBER_KEYS if key in record), DEFAULT_NUMBER
+            )
+            date = next((record[key] for key in DATE_KEYS if key in record), None)
+            when = _parse_date(date) if date is not None else when + interval
+            sms = kang.sim.Sms(
+                number, text, datetime.datetime.fromtimestamp(when).astimezone()
+            )
+            messages.append((when, sms))
+    messages.sort(key=lambda message: message[0])
+    return messages
+
+
+class Report:
+    """
+    Measures of a replay
+    """
+
+    def __init__(self):
+        self.messages = 0
+        self.errors = 0
+        self.wall_time = 0.0
+        self.simulated_time = 0.0
+        self.sms = 0
+        self.segments = 0
+        self.pulses = 0
+        self.scheduled = 0
+        # Processing times per command function name
+        self.latencies = collections.defaultdict(list)
+
+    def to_dict(self):
+        return {
+            "messages": self.messages,
+            "errors": self.errors,
+            "wall_time": self.wall_time,
+            "simulated_time": self.simulated_time,
+            "throughput": self.messages / self.wall_time if self.wall_time else None,
+            "sms": self.sms,
+            "segments": self.segments,
+            "pulses": self.pulses,
+            "scheduled": self.scheduled,
+            "commands": {
+                name: {
+                    "count": len(times),
+                    "mean": statistics.mean(times),
+                    "median": statistics.median(times),
+                    "p95": _percentile(times, 0.95),
+                    "max": max(times),
+                }
+                for name, times in sorted(self.latencies.items())
+            },
+        }
+
+    def format(self):
+        data = self.to_dict()
+        lines = [
+            "Messages: {} in {:.3f}s ({:.1f} msg/s), {} errors".format(
+                self.messages, self.wall_time, data["throughput"] or 0, self.errors
+            ),
+            "Simulated time: {:.1f}h ({:.0f}x real time)".format(
+                self.simulated_time / 3600,
+                self.simulated_time / self.wall_time if self.wall_time else 0,
+            ),
+            "",
+            "{:<24} {:>6} {:>10} {:>10} {:>10} {:>10}".format(
+                "Command", "count", "mean ms", "p50 ms", "p95 ms", "max ms"
+            ),
+        ]
+        for name, stats in data["commands"].items():
+            lines.append(
+                "{:<24} {:>6} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+                    name,
+                    stats["count"],
+                    stats["mean"] * 1000,
+                    stats["median"] * 1000,
+                    stats["p95"] * 1000,
+                    stats["max"] * 1000,
+                )
+            )
+        lines.extend(
+            [
+                "",
+                "Relay pulses: {}".format(self.pulses),
+                "SMS sent: {} ({} segments)".format(self.sms, self.segments),
+                "Events still scheduled: {}".format(self.scheduled),
+            ]
+        )
+        return "\n".join(lines)
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Replay:
+    """
+    Simulated environment to process the messages in.
+
+    The kang.kang scheduler and authorized numbers file are replaced by temporary ones
+    while replaying, and the relays by simulated ones, so the files and the relays of a
+    running system are never modified.
+    """
+
+    def __init__(self, authorized=None):
+        """
+        @param authorized: authorized numbers file to copy, for the commands changing it
+        """
+        self.authorized = authorized
+
+    def run(self, messages):
+        """
+        @param messages: list of (timestamp, Sms) tuples sorted by time
+        @return: the Report of the replay
+        """
+        report = Report()
+        if not messages:
+            return report
+
+        workdir = tempfile.mkdtemp(prefix="kang-replay-")
+        auth_file = os.path.join(workdir, "authorized.txt")
+        if self.authorized:
+            shutil.copy(self.authorized, auth_file)
+        else:
+            open(auth_file, "w").close()
+
+        clock = kang.clock.SimulatedClock(messages[0][0])
+        scheduler_thread = kang.scheduler.SchedulerThread(
+            os.path.join(workdir, "events.txt"),
+            [kang.relays.start, kang.relays.stop],
+            clock,
+        )
+        modem = kang.emulator.FakeModem()
+        backend = kang.gpio.MockBackend()
+        driver = kang.relays.PulseDriver(width=0, window=0)
+
+        saved = (kang.kang.clock, kang.kang.scheduler_thread, kang.kang.AUTH_FILE)
+        kang.kang.clock = clock
+        kang.kang.scheduler_thread = scheduler_thread
+        kang.kang.AUTH_FILE = auth_file
+        previous_driver = kang.relays.set_driver(driver)
+        previous_backend = kang.relays.set_backend(backend)
+        kang.relays.setup()
+        previous_state = kang.relays.set_state({})
+        try:
+            start = time.perf_counter()
+            for when, sms in messages:
+                scheduler_thread.run_until(when)
+                self._process(sms, modem, report)
+            report.wall_time = time.perf_counter() - start
+            driver.stop()
+        finally:
+            kang.kang.clock, kang.kang.scheduler_thread, kang.kang.AUTH_FILE = saved
+            kang.relays.set_driver(previous_driver)
+            kang.relays.set_backend(previous_backend)
+            kang.relays.set_state(*previous_state)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        report.messages = len(messages)
+        report.simulated_time = messages[-1][0] - messages[0][0]
+        report.segments = len(modem.segments)
+        report.pulses = len(backend.pulses())
+        report.scheduled = len(scheduler_thread.scheduler.queue)
+        return report
+
+    def _process(self, sms, modem, report):
+        cmd, _ = kang.kang.match_command(sms.message)
+        name = cmd["fn"] if cmd else "unknown"
+        start = time.perf_counter()
+        try:
+            # Same as kang.kang.process_command, counting the replies
+            for reply in kang.kang.handle_command(sms):
+                reply.send(modem)
+                report.sms += 1
+        except Exception:
+            report.errors += 1
+            log.exception("Failed to process %r", sms.message)
+        report.latencies[name].append(time.perf_counter() - start)
+
+
+def main(argv=None):
+    """
+    @param argv: the command line arguments, sys.argv if None
+    """
+    parser = argparse.ArgumentParser(
+        prog="kang-replay", description="Replay recorded SMS traffic offline"
+    )
+    parser.add_argument("path", help="JSONL file of the messages to replay")
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=INTERVAL,
+        help="seconds between two messages without date",
+    )
+    parser.add_argument(
+        "--authorized", help="authorized numbers file to use for the admin commands"
+    )
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format="%(levelname)s:%(message)s", level=logging.ERROR)
+    messages = load_messages(args.path, args.interval)
+    report = Replay(args.authorized).run(messages)
+    if args.json:
+        print(json.dumps(report.to_dict(), indent=2))
+    else:
+        print(report.format())
+    sys.exit(1 if report.errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,76 @@
+import bisect
 import json
+import logging
 import os.path
 import sched
 import threading
-import time
-from collections import namedtuple
 
+import kang.clock
 
-def _persisted_action(action, argument, kwargs, saver):
-    action(*argument, **kwargs)
-    saver()
+log = logging.getLogger(__name__)
+
+# What to do with the events that became past due while the system was off:
+#  - replay: run all of them, in order
+#  - coalesce: only run the last one of each action arguments
+#  - skip: drop all of them
+CATCH_UP_POLICIES = ["replay", "coalesce", "skip"]
+
+
+def _watch(event, result):
+    """
+    Log the failure of an action returning a Future, like the relays switches
+
+    @param event: the event which ran the action
+    @param result: the value returned by the action
+    """
+    if not hasattr(result, "add_done_callback"):
+        return
+
+    def _done(future):
+        err = future.exception()
+        if err is not None:
+            log.error("Event %s failed: %s: %s", event, type(err).__name__, err)
+
+    result.add_done_callback(_done)
+
+
+class Event:
+    """
+    A scheduled event as stored by the persisted scheduler.
+    """
+
+    __slots__ = ("time", "priority", "action", "argument", "kwargs")
+
+    def __init__(self, time, priority, action, argument=(), kwargs=None):
+        self.time = time
+        self.priority = priority
+        self.action = action
+        self.argument = tuple(argument)
+        self.kwargs = kwargs if kwargs is not None else {}
+
+    def matches(self, time, action, argument=(), kwargs={}):
+        """
+        :return: True if the event has the given time, action and arguments
+        """
+        return (
+            self.time == time
+            and self.action == action
+            and self.argument == tuple(argument)
+            and self.kwargs == kwargs
+        )
+
+    def __repr__(self):
+        return "Event(time={}, priority={}, action={}, argument={}, kwargs={})".format(
+            self.time,
+            self.priority,
+            getattr(self.action, "__name__", self.action),
+            self.argument,
+            self.kwargs,
+        )
 
 
 class PersistedScheduler(sched.scheduler):
-    def __init__(self, path, functions):
+    def __init__(self, path, functions, clock=None):
         """
         Create a new persisted scheduler instance.
 
@@ -21,13 +79,23 @@ class PersistedScheduler(sched.scheduler):
 
         :param path: the path to the file where the events queue is persisted.
         :param functions: list of functions to be used as actions
+        :param clock: the kang.clock clock to use, the system one if None
         """
-        sched.scheduler.__init__(self, time.time, time.sleep)
+        self.clock = clock or kang.clock.SystemClock()
+        sched.scheduler.__init__(self, self.clock.time, self.clock.sleep)
         func_map = {func.__name__: func for func in functions}
-        self.path = path
+        # Map of the queued events to their entry in the sched queue
+        self._entries = {}
+        # The events snapshot is only rebuilt when the version changes
+        self._version = 0
+        self._snapshot = ()
+        # Sorted (time, priority, sequence) keys of the snapshot events, used as index
+        self._keys = ()
+        self._snapshot_version = 0
+        self.path = None
         if os.path.isfile(path):
             # Load the persisted events
-            with open(self.path, "r") as fd:
+            with open(path, "r") as fd:
                 events = [line.strip().split(",") for line in fd.readlines()]
                 for event in events:
                     if len(event) != 5:
@@ -40,19 +108,31 @@ class PersistedScheduler(sched.scheduler):
                         argument=tuple(json.loads(event[3])),
                         kwargs=json.loads(event[4]),
                     )
+        # Only set the path now to avoid saving the file for each loaded event
+        self.path = path
+
+    def _run_event(self, event):
+        """
+        Run the action of a queued event and persist the queue.
+        """
+        # The sched queue no longer contains the event when this is called
+        self._entries.pop(event, None)
+        self._version += 1
+        try:
+            _watch(event, event.action(*event.argument, **event.kwargs))
+        finally:
+            self.save()
 
     def enterabs(self, time, priority, action, argument=(), kwargs={}):
         """
         Enter a persisted event in the scheduler. The queue is automatically saved after entering the event,
         but also after the event has been run.
         """
-        event = sched.scheduler.enterabs(
-            self,
-            time,
-            priority,
-            _persisted_action,
-            argument=(action, argument, kwargs, self.save),
+        event = Event(time, priority, action, argument, dict(kwargs))
+        self._entries[event] = sched.scheduler.enterabs(
+            self, time, priority, self._run_event, argument=(event,)
         )
+        self._version += 1
         self.save()
         return event
 
@@ -61,68 +141,167 @@ class PersistedScheduler(sched.scheduler):
         Enter a persisted event in the scheduler. The queue is automatically saved after entering the event,
         but also after the event has been run.
         """
-        event = sched.scheduler.enterabs(
-            self,
-            time.time() + delay,
-            priority,
-            _persisted_action,
-            argument=(action, argument, kwargs, self.save),
+        return self.enterabs(
+            self.timefunc() + delay, priority, action, argument, kwargs
         )
-        self.save()
-        return event
 
     def cancel(self, event):
         """
         Cancel a persisted event from the scheduler. Raises ValueError if the event isn't queued.
         """
-        for persisted_event in self.queue:
-            if persisted_event.time == event.time and \
-               persisted_event.priority == event.priority and \
-               persisted_event.argument[0] == event.action and \
-               persisted_event.argument[1] == event.argument and \
-               persisted_event.argument[2] == event.kwargs:
-                sched.scheduler.cancel(self, persisted_event)
-                self.save()
+        entry = self._entries.pop(event, None)
+        if entry is None:
+            # Not one of the queued instances, look for an equivalent event
+            for queued in self._entries:
+                if queued.priority == event.priority and queued.matches(
+                    event.time, event.action, event.argument, event.kwargs
+                ):
+                    entry = self._entries.pop(queued)
+                    break
+        if entry is None:
+            return
+        sched.scheduler.cancel(self, entry)
+        self._version += 1
+        self.save()
+
+    def run_until(self, end):
+        """
+        Run the events due until a time, then let the time pass until it.
+
+        With a simulated clock this jumps from one deadline to the next without waiting.
+
+        :param end: the timestamp to stop at
+        """
+        while True:
+            delay = self.run(blocking=False)
+            if delay is None or self.timefunc() + delay > end:
                 break
+            self.delayfunc(delay)
+        if end > self.timefunc():
+            self.delayfunc(end - self.timefunc())
+
+    def catch_up(self, policy="coalesce", now=None):
+        """
+        Handle the events that are already past due, typically after a restart.
+
+        With the coalesce policy the overdue events are grouped by their arguments, i.e. per place,
+        and only the last one of each group is run to reach the state expected at that time.
+
+        :param policy: one of the CATCH_UP_POLICIES values
+        :param now: the reference time, the current time if None
+        :return: a tuple with the list of run events and the list of skipped events
+        """
+        if policy not in CATCH_UP_POLICIES:
+            raise ValueError("Unknown catch up policy: {}".format(policy))
+        if policy == "replay":
+            return [], []
+
+        if now is None:
+            now = self.timefunc()
+        overdue = [event for event in self.events if event.time <= now]
+        if not overdue:
+            return [], []
+
+        last = {}
+        if policy == "coalesce":
+            for event in overdue:
+                key = (
+                    json.dumps(event.argument),
+                    json.dumps(event.kwargs, sort_keys=True),
+                )
+                last[key] = event
+        applied = list(last.values())
+        applied_ids = {id(event) for event in applied}
+        skipped = [event for event in overdue if id(event) not in applied_ids]
+
+        # Remove all the overdue events at once and save only once
+        for event in overdue:
+            sched.scheduler.cancel(self, self._entries.pop(event))
+        self._version += 1
+        self.save()
+
+        for event in applied:
+            try:
+                _watch(event, event.action(*event.argument, **event.kwargs))
+            except Exception:
+                log.exception("Failed to catch up event %s", event)
+        return applied, skipped
 
     @property
     def events(self):
         """
-        Return the list of scheduled events
+        Return the scheduled events, sorted by time.
+
+        The returned tuple is shared between callers until the queue changes.
         """
-        Event = namedtuple(
-            "Event", ["time", "priority", "action", "argument", "kwargs"]
-        )
-        return [
-            Event(
-                event.time,
-                event.priority,
-                event.argument[0],
-                event.argument[1],
-                event.argument[2],
+        self._refresh_snapshot()
+        return self._snapshot
+
+    def _refresh_snapshot(self):
+        """
+        Rebuild the events snapshot and its index if the queue changed.
+        """
+        if self._snapshot_version != self._version:
+            queue = self.queue
+            self._snapshot = tuple(entry.argument[0] for entry in queue)
+            self._keys = tuple(
+                (entry.time, entry.priority, entry.sequence) for entry in queue
             )
-            for event in self.queue
-        ]
+            self._snapshot_version = self._version
+
+    def select(self, argument=None, start=None, end=None, limit=None, after=None):
+        """
+        Return a page of the scheduled events, sorted by time.
+
+        :param argument: only keep the events with these positional arguments
+        :param start: only keep the events at or after this time
+        :param end: only keep the events before this time
+        :param limit: maximum number of events to return
+        :param after: cursor returned by a previous call to get the next page
+        :return: a tuple with the list of events and the cursor of the next page,
+                 None if there are no more events
+        """
+        self._refresh_snapshot()
+        lower = 0
+        if start is not None:
+            lower = bisect.bisect_left(self._keys, (start,))
+        if after is not None:
+            lower = max(lower, bisect.bisect_right(self._keys, after))
+        upper = len(self._keys)
+        if end is not None:
+            upper = bisect.bisect_left(self._keys, (end,))
+        if argument is not None:
+            argument = tuple(argument)
+        if limit is not None:
+            limit = max(1, limit)
+
+        result = []
+        last = None
+        for index in range(lower, upper):
+            event = self._snapshot[index]
+            if argument is not None and event.argument != argument:
+                continue
+            if limit is not None and len(result) == limit:
+                return result, self._keys[last]
+            result.append(event)
+            last = index
+        return result, None
 
     def save(self):
         """
         Persist the scheduled events to a file
         """
         if not self.path:
-            print("No path")
             return
         with open(self.path, "w") as fd:
             for event in self.events:
-                action = event.action
-                argument = event.argument
-                kwargs = event.kwargs
                 fd.write(
                     "{},{},{},{},{}\n".format(
                         event.time,
                         event.priority,
-                        action.__name__,
-                        json.dumps(argument),
-                        json.dumps(kwargs),
+                        event.action.__name__,
+                        json.dumps(event.argument),
+                        json.dumps(event.kwargs),
                     )
                 )
 
@@ -132,15 +311,17 @@ class SchedulerThread(threading.Thread):
     Thread handling a persisted scheduler.
     """
 
-    def __init__(self, path, functions):
+    def __init__(self, path, functions, clock=None):
         """
         Create a new threaded persisted scheduler instance.
 
         :param path: the path to the file where the events queue is persisted.
         :param functions: list of functions to be used as actions
+        :param clock: the kang.clock clock to use, the system one if None
         """
         super().__init__(name="Scheduler Thread")
-        self.scheduler = PersistedScheduler(path, functions)
+        self.scheduler = PersistedScheduler(path, functions, clock)
+        self.clock = self.scheduler.clock
         self.stopping = False
         self.lock = threading.Lock()
 
@@ -149,42 +330,40 @@ class SchedulerThread(threading.Thread):
         Enter a persisted event in the scheduler. The queue is automatically saved after entering the event,
         but also after the event has been run.
         """
-        self.lock.acquire()
-        event = self.scheduler.enterabs(time, priority, action, argument, kwargs)
-        self.lock.release()
-        return event
+        with self.lock:
+            return self.scheduler.enterabs(time, priority, action, argument, kwargs)
 
     def enter(self, delay, priority, action, argument=(), kwargs={}):
         """
         Enter a persisted event in the scheduler. The queue is automatically saved after entering the event,
         but also after the event has been run.
         """
-        self.lock.acquire()
-        event = self.scheduler.enter(delay, priority, action, argument, kwargs)
-        self.lock.release()
-        return event
+        with self.lock:
+            return self.scheduler.enter(delay, priority, action, argument, kwargs)
 
     def empty(self):
         """
         Thread safe function checking if the scheduler queue is empty
         """
-        self.lock.acquire()
-        result = self.scheduler.empty()
-        self.lock.release()
-        return result
+        with self.lock:
+            return self.scheduler.empty()
 
     @property
     def events(self):
         """
         Return the queue of events
         """
-        self.lock.acquire()
-        result = None
-        try:
-            result = self.scheduler.events
-        finally:
-            self.lock.release()
-        return result
+        with self.lock:
+            return self.scheduler.events
+
+    def select(self, argument=None, start=None, end=None, limit=None, after=None):
+        """
+        Return a page of the scheduled events in a thread-safe way.
+
+        See PersistedScheduler.select() for the details.
+        """
+        with self.lock:
+            return self.scheduler.select(argument, start, end, limit, after)
 
     def cancel(self, time, action, argument=(), kwargs={}):
         """
@@ -197,22 +376,43 @@ class SchedulerThread(threading.Thread):
 
         Raises ValueError if not matching event can be found in the queue
         """
-        self.lock.acquire()
-        found = False
-        for event in self.scheduler.events:
-            if (
-                event.time == time
-                and event.action == action
-                and event.argument == argument
-                and event.kwargs == kwargs
-            ):
-                found = event
-                break
-        if not found:
-            self.lock.release()
-            raise ValueError()
-        self.scheduler.cancel(found)
-        self.lock.release()
+        with self.lock:
+            for event in self.scheduler.events:
+                if event.matches(time, action, argument, kwargs):
+                    self.scheduler.cancel(event)
+                    return
+        raise ValueError()
+
+    def run_until(self, end):
+        """
+        Run the events due until a time in a thread-safe way.
+
+        See PersistedScheduler.run_until() for the details.
+        """
+        with self.lock:
+            self.scheduler.run_until(end)
+
+    def catch_up(self, policy="coalesce", now=None):
+        """
+        Handle the past due events in a thread-safe way.
+
+        See PersistedScheduler.catch_up() for the details.
+        """
+        with self.lock:
+            return self.scheduler.catch_up(policy, now)
+
+    def adjust_time(self, step, policy="coalesce"):
+        """
+        Change the time without running the events it skips over,
+        then handle them like after a restart.
+
+        :param step: function changing the time
+        :param policy: one of the CATCH_UP_POLICIES values
+        :return: a tuple with the list of run events and the list of skipped events
+        """
+        with self.lock:
+            step()
+            return self.scheduler.catch_up(policy)
 
     def stop(self):
         """
@@ -222,8 +422,11 @@ class SchedulerThread(threading.Thread):
 
     def run(self):
         while not self.stopping:
-            self.lock.acquire()
-            if not self.scheduler.empty():
-                self.scheduler.run(blocking=False)
-            self.lock.release()
-            time.sleep(1)
+            with self.lock:
+                try:
+                    if not self.scheduler.empty():
+                        self.scheduler.run(blocking=False)
+                except Exception:
+                    # Keep running the next events
+                    log.exception("Failed to run a scheduled event")
+            self.clock.idle(1)
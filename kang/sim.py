@@ -5,20 +5,56 @@ See https://stackoverflow.com/questions/49292130/raspberry-pi-python-send-sms-us
 for the raspberry pi setup to get the Serial bus working
 """
 
+import collections
 import datetime
+import functools
 import logging
 import re
-import serial
 import time
-from smspdu import SMS_SUBMIT
 from io import StringIO
-from smspdudecoder.easy import read_incoming_sms
-
 
 from kang.cms_error import CmsError
+import kang.encoding
+import kang.metrics
+import kang.modems
+import kang.pdu
 
 log = logging.getLogger(__name__)
 
+# Request a delivery report for each sent segment, set from the configuration
+delivery_reports = False
+
+# Maximum number of received delivery reports waiting to be processed
+REPORTS_QUEUE_SIZE = 64
+
+# (sim, report) tuples of the delivery reports received as unsolicited results, when
+# the modem is set to send them directly instead of storing them
+status_reports = collections.deque(maxlen=REPORTS_QUEUE_SIZE)
+
+
+def readline(sim):
+    """
+    Read a line answered by the modem, handling the unsolicited delivery reports
+    received meanwhile
+
+    @param sim: the SIM serial handle
+    @return: the line
+    """
+    line = sim.readline()
+    while line.startswith((b"+CDS:", b"+CDSI:")):
+        if line.startswith(b"+CDS:"):
+            # The PDU of the report follows on the next line
+            pdu = sim.readline().strip()
+            try:
+                status_reports.append((sim, kang.pdu.decode_status_report(pdu)))
+            except ValueError as err:
+                log.error("Failed parsing delivery report %s: %s", pdu, err)
+        else:
+            # Stored report, read with the received messages
+            log.debug("Delivery report stored: %s", line.strip())
+        line = sim.readline()
+    return line
+
 
 def fireATCommand(sim, command):
     """
@@ -28,8 +64,8 @@ def fireATCommand(sim, command):
     sim.write(b"%s\r\n" % command.encode("ascii"))
 
     # Reading empty line and status
-    sim.readline()
-    return sim.readline().strip() == b"OK"
+    readline(sim)
+    return readline(sim).strip() == b"OK"
 
 
 def getTime(sim):
@@ -38,16 +74,18 @@ def getTime(sim):
 
     @param sim: the SIM serial handle
     """
+    sim.reset_input_buffer()
     sim.write(b"AT+CCLK?\r\n")
-    line = sim.readline()
+    line = readline(sim)
     res = None
-    while not line.endswith(b"OK\r\n"):
-        time.sleep(0.5)
-        matcher = re.match(rb'^\+CCLK: "([^+]+)\+[0-9]+"\r\n', line)
+    while line and not line.endswith(b"OK\r\n"):
+        if get_error(line):
+            return None
+        matcher = re.match(rb'^\+CCLK: "([^+-]+)[+-][0-9]+"\r\n', line)
         if matcher:
             ts = matcher.group(1).decode("ascii")
-            res = datetime.datetime.strptime(ts[: ts.find("+")], "%y/%m/%d,%H:%M:%S")
-        line = sim.readline()
+            res = datetime.datetime.strptime(ts, "%y/%m/%d,%H:%M:%S")
+        line = readline(sim)
     return res
 
 
@@ -64,15 +102,174 @@ def get_error(line):
     return None
 
 
+# Number of encoded messages kept to send them again
+PDU_CACHE_SIZE = 256
+
+
+@functools.lru_cache(maxsize=PDU_CACHE_SIZE)
+def encode_pdus(number, text, status_report=False):
+    """
+    Encode a message into SMS-SUBMIT PDUs, one per segment.
+
+    The alphabet only depends on the text: the replies sent several times to the same
+    number, like the help or the confirmations, are only encoded once.
+
+    @param number: the destination phone number
+    @param text: the message
+    @param status_report: request a delivery report for each segment
+    @return: a tuple of (PDU hex string, TPDU length) tuples, the hex strings starting
+             with a 00 byte to use the SIM's default SMSC
+    """
+    from smspdu import SMS_SUBMIT
+
+    pdus = []
+    for chunk in kang.encoding.split_segments(text):
+        # Convert the PDU binary map into a clean uppercase Hex string
+        pdu_hex = (
+            SMS_SUBMIT.create(None, number, chunk, tp_srr=int(status_report))
+            .toPDU()
+            .upper()
+        )
+        pdus.append(("00" + pdu_hex, len(pdu_hex) // 2))
+    return tuple(pdus)
+
+
+def _encode_address(number):
+    """
+    @param number: the destination phone number
+    @return: the hex string of the TP-DA field of an SMS-SUBMIT PDU
+    """
+    digits = number.lstrip("+")
+    swapped = "".join(
+        pair[1::-1] for pair in re.findall("..?", digits + "F" * (len(digits) % 2))
+    )
+    return "{:02X}{}{}".format(
+        len(digits), "91" if number.startswith("+") else "81", swapped
+    )
+
+
+@functools.lru_cache(maxsize=PDU_CACHE_SIZE)
+def encode_user_data(text):
+    """
+    Encode the parts of the SMS-SUBMIT PDUs of a message that don't depend on the
+    destination number
+
+    @param text: the message
+    @return: a tuple of (head, tail) hex strings per segment, the destination address
+             field going between the two
+    """
+    parts = []
+    for pdu_hex, _ in encode_pdus("0", text):
+        # Strip the SMSC byte, first octet, message reference and "0" address
+        parts.append((pdu_hex[2:6], pdu_hex[12:]))
+    return tuple(parts)
+
+
+def _broadcast_pdus(numbers, text):
+    """
+    @return: an iterator of (number, PDU hex string, TPDU length, last segment) tuples
+    """
+    segments = encode_user_data(text)
+    for number in numbers:
+        address = _encode_address(number)
+        for index, (head, tail) in enumerate(segments, start=1):
+            tpdu = head + address + tail
+            yield number, "00" + tpdu, len(tpdu) // 2, index == len(segments)
+
+
+def _wait_sent(sim):
+    """
+    Wait for the result of a submitted PDU
+
+    @return: the message reference given by the modem, None if not found
+    @raise CmsError: if the modem fails to send it
+    """
+    reference = None
+    line = readline(sim)
+    while not line.endswith(b"OK\r\n"):
+        error = get_error(line)
+        if error:
+            raise error
+        matcher = re.match(rb"^\+CMGS:\s*([0-9]+)", line)
+        if matcher:
+            reference = int(matcher.group(1))
+        line = readline(sim)
+    return reference
+
+
+def _open_prompt(sim, pdu_len):
+    """
+    Start the submission of a PDU and wait for the modem prompt
+    """
+    sim.write(f"AT+CMGS={pdu_len}\r\n".encode("ascii"))
+    prompt = sim.read_until(b"> ")
+    if b"> " not in prompt:
+        remainder = prompt + sim.readline()
+        log.error("Modem rejected PDU initiation prompt. Response: %s", remainder)
+        raise Exception(
+            "Modem failed to open PDU prompt: "
+            + remainder.decode("ascii", errors="replace")
+        )
+
+
+def sendAllSms(sim, numbers, text):
+    """
+    Send the same message to several numbers.
+
+    The text is only encoded once, and the PDU of the next submission is built while
+    the modem sends the previous one.
+
+    @param sim: the SIM serial handle
+    @param numbers: the destination phone numbers
+    @param text: the message
+    @return: an iterator of (number, CmsError or None) tuples, yielded as soon as the
+             message to a number is sent or refused
+    @raise Exception: if the modem or its network doesn't accept the submissions anymore
+    """
+    sim.reset_input_buffer()
+    pdus = _broadcast_pdus(numbers, text)
+    current = next(pdus, None)
+    failed = None
+    while current is not None:
+        number, pdu_hex, pdu_len, last = current
+        submitted = number != failed
+        if submitted:
+            _open_prompt(sim, pdu_len)
+            sim.write(f"{pdu_hex}\x1a".encode("ascii"))
+            kang.metrics.increment("sms_segments_sent")
+
+        # Build the next PDU while the modem talks to the network
+        current = next(pdus, None)
+
+        if submitted:
+            try:
+                _wait_sent(sim)
+            except CmsError as err:
+                if kang.modems.modem_error(err):
+                    # Let the other modems send to this number and the next ones
+                    raise
+                log.error("Failed to send SMS to %s: %s", number, err)
+                failed = number
+                yield number, err
+                continue
+        if last and number != failed:
+            yield number, None
+
+
 class Sms:
-    def __init__(self, dest=None, message=None):
+    def __init__(self, dest=None, message=None, date=None):
         """
         @param dest: the destination phone number
         @param message: the message
+        @param date: the time the message was sent, for received messages
         """
         self.number = dest
         self.message = message
+        self.date = date
+        # Message references of the sent segments
+        self.references = []
 
+    @kang.metrics.timed("sms_send")
     def send(self, sim):
         """
         @param sim: the SIM serial handle
@@ -80,55 +277,27 @@ class Sms:
         log.debug("Sending SMS: %s", self.message)
         sim.reset_input_buffer()
 
-        pdu_objects = []
-        chunks = [self.message[i : i + 160] for i in range(0, len(self.message), 160)]
-        for chunk in chunks:
-            pdu_objects.append(SMS_SUBMIT.create(None, self.number, chunk))
-
-        log.debug("Message split into %s PDU segments.", len(pdu_objects))
+        pdus = encode_pdus(self.number, self.message, delivery_reports)
+        self.references = []
+        log.debug("Message split into %s PDU segments.", len(pdus))
+        kang.metrics.increment("sms_segments_sent", len(pdus))
 
         # Transmit each segment sequentially
-        for index, pdu_obj in enumerate(pdu_objects, start=1):
-            # Convert the PDU binary map into a clean uppercase Hex string
-            pdu_hex = pdu_obj.toPDU().upper()
-            pdu_len = len(pdu_hex) // 2
-
-            # Prepend a 00 byte to tell the modem to use the SIM's default SMSC profile
-            pdu_hex = "00" + pdu_hex
-
+        for index, (pdu_hex, pdu_len) in enumerate(pdus, start=1):
             log.debug(
                 "Sending segment %s/%s (Length: %s): %s",
                 index,
-                len(pdu_objects),
+                len(pdus),
                 pdu_len,
                 pdu_hex,
             )
 
-            # Initiate the write pipeline using \r\n line endings
-            sim.write(f"AT+CMGS={pdu_len}\r\n".encode("ascii"))
-
-            # Wait for the modem prompt indicating readiness
-            prompt = sim.read_until(b"> ")
-            if b"> " not in prompt:
-                remainder = prompt + sim.readline()
-                log.error(
-                    "Modem rejected PDU initiation prompt. Response: %s", remainder
-                )
-                raise Exception(
-                    "Modem failed to open PDU prompt: "
-                    + remainder.decode("ascii", errors="replace")
-                )
-
-            # Push the hex PDU string followed immediately by Ctrl+Z (\x1a)
+            # Wait for the modem prompt, then push the hex PDU followed by Ctrl+Z
+            _open_prompt(sim, pdu_len)
             sim.write(f"{pdu_hex}\x1a".encode("ascii"))
 
-            # Keep processing responses until this fragment is confirmed by the cell tower
-            line = sim.readline()
-            while not line.endswith(b"OK\r\n"):
-                error = get_error(line)
-                if error:
-                    raise error
-                line = sim.readline()
+            # Wait until this fragment is confirmed by the cell tower
+            self.references.append(_wait_sent(sim))
 
         log.info("All segments sent successfully.")
 
@@ -140,58 +309,104 @@ class Sms:
         @return: an SMS object
         """
         log.debug("Reading SMS %s", idx)
-        sim.reset_input_buffer()
-        sim.write(b"AT+CMGR=%s\r\n" % idx.encode("ascii"))
-        msg = b""
-        line = None
-        while not line or not line.endswith(b"OK\r\n"):
-            line = sim.readline()
-            error = get_error(line)
-            if error:
-                raise error
-            if line != b"\r\n" and line != b"OK\r\n" and not line.startswith(b"+CMGR:"):
-                msg = msg + line
-
-        # Decode the PDU hex string using smspdudecoder
-        try:
-            parsed = read_incoming_sms(msg.decode("ascii"))
-            log.debug("parsed sms: %s", parsed["content"])
-            return Sms(parsed["sender"], parsed["content"])
+        buffer = kang.pdu.PduBuffer()
+        with kang.metrics.timer("sms_read"):
+            sim.reset_input_buffer()
+            sim.write(b"AT+CMGR=%s\r\n" % idx.encode("ascii"))
+            line = None
+            while not line or not line.endswith(b"OK\r\n"):
+                line = readline(sim)
+                error = get_error(line)
+                if error:
+                    raise error
+                if (
+                    line != b"\r\n"
+                    and line != b"OK\r\n"
+                    and not line.startswith(b"+CMGR:")
+                ):
+                    buffer.append(line)
 
+        try:
+            return Sms.decode(buffer)
         except Exception as e:
-            log.error("Failed parsing PDU string %s: %s", msg, e)
+            log.error("Failed parsing PDU string %s: %s", bytes(buffer.data()), e)
             raise e
 
+    @staticmethod
+    def decode(buffer):
+        """
+        @param buffer: the kang.pdu.PduBuffer holding the PDU hex digits
+        @return: an SMS object
+        """
+        with kang.metrics.timer("pdu_decode"):
+            try:
+                parsed = kang.pdu.decode_deliver(buffer.data())
+            except ValueError:
+                # Let smspdudecoder try the PDUs the quick decoder doesn't support
+                from smspdudecoder.easy import read_incoming_sms
+
+                parsed = read_incoming_sms(str(buffer.data(), "ascii"))
+        log.debug("parsed sms: %s", parsed["content"])
+        return Sms(parsed["sender"], parsed["content"], parsed.get("date"))
+
     @staticmethod
     def delete(sim, idx):
         fireATCommand(sim, "AT+CMGD=%s" % idx)
 
 
-def getAllSmsIds(sim):
+@kang.metrics.timed("sms_list")
+def readAllSms(sim, skip=()):
     """
+    Read all the stored messages with a single command
+
     @param sim: the SIM serial handle
-    @return: the list of identifiers for the available messages
+    @param skip: identifiers of the messages not to decode
+    @return: the list of (identifier, Sms) tuples, with None instead of the Sms for
+             the messages that can't be decoded and the kang.pdu.decode_status_report()
+             dictionary for the stored delivery reports
     """
+    sim.reset_input_buffer()
     sim.write(b"AT+CMGL=4\r\n")
     messages = []
-    time.sleep(0.5)
-    line = sim.readline()
-    while not line.endswith(b"OK\r\n"):
-        time.sleep(0.5)
+    buffer = kang.pdu.PduBuffer()
+    idx = None
+    line = readline(sim)
+    while line and not line.endswith(b"OK\r\n"):
+        error = get_error(line)
+        if error:
+            raise error
         matcher = re.match(rb"^\+CMGL:\s*([0-9]+),", line)
         if matcher:
-            messages.append(matcher.group(1).decode("ascii"))
-        line = sim.readline()
+            idx = matcher.group(1).decode("ascii")
+        elif idx is not None and line != b"\r\n":
+            # The PDU follows the +CMGL line
+            if idx not in skip:
+                buffer.clear()
+                buffer.append(line)
+                try:
+                    if kang.pdu.is_status_report(buffer.data()):
+                        message = kang.pdu.decode_status_report(buffer.data())
+                    else:
+                        message = Sms.decode(buffer)
+                    messages.append((idx, message))
+                except Exception as e:
+                    log.error("Failed parsing PDU of message %s: %s", idx, e)
+                    messages.append((idx, None))
+            idx = None
+        line = readline(sim)
     return messages
 
 
-def setup(dev="/dev/ttyAMA0"):
+def setup(dev="/dev/ttyAMA0", delivery_reports=False):
     """
     Run the AT initialization commands
 
     @param dev: the serial device path. /dev/ttyAMA0 as default should work fine
+    @param delivery_reports: get the delivery reports of the sent messages
     @return: the initialized sim handle
     """
+    import serial
+
     sim = serial.Serial(dev, 115200, timeout=5)
     fireATCommand(sim, "AT")
     fireATCommand(sim, "ATE0")  # Disable echo
@@ -208,7 +423,14 @@ def setup(dev="/dev/ttyAMA0"):
     time.sleep(5)
 
     fireATCommand(sim, "AT+CMGF=0")  # Setting PDU mode
-    fireATCommand(sim, "AT+CNMI=1,0,0,0,0")  # Don't get the unsolicited notifications
+    if delivery_reports:
+        # Store the delivery reports with the received messages: an unsolicited +CDS
+        # arriving while the modem is idle would be dropped with the input buffer
+        fireATCommand(sim, "AT+CNMI=1,0,0,2,0")
+    else:
+        fireATCommand(
+            sim, "AT+CNMI=1,0,0,0,0"
+        )  # Don't get the unsolicited notifications
     fireATCommand(sim, 'AT+CSCS="UCS2"')  # Receive all data as UCS2
     fireATCommand(
         sim, "AT+CSMP=17,168,0,8"
@@ -0,0 +1,147 @@
+"""
+Keep the system clock on the network time
+
+The Raspberry Pi has no real time clock: the time is read from the modem with
+AT+CCLK? when starting and then periodically, to correct the drift before it shifts
+the scheduled events. Small offsets are slewed, so the time never goes backward nor
+skips an event, larger ones are stepped with clock_settime(). The scheduler is paused
+while stepping and then catches up with the events the jump went over.
+
+Setting the time requires running as root.
+"""
+
+import logging
+import threading
+import time
+
+import kang.metrics
+import kang.sim
+
+log = logging.getLogger(__name__)
+
+# Time between two reads of the network time, in seconds
+SYNC_INTERVAL = 3600
+
+# Offsets below the resolution of the network time are ignored, in seconds
+TOLERANCE = 1
+
+# Largest offset corrected by slewing, in seconds. The kernel slews at 0.5 ms/s,
+# 5 seconds take less than 3 hours to absorb.
+SLEW_LIMIT = 5
+
+
+def step_time(offset):
+    """
+    Move the system clock at once
+
+    @param offset: seconds to add to the current time
+    """
+    time.clock_settime(time.CLOCK_REALTIME, time.time() + offset)
+
+
+def slew_time(offset):
+    """
+    Make the system clock run slightly faster or slower until it gained an offset
+
+    @param offset: seconds to add to the current time
+    @return: False if the clock can't be slewed
+    """
+    import ctypes
+    import ctypes.util
+
+    class Timeval(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_usec", ctypes.c_long)]
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        adjtime = libc.adjtime
+    except (OSError, AttributeError):
+        return False
+    seconds = int(offset)
+    delta = Timeval(seconds, int(round((offset - seconds) * 1000000)))
+    if adjtime(ctypes.byref(delta), None) != 0:
+        log.error("Failed to slew the time: errno %s", ctypes.get_errno())
+        return False
+    return True
+
+
+class TimeSync(threading.Thread):
+    """
+    Read the network time periodically and correct the system clock
+    """
+
+    def __init__(
+        self,
+        sim,
+        modem_lock,
+        scheduler_thread=None,
+        policy="coalesce",
+        on_jump=None,
+        interval=SYNC_INTERVAL,
+    ):
+        """
+        @param sim: the SIM serial handle
+        @param modem_lock: the lock serializing the accesses to the modem
+        @param scheduler_thread: the kang.scheduler.SchedulerThread to pause while stepping
+        @param policy: the catch up policy for the events skipped by a step
+        @param on_jump: function called with the offset and the applied and skipped
+                        events after stepping the clock
+        @param interval: seconds between two synchronizations
+        """
+        super().__init__(name="Time Sync Thread", daemon=True)
+        self.sim = sim
+        self.modem_lock = modem_lock
+        self.scheduler_thread = scheduler_thread
+        self.policy = policy
+        self.on_jump = on_jump
+        self.interval = interval
+        self._stopping = threading.Event()
+
+    def sync(self):
+        """
+        Read the network time and correct the system clock
+
+        @return: the measured offset in seconds, None if the network time is unknown
+        """
+        with self.modem_lock:
+            network_time = kang.sim.getTime(self.sim)
+        if network_time is None:
+            log.warning("The network time is unknown")
+            return None
+
+        offset = network_time.timestamp() - time.time()
+        kang.metrics.observe("time_offset", abs(offset))
+        if abs(offset) < TOLERANCE:
+            return offset
+        if abs(offset) <= SLEW_LIMIT and slew_time(offset):
+            log.info("Slewing the time by %.3fs", offset)
+            return offset
+
+        log.warning("Stepping the time by %.3fs", offset)
+        try:
+            if self.scheduler_thread:
+                applied, skipped = self.scheduler_thread.adjust_time(
+                    lambda: step_time(offset), self.policy
+                )
+            else:
+                step_time(offset)
+                applied, skipped = [], []
+        except OSError as err:
+            log.error("Failed to set the time: %s", err)
+            return offset
+        if self.on_jump:
+            self.on_jump(offset, applied, skipped)
+        return offset
+
+    def run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                self.sync()
+            except Exception:
+                log.exception("Failed to synchronize the time")
+
+    def stop(self):
+        """
+        Request the thread to stop
+        """
+        self._stopping.set()
@@ -0,0 +1,74 @@
+"""
+Version of the running code, resolved once at import
+
+setup.py writes the version, commit and build date in kang/_build.py when building
+the package. When running from a source checkout, the version is read from the
+kang/VERSION file if any, and the commit from the .git directory without running git.
+"""
+
+import os.path
+
+_path = os.path.dirname(os.path.abspath(__file__))
+
+
+def _read_version_file():
+    """
+    @return: the content of the kang/VERSION file, None if missing
+    """
+    try:
+        with open(os.path.join(_path, "VERSION")) as fd:
+            return fd.read().strip() or None
+    except OSError:
+        return None
+
+
+def _git_commit(root):
+    """
+    @param root: the folder containing the .git directory
+    @return: the short identifier of the checked out commit, None if unknown
+    """
+    git_dir = os.path.join(root, ".git")
+    try:
+        with open(os.path.join(git_dir, "HEAD")) as fd:
+            head = fd.read().strip()
+        if not head.startswith("ref: "):
+            return head[:7]
+        ref = head[len("ref: ") :]
+        ref_path = os.path.join(git_dir, *ref.split("/"))
+        if os.path.isfile(ref_path):
+            with open(ref_path) as fd:
+                return fd.read().strip()[:7]
+        with open(os.path.join(git_dir, "packed-refs")) as fd:
+            for line in fd:
+                parts = line.split()
+                if len(parts) == 2 and parts[1] == ref:
+                    return parts[0][:7]
+    except OSError:
+        pass
+    return None
+
+
+try:
+    from kang._build import VERSION, COMMIT, BUILD_DATE
+except ImportError:
+    VERSION = _read_version_file()
+    COMMIT = _git_commit(os.path.dirname(_path))
+    BUILD_DATE = None
+
+
+def describe():
+    """
+    @return: the user-readable version with the build information
+    """
+    if not VERSION and not COMMIT:
+        return "unknown version"
+    details = [COMMIT] if COMMIT and VERSION else []
+    if BUILD_DATE:
+        details.append("construit le {}".format(BUILD_DATE))
+    text = VERSION or COMMIT
+    if details:
+        text += " ({})".format(", ".join(details))
+    return text
+
+
+DESCRIPTION = describe()
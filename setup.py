@@ -1,11 +1,50 @@
+import datetime
+import os.path
+import subprocess
+
 import setuptools
+from setuptools.command.build_py import build_py
+
+VERSION = "0.2.0"
 
 with open("README.md", "r") as fh:
     long_description = fh.read()
 
+
+def git_commit():
+    """
+    Get the short identifier of the built commit, None if not building from git
+    """
+    try:
+        process = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True
+        )
+    except OSError:
+        return None
+    return process.stdout.strip() if process.returncode == 0 else None
+
+
+class BuildPy(build_py):
+    """
+    Embed the version and build information in the kang._build module
+    """
+
+    def run(self):
+        super().run()
+        path = os.path.join(self.build_lib, "kang", "_build.py")
+        with open(path, "w") as fd:
+            fd.write(
+                "VERSION = {!r}\nCOMMIT = {!r}\nBUILD_DATE = {!r}\n".format(
+                    VERSION,
+                    git_commit(),
+                    datetime.date.today().isoformat(),
+                )
+            )
+
+
 setuptools.setup(
     name="kang",  # Replace with your own username
-    version="0.2.0",
+    version=VERSION,
     author="Cedric Bosdonnat",
     author_email="cedric.bosdonnat@free.fr",
     description="An SMS-controlled heating system for raspberry pi and SIM7600E",
@@ -13,7 +52,13 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/cbosdo/kang",
     packages=["kang"],
-    entry_points={"console_scripts": ["kang = kang.kang:main"]},
+    cmdclass={"build_py": BuildPy},
+    entry_points={
+        "console_scripts": [
+            "kang = kang.kang:main",
+            "kang-replay = kang.replay:main",
+        ]
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
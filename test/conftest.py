@@ -1,3 +1,4 @@
+import kang.clock
 import kang.scheduler
 
 import os
@@ -65,12 +66,14 @@ def make_scheduler_thread():
     Convenience fixture to easily create a scheduler thread with data
     """
     scheduler_thread = None
-    def _make_scheduler(data):
+    def _make_scheduler(data, now=1704067200.0):
         nonlocal scheduler_thread
         with open(EVENTS_FILE, "w") as fd:
             fd.write(data)
 
-        scheduler_thread = kang.scheduler.SchedulerThread(EVENTS_FILE, [start, stop])
+        # Simulated clock to keep the events in the future
+        clock = kang.clock.SimulatedClock(now)
+        scheduler_thread = kang.scheduler.SchedulerThread(EVENTS_FILE, [start, stop], clock)
         scheduler_thread.start()
         return scheduler_thread
 
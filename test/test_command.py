@@ -5,6 +5,8 @@ from threading import local
 from datetime import datetime, timedelta
 import time
 import kang.kang
+import kang.metrics
+import kang.relays
 from unittest.mock import MagicMock, call, patch
 import pytest
 from json import dumps as _dumps
@@ -12,19 +14,19 @@ from test.conftest import start, stop
 
 
 @patch("kang.sim")
-@patch("kang.relays")
-def test_start(mock_relays, mock_sim, make_sms):
+@patch("kang.relays.start")
+def test_start(mock_start, mock_sim, make_sms):
     """
     Test the processing of command Démarrer
     """
-    mock_sim = MagicMock()
     mock_sms = make_sms("+33123456789", "Démarrer")
 
     kang.kang.process_command(mock_sms, mock_sim)
 
     # Test that the relays are actioned
-    mock_relays.start.assert_any_call(mock_relays.CHURCH)
-    mock_relays.start.assert_called_with(mock_relays.HALL)
+    mock_start.assert_called_once_with(
+        kang.relays.CHURCH, kang.relays.HALL, force=False
+    )
 
     # Test that the confirmation SMS is sent back
     mock_sim.Sms.assert_called_with("+33123456789", "Démarré dans l'église, le hall")
@@ -32,24 +34,18 @@ def test_start(mock_relays, mock_sim, make_sms):
 
 
 @patch("kang.sim")
-@patch("kang.relays")
-def test_start_place(mock_relays, mock_sim, make_sms, place):
+@patch("kang.relays.start")
+def test_start_place(mock_start, mock_sim, make_sms, place):
     """
     Test the processing of the command Démarrer in specific places
     """
-    mock_sim = MagicMock()
     mock_sms = make_sms("+33123456789", "Démarrer dans " + place)
 
     kang.kang.process_command(mock_sms, mock_sim)
 
     # Test that the relays are actioned
-    called = mock_relays.CHURCH
-    not_called = mock_relays.HALL
-    if place == "le hall":
-        called = mock_relays.HALL
-        not_called = mock_relays.CHURCH
-    mock_relays.start.assert_any_call(called)
-    call(not_called) not in mock_relays.start.method_calls
+    called = kang.relays.HALL if place == "le hall" else kang.relays.CHURCH
+    mock_start.assert_called_once_with(called, force=False)
 
     # Test that the confirmation SMS is sent back
     mock_sim.Sms.assert_called_once_with("+33123456789", "Démarré dans " + place)
@@ -57,19 +53,17 @@ def test_start_place(mock_relays, mock_sim, make_sms, place):
 
 
 @patch("kang.sim")
-@patch("kang.relays")
-def test_stop(mock_relays, mock_sim, make_sms):
+@patch("kang.relays.stop")
+def test_stop(mock_stop, mock_sim, make_sms):
     """
     Test the processing of command Arrêter
     """
-    mock_sim = MagicMock()
     mock_sms = make_sms("+33123456789", "Arrêter")
 
     kang.kang.process_command(mock_sms, mock_sim)
 
     # Test that the relays are actioned
-    mock_relays.stop.assert_any_call(mock_relays.CHURCH)
-    mock_relays.stop.assert_called_with(mock_relays.HALL)
+    mock_stop.assert_called_once_with(kang.relays.CHURCH, kang.relays.HALL, force=False)
 
     # Test that the confirmation SMS is sent back
     mock_sim.Sms.assert_called_with("+33123456789", "Arrêté dans l'église, le hall")
@@ -77,24 +71,18 @@ def test_stop(mock_relays, mock_sim, make_sms):
 
 
 @patch("kang.sim")
-@patch("kang.relays")
-def test_stop_place(mock_relays, mock_sim, make_sms, place):
+@patch("kang.relays.stop")
+def test_stop_place(mock_stop, mock_sim, make_sms, place):
     """
     Test the processing of the command Arrêter in specific places
     """
-    mock_sim = MagicMock()
     mock_sms = make_sms("+33123456789", "Arrêter dans " + place)
 
     kang.kang.process_command(mock_sms, mock_sim)
 
     # Test that the relays are actioned
-    called = mock_relays.CHURCH
-    not_called = mock_relays.HALL
-    if place == "le hall":
-        called = mock_relays.HALL
-        not_called = mock_relays.CHURCH
-    mock_relays.stop.assert_any_call(called)
-    call(not_called) not in mock_relays.stop.method_calls
+    called = kang.relays.HALL if place == "le hall" else kang.relays.CHURCH
+    mock_stop.assert_called_once_with(called, force=False)
 
     # Test that the confirmation SMS is sent back
     mock_sim.Sms.assert_called_with("+33123456789", "Arrêté dans " + place)
@@ -102,19 +90,19 @@ def test_stop_place(mock_relays, mock_sim, make_sms, place):
 
 
 @patch("kang.sim")
-@patch("kang.relays")
-def test_command_lenient(mock_relays, mock_sim, make_sms):
+@patch("kang.relays.start")
+def test_command_lenient(mock_start, mock_sim, make_sms):
     """
     Test the processing of commands with variations of accents, added spaces, different caps
     """
-    mock_sim = MagicMock()
     mock_sms = make_sms("+33123456789", " demarrer  ")
 
     kang.kang.process_command(mock_sms, mock_sim)
 
     # Test that the relays are actioned
-    mock_relays.start.assert_any_call(mock_relays.CHURCH)
-    mock_relays.start.assert_called_with(mock_relays.HALL)
+    mock_start.assert_called_once_with(
+        kang.relays.CHURCH, kang.relays.HALL, force=False
+    )
 
     # Test that the confirmation SMS is sent back
     mock_sim.Sms.assert_called_with("+33123456789", "Démarré dans l'église, le hall")
@@ -216,22 +204,501 @@ def test_cancel_schedule(mock_sim, make_sms, make_scheduler_thread):
     mock_sim.Sms.return_value.send.assert_called_with(mock_sim)
 
 
-@patch("kang.kang.subprocess")
+@patch("kang.version.DESCRIPTION", "0.2.0 (abc1234, construit le 2024-01-07)")
 @patch("kang.sim")
-def test_version(mock_sim, mock_subprocess, make_sms):
+def test_version(mock_sim, make_sms):
     """
     Test the processing of command version
     """
-    mock_sim = MagicMock()
     mock_sms = make_sms("+33123456789", "version")
 
-    git_mock = MagicMock()
-    git_mock.returncode = 0
-    git_mock.stdout = "Fake version"
-    mock_subprocess.run.return_value = git_mock
-
     kang.kang.process_command(mock_sms, mock_sim)
 
     # Test that the result SMS is sent back
-    mock_sim.Sms.assert_called_with("+33123456789", "Fake version")
+    mock_sim.Sms.assert_called_with(
+        "+33123456789", "0.2.0 (abc1234, construit le 2024-01-07)"
+    )
     mock_sim.Sms.return_value.send.assert_called_with(mock_sim)
+
+
+@patch("kang.sim")
+def test_list_events_paged(mock_sim, make_sms, make_scheduler_thread):
+    """
+    Test listing the scheduled events of one place, one page at a time
+    """
+    data = "".join(
+        "{},0,start,[22],{{}}\n{},0,start,[24],{{}}\n".format(
+            4102444800.0 + day * 86400, 4102444800.0 + day * 86400
+        )
+        for day in range(3)
+    )
+    scheduler_thread = make_scheduler_thread(data)
+
+    with patch.multiple("kang.relays", start=start, stop=stop), patch(
+        "kang.kang.scheduler_thread", scheduler_thread
+    ):
+        kang.kang.process_command(
+            make_sms("+33123456789", "Lister les 2 prochaines dans l'église"), mock_sim
+        )
+        first_page = mock_sim.Sms.call_args.args[1]
+
+        kang.kang.process_command(make_sms("+33123456789", "Suite"), mock_sim)
+        second_page = mock_sim.Sms.call_args.args[1]
+
+        kang.kang.process_command(make_sms("+33123456789", "Suite"), mock_sim)
+        no_page = mock_sim.Sms.call_args.args[1]
+
+    assert first_page.count("démarrer - l'église") == 2
+    assert "le hall" not in first_page
+    assert first_page.endswith("Envoyer 'Suite' pour la suite")
+    assert second_page.count("démarrer - l'église") == 1
+    assert "Suite" not in second_page
+    assert no_page == "Aucune suite à afficher"
+    assert "+33123456789" not in kang.kang._list_cursors
+
+
+@patch("kang.sim")
+def test_list_events_cursors_bounded(mock_sim, make_sms, make_scheduler_thread):
+    """
+    Test that only the most recent paged listings are remembered
+    """
+    data = "".join(
+        "{},0,start,[22],{{}}\n".format(4102444800.0 + day * 86400) for day in range(3)
+    )
+    scheduler_thread = make_scheduler_thread(data)
+    with patch.multiple("kang.relays", start=start, stop=stop), patch(
+        "kang.kang.scheduler_thread", scheduler_thread
+    ), patch("kang.kang.MAX_LIST_CURSORS", 2), patch.dict(
+        "kang.kang._list_cursors", clear=True
+    ):
+        for number in ["+33600000001", "+33600000002", "+33600000003"]:
+            kang.kang.process_command(
+                make_sms(number, "Lister les 2 prochaines"), mock_sim
+            )
+        assert list(kang.kang._list_cursors) == ["+33600000002", "+33600000003"]
+
+        kang.kang.process_command(make_sms("+33600000001", "Suite"), mock_sim)
+        assert mock_sim.Sms.call_args.args[1] == "Aucune suite à afficher"
+
+
+@patch("kang.sim")
+def test_list_events_removed_place(mock_sim, make_sms, make_scheduler_thread):
+    """
+    Test that the events of a place removed from the configuration are still listed
+    """
+    scheduler_thread = make_scheduler_thread("4102444800.0,0,start,[5],{}\n")
+
+    with patch.multiple("kang.relays", start=start, stop=stop), patch(
+        "kang.kang.scheduler_thread", scheduler_thread
+    ):
+        kang.kang.process_command(make_sms("+33123456789", "Lister"), mock_sim)
+
+    assert "démarrer - 5" in mock_sim.Sms.call_args.args[1]
+
+
+@patch("kang.sim")
+def test_list_events_invalid_date(mock_sim, make_sms, make_scheduler_thread):
+    """
+    Test that listing the events of a day which doesn't exist is refused
+    """
+    with patch("kang.kang.scheduler_thread", make_scheduler_thread("")):
+        for text in ["Lister du 31/02", "Lister du 01/01 au 45/13/2030"]:
+            kang.kang.process_command(make_sms("+33123456789", text), mock_sim)
+            mock_sim.Sms.assert_called_with(
+                "+33123456789",
+                "Commande inconnue, envoyer 'aide' pour vérifier les commandes disponibles",
+            )
+
+
+@patch("kang.sim")
+def test_reply_packing(mock_sim):
+    """
+    Test that reply lines are packed up to the segment budget of their alphabet
+    """
+    mock_sim.Sms.side_effect = lambda number, message: message
+
+    # GSM alphabet: 160 characters per SMS
+    lines = ["- +3361234567{}".format(i % 10) for i in range(30)]
+    messages = kang.kang.Reply(
+        "+33123456789", "Numéros autorisés", iter(lines)
+    ).messages()
+    assert len(messages) == 4
+    for i, message in enumerate(messages):
+        assert message.startswith("Numéros autorisés {}/4:\n".format(i + 1))
+        assert kang.encoding.fits_segment(kang.encoding.encoded_length(message))
+    assert sum(message.count("\n- ") for message in messages) == 30
+
+    # UCS2 alphabet: 70 characters per SMS
+    lines = ["- 01/02/2023 12:34: arrêter - le hall"] * 12
+    messages = kang.kang.Reply("+33123456789", "Programmation", lines).messages()
+    assert len(messages) == 12
+    assert messages[-1].startswith("Programmation 12/12:\n")
+    for message in messages:
+        assert len(message) <= 70
+
+
+@patch("kang.sim")
+def test_show_state(mock_sim, make_sms):
+    """
+    Test the processing of the command Etat
+    """
+    since = datetime(2023, 2, 1, 12, 34).timestamp()
+    with patch.dict(
+        "kang.relays._state", {22: {"on": True, "since": since}}, clear=True
+    ):
+        kang.kang.process_command(make_sms("+33123456789", "État"), mock_sim)
+
+    mock_sim.Sms.assert_called_with(
+        "+33123456789",
+        "Chauffage:\n- l'église: allumé depuis le 01/02/2023 12:34\n- le hall: inconnu",
+    )
+
+
+@patch("kang.sim")
+def test_configured_places(mock_sim, make_sms):
+    """
+    Test commands on places defined in the configuration
+    """
+    places = [
+        kang.relays.Place.from_config(place)
+        for place in [
+            {"name": "l'église", "on_pin": 22},
+            {"name": "la salle Saint-Rémi", "aliases": ["salle"], "on_pin": 5},
+        ]
+    ]
+    kang.kang.configure_places(places)
+    try:
+        with patch("kang.relays.start") as mock_start:
+            kang.kang.process_command(
+                make_sms("+33123456789", "Démarrer dans la Salle Saint-Remi"),
+                mock_sim,
+            )
+            mock_start.assert_called_once_with(5, force=False)
+            mock_sim.Sms.assert_called_with(
+                "+33123456789", "Démarré dans la salle Saint-Rémi"
+            )
+
+            kang.kang.process_command(
+                make_sms("+33123456789", "Démarrer dans salle"), mock_sim
+            )
+            mock_start.assert_called_with(5, force=False)
+
+            kang.kang.process_command(make_sms("+33123456789", "Démarrer"), mock_sim)
+            mock_start.assert_called_with(22, 5, force=False)
+
+        assert kang.relays.get_place(5).off_pin == 6
+    finally:
+        kang.kang.configure_places(kang.relays.DEFAULT_PLACES)
+
+
+def test_reload_configuration(tmp_path):
+    """
+    Test that the configuration is applied again, unless it is invalid
+    """
+    config_file = tmp_path / "kang.json"
+    config_file.write_text(
+        _dumps(
+            {
+                "log_level": "debug",
+                "admins": ["+33123456789"],
+                "places": [{"name": "la salle", "aliases": ["salle"], "on_pin": 5}],
+            }
+        )
+    )
+    try:
+        with patch("kang.kang.CONFIG_FILE", str(config_file)), patch(
+            "kang.relays.setup"
+        ) as mock_setup:
+            assert kang.kang.reload_configuration()
+            mock_setup.assert_called_once_with()
+            assert kang.kang._config["admins"] == ["+33123456789"]
+            assert kang.kang._place_aliases == {"la salle": 5, "salle": 5}
+            assert kang.relays.get_place(5).off_pin == 6
+
+            config_file.write_text('{"places": [{"name": "la salle"}]}')
+            assert not kang.kang.reload_configuration()
+            assert kang.kang._config["admins"] == ["+33123456789"]
+            assert kang.relays.get_place(5).name == "la salle"
+    finally:
+        kang.kang.apply_configuration({})
+    assert kang.relays.places() == kang.relays.DEFAULT_PLACES
+
+
+@patch("kang.sim")
+def test_help(mock_sim, make_sms):
+    """
+    Test the help messages
+    """
+    kang.kang.process_command(make_sms("+33123456789", "Aide"), MagicMock())
+    mock_sim.Sms.assert_called_with(
+        "+33123456789",
+        "Taper une des 4 commandes suivantes:\n"
+        "- Aide demarrer\n"
+        "- Aide programmer\n"
+        "- Aide arreter\n"
+        "- Aide administrer",
+    )
+
+    kang.kang.process_command(make_sms("+33123456789", "Aide arrêter"), MagicMock())
+    mock_sim.Sms.assert_called_with(
+        "+33123456789",
+        "Taper une des 2 commandes suivantes:\n"
+        "- Arrêter [forcé]\n"
+        "- Arrêter [forcé] dans ...",
+    )
+
+    kang.kang.process_command(make_sms("+33123456789", "Aide administrer"), MagicMock())
+    assert mock_sim.Sms.call_args[0][1].endswith(
+        "- Stats\n- Diffuser ...\n- Afficher la version"
+    )
+
+    kang.kang.process_command(make_sms("+33123456789", "Aide foo"), MagicMock())
+    mock_sim.Sms.assert_called_with(
+        "+33123456789", "Taper une des 0 commandes suivantes:\n"
+    )
+
+
+def test_check_configuration():
+    """
+    Test that the configuration problems are all reported
+    """
+    assert kang.kang.check_configuration({}) == []
+    assert (
+        kang.kang.check_configuration(
+            {
+                "log_level": "info",
+                "places": [{"name": "la salle", "on_pin": 5}],
+                "gpio": {"backend": "mock"},
+                "rate_limit": {"count": 2, "period": 60},
+                "modems": ["/dev/ttyAMA0", "/dev/ttyUSB2"],
+                "delivery_reports": True,
+            }
+        )
+        == []
+    )
+
+    errors = kang.kang.check_configuration(
+        {
+            "log_level": "verbose",
+            "places": [{"name": "la salle"}, {"name": "le hall", "on_pin": "x"}],
+            "gpio": {"backend": "serial"},
+            "catch_up": "later",
+            "rate_limit": {"count": 0, "period": 60},
+            "admins": "+33123456789",
+            "modems": ["/dev/ttyUSB2", "/dev/ttyUSB2"],
+            "delivery_reports": "yes",
+        }
+    )
+    assert len(errors) == 9
+
+
+def test_check_config(tmp_path, capsys):
+    """
+    Test that kang --check-config validates the files without touching the hardware
+    """
+    config_file = tmp_path / "kang.json"
+    auth_file = tmp_path / "authorized.txt"
+    config_file.write_text('{"gpio": {"backend": "mock"}}')
+    auth_file.write_text("+33123456789\n")
+    with patch("kang.kang.CONFIG_FILE", str(config_file)), patch(
+        "kang.kang.AUTH_FILE", str(auth_file)
+    ), patch("kang.kang.App") as mock_app:
+        with pytest.raises(SystemExit) as exit_info:
+            kang.kang.main(["--check-config"])
+        assert exit_info.value.code == 0
+
+        config_file.write_text("{")
+        with pytest.raises(SystemExit) as exit_info:
+            kang.kang.main(["--check-config"])
+        assert exit_info.value.code == 1
+    mock_app.assert_not_called()
+    assert "unreadable" in capsys.readouterr().err
+
+
+def test_scheduler_thread_lazy():
+    """
+    Test that the events file is only loaded when the scheduler is needed
+    """
+    with patch("kang.kang.scheduler_thread", None), patch(
+        "kang.scheduler.SchedulerThread"
+    ) as mock_thread:
+        mock_thread.assert_not_called()
+        scheduler_thread = kang.kang.get_scheduler_thread()
+        assert kang.kang.get_scheduler_thread() is scheduler_thread
+    mock_thread.assert_called_once_with(
+        kang.kang.EVENTS_FILE,
+        [kang.relays.start, kang.relays.stop],
+        kang.kang.clock,
+    )
+
+
+def test_rate_limit(caplog):
+    """
+    Test that the commands of a number are ignored beyond the rate limit
+    """
+    try:
+        kang.kang.apply_configuration({"rate_limit": {"count": 2, "period": 60}})
+        with patch("kang.kang.is_authorized", return_value=True):
+            assert [kang.kang.is_allowed("+33123456789") for _ in range(3)] == [
+                True,
+                True,
+                False,
+            ]
+            assert kang.kang.is_allowed("+33999999999")
+        assert "Rate limit exceeded by +33123456789" in caplog.text
+        assert "Unauthorized" not in caplog.text
+    finally:
+        kang.kang.apply_configuration({})
+
+
+@patch("kang.sim")
+def test_show_stats(mock_sim, make_sms):
+    """
+    Test that the stats command is only available to the administrators
+    """
+    try:
+        kang.kang.apply_configuration({"admins": ["+33123456789"]})
+        kang.kang.handle_command(make_sms("+33999999999", "Stats"))
+        mock_sim.Sms.assert_called_with(
+            "+33999999999", "Commande réservée aux administrateurs"
+        )
+
+        kang.metrics.reset()
+        kang.metrics.observe("sms_read", 0.3)
+        kang.metrics.observe("sms_read", 0.02)
+        kang.metrics.increment("relay_pulses", 2)
+
+        reply = kang.kang.show_stats("+33123456789")
+        assert list(reply.lines) == [
+            "- sms_read: 2 fois, médiane 0.025s, 95% 0.300s, max 0.300s",
+            "- relay_pulses: 2",
+        ]
+        assert "kang_sms_read_seconds_count 2" in kang.metrics.render()
+    finally:
+        kang.kang.apply_configuration({})
+        kang.metrics.reset()
+
+
+def test_broadcast(tmp_path, make_sms):
+    """
+    Test that the administrators can send a message to all the authorized numbers
+    """
+    import kang.emulator
+    import kang.modems
+
+    auth_file = tmp_path / "authorized.txt"
+    auth_file.write_text("+33123456789\n# Gardien\n+33611111111\n\n0622222222\n")
+    try:
+        kang.kang.apply_configuration({"admins": ["+33123456789"]})
+        with patch("kang.kang.AUTH_FILE", str(auth_file)):
+            [reply] = kang.kang.handle_command(
+                make_sms("+33611111111", "Diffuser Chauffage en panne")
+            )
+            assert reply.message == "Commande réservée aux administrateurs"
+
+            [broadcast] = kang.kang.handle_command(
+                make_sms("+33123456789", "diffuser  Chauffage arrêté à 18h")
+            )
+        assert broadcast.numbers == ["+33611111111", "0622222222"]
+        assert broadcast.text == "Chauffage arrêté à 18h"
+        # Only the summary is sent again from the journal
+        assert broadcast.message == "Diffusion:\nEnvoyé à 0/2 numéros"
+
+        # The network failing on a modem, the others send the rest
+        failing = kang.emulator.FakeModem()
+        failing.error = "38"
+        working = kang.emulator.FakeModem()
+        pool = kang.modems.ModemPool(
+            [kang.modems.Modem(failing, "modem1"), kang.modems.Modem(working, "modem2")]
+        )
+        assert pool.send(broadcast).sim is working
+        # Retrying on another modem only sends the summary again
+        broadcast.send(working)
+        assert len(working.segments) == 4
+        assert broadcast.message == "Diffusion:\nEnvoyé à 2/2 numéros"
+
+        # Without any other modem, the numbers left out are reported in the summary
+        def send_all(sim, numbers, text):
+            yield numbers[0], None
+            raise kang.sim.CmsError("38")
+
+        broadcast = kang.kang.Broadcast(
+            "+33123456789", ["+33611111111", "0622222222"], "Chauffage arrêté"
+        )
+        modem = kang.emulator.FakeModem()
+        with patch("kang.sim.sendAllSms", side_effect=send_all):
+            broadcast.send(modem)
+        assert len(modem.segments) == 1
+        assert broadcast.message == (
+            "Diffusion:\nEnvoyé à 1/2 numéros\n"
+            "- 0622222222: CMS error 38: Network out of order"
+        )
+    finally:
+        kang.kang.apply_configuration({})
+
+
+def test_app_loop_profiling_disabled(caplog):
+    """
+    Test that SIGUSR1 doesn't kill the daemon when profiling is disabled
+    """
+    import os
+    import signal
+
+    app = kang.kang.App({})
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) == 1:
+            os.kill(os.getpid(), signal.SIGUSR1)
+        else:
+            raise KeyboardInterrupt()
+
+    handlers = {sig: signal.getsignal(sig) for sig in [signal.SIGHUP, signal.SIGUSR1]}
+    try:
+        with patch("kang.kang.time.sleep", side_effect=sleep):
+            assert app.loop() == 0
+    finally:
+        for sig, handler in handlers.items():
+            signal.signal(sig, handler)
+    assert "Profiling disabled" in caplog.text
+
+
+@patch("kang.relays")
+def test_app_start(mock_relays, tmp_path):
+    """
+    Test that the daemon sets all the configured modems up and stops cleanly
+    """
+    import kang.emulator
+
+    config = {
+        "modems": ["/dev/ttyAMA0", "/dev/ttyUSB2"],
+        "delivery_reports": True,
+        "gpio": {"backend": "mock"},
+        "time_sync_interval": 0,
+    }
+    app = kang.kang.App(config)
+    with patch(
+        "kang.sim.setup", side_effect=lambda dev, reports: kang.emulator.FakeModem()
+    ) as mock_setup, patch.object(kang.sim, "delivery_reports", False), patch(
+        "kang.kang.JOURNAL_FILE", str(tmp_path / "journal.db")
+    ), patch(
+        "kang.kang.get_scheduler_thread"
+    ), patch(
+        "kang.timesync.TimeSync"
+    ) as mock_timesync, patch(
+        "kang.kang.catch_up"
+    ):
+        mock_timesync.return_value.interval = 0
+        app.start()
+        try:
+            assert mock_setup.call_args_list == [
+                call("/dev/ttyAMA0", True),
+                call("/dev/ttyUSB2", True),
+            ]
+            assert kang.sim.delivery_reports
+            assert app.pipeline.tracker is app.tracker is not None
+            assert len(app.pipeline.senders) == 2
+        finally:
+            app.stop()
+    mock_relays.clean.assert_called_once_with()
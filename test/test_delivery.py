@@ -0,0 +1,110 @@
+from unittest.mock import MagicMock, patch
+
+import kang.delivery
+import kang.emulator
+import kang.metrics
+import kang.pipeline
+import kang.sim
+
+from test.test_pipeline import wait_for
+
+# Delivery report of the message 1 to +33123456789, with the status to complete
+REPORT = "0006{:02X}0B913321436587F94210714102004042107141120040{:02X}"
+
+
+def test_tracker():
+    """
+    Test correlating the sent messages with their delivery reports
+    """
+    now = [0]
+    kang.metrics.reset()
+    tracker = kang.delivery.DeliveryTracker(size=3, clock=lambda: now[0])
+    sms = kang.sim.Sms("+33123456789", "Chauffage allumé")
+    sms.references = [1, 2]
+    tracker.sent("modem", sms)
+    assert tracker.state("modem", 1) == kang.delivery.PENDING
+    assert tracker.state("other", 1) is None
+
+    now[0] = 5
+    report = {"reference": 1, "status": 0x00}
+    assert tracker.report("modem", report) == kang.delivery.DELIVERED
+    assert tracker.report("modem", report) is None
+    # The service center is still trying, then gives up
+    assert tracker.report("modem", {"reference": 2, "status": 0x30}) == "pending"
+    assert tracker.report("modem", {"reference": 2, "status": 0x41}) == "failed"
+    assert [
+        (modem, reference) for modem, reference, _ in tracker.entries("failed")
+    ] == [("modem", 2)]
+
+    # The oldest messages are forgotten first
+    sms.references = [3, 4]
+    tracker.sent("modem", sms)
+    assert tracker.state("modem", 1) is None
+    assert [reference for _, reference, _ in tracker.entries(older_than=1)] == [2]
+
+    histograms, counters = kang.metrics.snapshot()
+    assert counters["sms_delivered"] == counters["sms_undelivered"] == 1
+    assert histograms["sms_delivery_report"][1] == 5
+    kang.metrics.reset()
+
+
+def test_unsolicited_report():
+    """
+    Test that the delivery reports received while waiting for the modem are parsed
+    """
+    pdu = REPORT.format(1, 0).encode("ascii")
+    sim = MagicMock()
+    sim.readline.side_effect = [
+        b"\r\n",
+        b"+CDS: 25\r\n",
+        pdu + b"\r\n",
+        b'+CDSI: "SM",3\r\n',
+        b"OK\r\n",
+    ]
+    kang.sim.status_reports.clear()
+    assert kang.sim.fireATCommand(sim, "AT+CMGD=2")
+    assert [report["reference"] for _, report in kang.sim.status_reports] == [1]
+    kang.sim.status_reports.clear()
+
+
+def test_stored_report():
+    """
+    Test that the delivery reports stored while the modem is idle are listed
+    """
+    sim = kang.emulator.FakeModem()
+    with patch("kang.sim.delivery_reports", True):
+        sms = kang.sim.Sms("+33123456789", "Merci")
+        sms.send(sim)
+        sim.report(REPORT.format(1, 0))
+        # The unsolicited result is dropped with the input buffer
+        sms.send(sim)
+
+    # The status report request bit of the first octet is set
+    assert sim.segments[0][2:4] == "21"
+    assert sms.references == [2]
+    [(idx, report)] = kang.sim.readAllSms(sim)
+    assert (idx, report["reference"], report["status"]) == ("1", 1, 0)
+
+
+def test_pipeline_delivery():
+    """
+    Test that the pipeline tracks the replies with the stored reports
+    """
+    sim = kang.emulator.FakeModem()
+    tracker = kang.delivery.DeliveryTracker()
+    pipeline = kang.pipeline.Pipeline(
+        sim, lambda number: True, lambda sms: [], poll_interval=0.05, tracker=tracker
+    )
+    pipeline.start()
+    try:
+        pipeline.send(kang.sim.Sms("+33123456789", "Merci"))
+        pipeline.send(kang.sim.Sms("+33123456789", "De rien"))
+        wait_for(lambda: len(tracker.entries()) == 2)
+        sim.report(REPORT.format(1, 0))
+        sim.report(REPORT.format(2, 0x41))
+        wait_for(lambda: not tracker.entries(kang.delivery.PENDING))
+        wait_for(lambda: not sim.inbox)
+    finally:
+        pipeline.stop()
+    assert tracker.state("modem", 1) == kang.delivery.DELIVERED
+    assert tracker.state("modem", 2) == kang.delivery.FAILED
@@ -0,0 +1,51 @@
+from kang.cms_error import CmsError
+import kang.errors
+
+
+def _raise(err):
+    try:
+        raise err
+    except Exception as caught:
+        return caught
+
+
+def test_aggregate_errors():
+    """
+    Test that only the first occurrence of an error is reported before the digest
+    """
+    now = [0.0]
+    aggregator = kang.errors.ErrorAggregator(600, clock=lambda: now[0])
+
+    message = aggregator.record(_raise(CmsError("38")), "sender")
+    assert message == (
+        "Erreur inattendue: veuillez consulter les logs.\n"
+        " > sender: CmsError: CMS error 38: Network out of order"
+    )
+    for _ in range(4):
+        assert aggregator.record(_raise(CmsError("38")), "sender") is None
+
+    # Another code, type or stage is another error
+    assert aggregator.record(_raise(CmsError("42")), "sender")
+    assert aggregator.record(_raise(ValueError("oops")), "sender")
+    assert aggregator.record(_raise(ValueError("oops")), "reader")
+    assert aggregator.record(_raise(ValueError("oops")), "reader") is None
+
+    assert aggregator.digest() is None
+    now[0] = 601
+    assert aggregator.digest() == (
+        "Erreurs répétées depuis 10 min:\n"
+        "- 4 fois sender: CmsError: CMS error 38: Network out of order\n"
+        "- 1 fois reader: ValueError: oops"
+    )
+
+    # The repeating errors stay silenced, the others are reported again
+    assert aggregator.record(_raise(CmsError("38")), "sender") is None
+    assert aggregator.record(_raise(CmsError("42")), "sender")
+    now[0] = 1300
+    assert aggregator.digest() == (
+        "Erreurs répétées depuis 11 min:\n"
+        "- 1 fois sender: CmsError: CMS error 38: Network out of order"
+    )
+    now[0] = 2000
+    assert aggregator.digest() is None
+    assert aggregator.record(_raise(CmsError("38")), "sender")
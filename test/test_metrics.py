@@ -0,0 +1,47 @@
+import kang.metrics
+
+
+def test_histogram():
+    """
+    Test the buckets and quantiles of the histograms
+    """
+    histogram = kang.metrics.Histogram((0.1, 1))
+    for value in [0.05, 0.1, 0.5, 2]:
+        histogram.observe(value)
+    assert histogram.counts == [2, 1, 1]
+    assert histogram.quantile(0.5) == 0.1
+    assert histogram.quantile(0.75) == 1
+    assert histogram.quantile(1) == 2
+    assert kang.metrics.Histogram().quantile(0.5) is None
+
+    # The bucket bound isn't above the largest value
+    histogram = kang.metrics.Histogram((0.1, 1))
+    histogram.observe(0.3)
+    assert histogram.quantile(0.95) == 0.3
+
+
+def test_write_textfile(tmp_path):
+    """
+    Test the Prometheus text format export
+    """
+    kang.metrics.reset()
+    try:
+        kang.metrics.observe("sms_send", 0.2)
+        kang.metrics.increment("relay_pulses")
+        kang.metrics.increment("relay_pulses")
+        path = tmp_path / "kang.prom"
+        kang.metrics.write_textfile(str(path))
+        lines = path.read_text().splitlines()
+    finally:
+        kang.metrics.reset()
+
+    assert lines[0] == "# TYPE kang_sms_send_seconds histogram"
+    assert 'kang_sms_send_seconds_bucket{le="0.1"} 0' in lines
+    assert 'kang_sms_send_seconds_bucket{le="0.25"} 1' in lines
+    assert 'kang_sms_send_seconds_bucket{le="+Inf"} 1' in lines
+    assert "kang_sms_send_seconds_count 1" in lines
+    assert lines[-2:] == [
+        "# TYPE kang_relay_pulses_total counter",
+        "kang_relay_pulses_total 2",
+    ]
+    assert list(tmp_path.iterdir()) == [path]
@@ -0,0 +1,96 @@
+from unittest.mock import MagicMock
+import pytest
+
+from kang.cms_error import CmsError
+import kang.emulator
+import kang.modems
+import kang.pipeline
+import kang.sim
+
+from test.test_pipeline import wait_for
+
+PDU = "07911326040000F0040B911346610089F60000208062917314080CC8F71D14969741F977FD07"
+
+
+def make_pool(count, clock=None):
+    modems = [
+        kang.modems.Modem(kang.emulator.FakeModem(), "modem{}".format(i), clock=clock)
+        for i in range(count)
+    ]
+    return kang.modems.ModemPool(modems)
+
+
+def test_pool_balance():
+    """
+    Test that the sent messages are spread over the modems
+    """
+    pool = make_pool(3)
+    for _ in range(6):
+        pool.send(kang.sim.Sms("+33123456789", "Merci"))
+    assert [len(modem.sim.segments) for modem in pool.modems] == [2, 2, 2]
+
+
+def test_pool_failover():
+    """
+    Test that a failing modem is left aside and its messages sent by the others
+    """
+    now = [0]
+    pool = make_pool(2, clock=lambda: now[0])
+    failing, working = pool.modems
+    failing.sim.error = "38"
+
+    for _ in range(kang.modems.MAX_FAILURES):
+        failing.sent = working.sent = 0
+        assert pool.send(kang.sim.Sms("+33123456789", "Merci")) is working
+    assert not failing.healthy()
+    assert pool.readable() == [working]
+    assert pool.health()[0]["last_error"] == (
+        "CmsError: CMS error 38: Network out of order"
+    )
+
+    # The failing modem isn't tried while left aside
+    pool.send(kang.sim.Sms("+33123456789", "Merci"))
+    assert failing.failures == kang.modems.MAX_FAILURES
+
+    # Errors caused by the message are not retried on the other modems
+    working.sim.error = "304"
+    with pytest.raises(CmsError):
+        pool.send(kang.sim.Sms("+33123456789", "Merci"))
+
+    # All the modems failing
+    working.sim.error = "38"
+    with pytest.raises(CmsError):
+        pool.send(kang.sim.Sms("+33123456789", "Merci"))
+
+    # The modem is tried again after the cooldown
+    now[0] = kang.modems.COOLDOWN
+    failing.sim.error = None
+    assert pool.send(kang.sim.Sms("+33123456789", "Merci")) is failing
+    assert failing.healthy()
+
+
+def test_pipeline_modems():
+    """
+    Test that all the modems are polled and each message deleted from its modem
+    """
+    pool = make_pool(2)
+    for modem in pool.modems:
+        modem.sim.receive(PDU)
+        modem.sim.receive(PDU)
+    reply = MagicMock()
+    pipeline = kang.pipeline.Pipeline(
+        pool, lambda number: True, lambda sms: [reply], poll_interval=0.05
+    )
+    assert [stage["name"] for stage in pipeline.health()] == [
+        "reader",
+        "dispatcher",
+        "sender",
+        "sender 2",
+    ]
+    pipeline.start()
+    try:
+        wait_for(lambda: not any(modem.sim.inbox for modem in pool.modems))
+    finally:
+        pipeline.stop()
+    assert reply.send.call_count == 4
+    assert not pipeline.reader.in_flight
@@ -0,0 +1,95 @@
+import datetime
+
+import pytest
+
+import kang.pdu
+
+UTC = datetime.timezone.utc
+
+
+@pytest.mark.parametrize(
+    "pdu,expected",
+    [
+        (
+            "07911326040000F0040B911346610089F60000208062917314080CC8F71D14969741F977FD07",
+            {
+                "date": datetime.datetime(2002, 8, 26, 19, 37, 41, tzinfo=UTC),
+                "sender": "+31641600986",
+                "content": "How are you?",
+                "partial": False,
+            },
+        ),
+        (
+            "07919730071111F1400B919746121610F20008507011713303801C050003040301003100200032002000330020004500EA00E800E000E7",
+            {
+                "date": datetime.datetime(2005, 7, 11, 15, 33, 30, tzinfo=UTC),
+                "sender": "+79642161012",
+                "content": "1 2 3 Eêèàç",
+                "partial": {"reference": "4-3", "parts_count": 3, "part_number": 1},
+            },
+        ),
+        (
+            "0791447758100650440C914477582342520000210121717245400E050003020201C2E230C86C2E03",
+            {
+                "date": datetime.datetime(2012, 10, 12, 16, 27, 54, tzinfo=UTC),
+                "sender": "+447785322425",
+                "content": "aba ffe",
+                "partial": {"reference": "2-2", "parts_count": 2, "part_number": 1},
+            },
+        ),
+        (
+            "0791448720003023240DD0E474D81C0EBB010000111011315214000BE474D81C0EBB5DE3771B",
+            {
+                "date": datetime.datetime(2011, 1, 11, 13, 25, 41, tzinfo=UTC),
+                "sender": "diafaan",
+                "content": "diafaan.com",
+                "partial": False,
+            },
+        ),
+    ],
+)
+def test_decode_deliver(pdu, expected):
+    """
+    Test decoding the received messages PDUs
+    """
+    assert kang.pdu.decode_deliver(pdu.encode("ascii")) == expected
+
+
+def test_decode_deliver_invalid():
+    """
+    Test that the invalid PDUs raise ValueError
+    """
+    for pdu in [b"0041007200", b"zz", b"07911326040000F0040B9113466100", b""]:
+        with pytest.raises(ValueError):
+            kang.pdu.decode_deliver(pdu)
+
+
+def test_pdu_buffer():
+    """
+    Test collecting the PDU from the modem lines
+    """
+    buffer = kang.pdu.PduBuffer(size=4)
+    buffer.append(b"0011\r\n")
+    buffer.append(b"2233\r\n")
+    assert bytes(buffer.data()) == b"00112233"
+    buffer.clear()
+    buffer.append(b"AB\r\n")
+    assert bytes(buffer.data()) == b"AB"
+
+
+def test_decode_status_report():
+    """
+    Test decoding the delivery reports PDUs
+    """
+    pdu = b"00060D0B913321436587F9421071410200404210714112004000"
+    assert kang.pdu.is_status_report(pdu)
+    assert not kang.pdu.is_status_report(b"0791447758100650440C91447758")
+    assert kang.pdu.decode_status_report(pdu) == {
+        "reference": 13,
+        "recipient": "+33123456789",
+        "date": datetime.datetime(2024, 1, 17, 13, 20, tzinfo=UTC),
+        "discharge": datetime.datetime(2024, 1, 17, 13, 21, tzinfo=UTC),
+        "status": 0,
+    }
+    with pytest.raises(ValueError):
+        kang.pdu.decode_status_report(pdu[:-4])
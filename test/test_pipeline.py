@@ -0,0 +1,292 @@
+from unittest.mock import MagicMock, patch
+import datetime
+import time
+import pytest
+
+import kang.journal
+import kang.pipeline
+import kang.sim
+
+
+def wait_for(predicate, timeout=5):
+    """
+    Wait for the predicate to be true
+    """
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert predicate()
+
+
+@pytest.fixture
+def modem():
+    """
+    Fake modem with messages to read
+    """
+    messages = {}
+
+    def read_all(sim, skip):
+        return [(idx, sms) for idx, sms in messages.items() if idx not in skip]
+
+    def delete(sim, idx):
+        messages.pop(idx, None)
+
+    with patch("kang.sim.readAllSms", side_effect=read_all), patch(
+        "kang.sim.Sms.delete", side_effect=delete
+    ):
+        yield messages
+
+
+def test_pipeline(modem, make_sms):
+    """
+    Test that the messages are read, dispatched, answered and deleted
+    """
+    modem.update(
+        {
+            "1": make_sms("+33123456789", "Merci"),
+            "2": make_sms("+33999999999", "Merci"),
+            "3": None,
+            "4": make_sms("+33123456789", "Boom"),
+        }
+    )
+    reply = MagicMock()
+
+    def handle(sms):
+        if sms.message == "Boom":
+            raise RuntimeError("Boom")
+        return [reply]
+
+    errors = []
+    pipeline = kang.pipeline.Pipeline(
+        MagicMock(),
+        lambda number: number == "+33123456789",
+        handle,
+        poll_interval=0.05,
+        on_error=lambda stage, err: errors.append((stage.stage_name, str(err))),
+    )
+    pipeline.start()
+    try:
+        wait_for(lambda: not modem)
+    finally:
+        pipeline.stop()
+
+    reply.send.assert_called_once_with(pipeline.sim)
+    assert sorted(errors) == [
+        ("dispatcher", "Boom"),
+        ("reader", "Invalid PDU for messages 3 on modem"),
+    ]
+    health = {stage["name"]: stage for stage in pipeline.health()}
+    assert health["dispatcher"]["processed"] == 2
+    assert health["dispatcher"]["errors"] == 1
+    assert health["reader"]["errors"] == 1
+    assert not pipeline.reader.in_flight
+
+
+def test_pipeline_backpressure(modem, make_sms):
+    """
+    Test that the reader stops reading when the next stages are full
+    """
+    modem.update({str(i): make_sms("+33123456789", "Merci") for i in range(10)})
+    pipeline = kang.pipeline.Pipeline(
+        MagicMock(), lambda number: True, lambda sms: [], queue_size=2
+    )
+    pipeline.reader.start()
+    try:
+        wait_for(lambda: pipeline.commands.full())
+        time.sleep(0.1)
+        assert len(pipeline.reader.in_flight) == 3
+    finally:
+        pipeline.stop()
+
+
+def test_pipeline_read_backoff():
+    """
+    Test that a modem failing to list its messages is polled less and less often
+    """
+    pipeline = kang.pipeline.Pipeline(
+        MagicMock(), lambda number: True, MagicMock(), poll_interval=0.05
+    )
+    with patch("kang.sim.readAllSms", side_effect=kang.sim.CmsError("500")) as read_all:
+        pipeline.start()
+        try:
+            time.sleep(0.5)
+        finally:
+            pipeline.stop()
+
+    # 0.05, 0.1, 0.2 then 0.4s between the polls
+    assert 2 <= read_all.call_count <= 5
+    assert pipeline.reader.failed_polls >= 2
+
+
+def test_journal(tmp_path):
+    """
+    Test the states of the journaled messages
+    """
+    journal = kang.journal.Journal(str(tmp_path / "journal.db"))
+    date = datetime.datetime(2024, 1, 7, 8, 30)
+    sms = kang.sim.Sms("+33123456789", "Merci", date)
+    key = journal.key(sms)
+    assert key == journal.key(kang.sim.Sms("+33123456789", "Merci", date))
+    assert key != journal.key(
+        kang.sim.Sms("+33123456789", "Merci", date + datetime.timedelta(minutes=1))
+    )
+
+    assert journal.state(key) is None
+    journal.received(key, sms)
+    assert journal.state(key) == kang.journal.RECEIVED
+    journal.executed(key, [kang.sim.Sms("+33123456789", "De rien")])
+    assert journal.state(key) == kang.journal.EXECUTED
+    assert journal.replies(key) == [("+33123456789", "De rien")]
+    journal.replied(key)
+    assert journal.state(key) == kang.journal.REPLIED
+
+    other = journal.key(kang.sim.Sms("+33123456789", "Boom", date))
+    journal.received(other, sms)
+    assert [journal.failed(other) for _ in range(kang.journal.MAX_ATTEMPTS)] == [
+        True,
+        True,
+        False,
+    ]
+    assert journal.state(other) == kang.journal.FAILED
+
+    journal.prune(0)
+    assert journal.state(key) is None
+    journal.close()
+
+
+def test_pipeline_journal(modem, tmp_path):
+    """
+    Test that the messages left on the modem after a crash are not executed again
+    """
+    journal = kang.journal.Journal(str(tmp_path / "journal.db"))
+    date = datetime.datetime(2024, 1, 7, 8, 30)
+    executed = kang.sim.Sms("+33123456789", "Allumer l'église", date)
+    replied = kang.sim.Sms("+33123456789", "Merci", date)
+    new = kang.sim.Sms("+33123456789", "Merci", date + datetime.timedelta(minutes=1))
+
+    key = journal.key(executed)
+    journal.received(key, executed)
+    journal.executed(key, [kang.sim.Sms("+33123456789", "Chauffage allumé")])
+    journal.received(journal.key(replied), replied)
+    journal.replied(journal.key(replied))
+    modem.update({"1": executed, "2": replied, "3": new})
+
+    sent = []
+    handle = MagicMock(return_value=[kang.sim.Sms("+33123456789", "De rien")])
+    pipeline = kang.pipeline.Pipeline(
+        MagicMock(), lambda number: True, handle, poll_interval=0.05, journal=journal
+    )
+    with patch.object(
+        kang.sim.Sms,
+        "send",
+        autospec=True,
+        side_effect=lambda sms, sim: sent.append(sms),
+    ):
+        pipeline.start()
+        try:
+            wait_for(lambda: not modem)
+        finally:
+            pipeline.stop()
+
+    handle.assert_called_once_with(new)
+    assert sorted(sms.message for sms in sent) == ["Chauffage allumé", "De rien"]
+    for sms in [executed, replied, new]:
+        assert journal.state(journal.key(sms)) == kang.journal.REPLIED
+    journal.close()
+
+
+def test_pipeline_journal_retry(modem, tmp_path):
+    """
+    Test that a message failing before its command runs is tried again before being
+    dropped
+    """
+    journal = kang.journal.Journal(str(tmp_path / "journal.db"))
+    sms = kang.sim.Sms("+33123456789", "Boom", datetime.datetime(2024, 1, 7, 8, 30))
+    modem["1"] = sms
+    authorize = MagicMock(side_effect=RuntimeError("Boom"))
+    handle = MagicMock()
+    pipeline = kang.pipeline.Pipeline(
+        MagicMock(), authorize, handle, poll_interval=0.05, journal=journal
+    )
+    pipeline.start()
+    try:
+        wait_for(lambda: not modem)
+    finally:
+        pipeline.stop()
+
+    assert authorize.call_count == kang.journal.MAX_ATTEMPTS
+    handle.assert_not_called()
+    assert journal.state(journal.key(sms)) == kang.journal.FAILED
+    journal.close()
+
+
+def test_pipeline_journal_command_failure(modem, tmp_path):
+    """
+    Test that a command failing while executing is not run again
+    """
+    journal = kang.journal.Journal(str(tmp_path / "journal.db"))
+    sms = kang.sim.Sms("+33123456789", "Boom", datetime.datetime(2024, 1, 7, 8, 30))
+    modem["1"] = sms
+    handle = MagicMock(side_effect=RuntimeError("Boom"))
+    sent = []
+    pipeline = kang.pipeline.Pipeline(
+        MagicMock(), lambda number: True, handle, poll_interval=0.05, journal=journal
+    )
+    with patch.object(
+        kang.sim.Sms,
+        "send",
+        autospec=True,
+        side_effect=lambda sms, sim: sent.append(sms),
+    ):
+        pipeline.start()
+        try:
+            wait_for(lambda: not modem and sent)
+        finally:
+            pipeline.stop()
+
+    handle.assert_called_once_with(sms)
+    assert journal.state(journal.key(sms)) == kang.journal.FAILED
+    assert [(reply.number, reply.message) for reply in sent] == [
+        (
+            "+33123456789",
+            "Commande interrompue, vérifier l'état avant de la renvoyer: Boom",
+        )
+    ]
+    journal.close()
+
+
+def test_pipeline_journal_interrupted(modem, tmp_path):
+    """
+    Test that a command interrupted by a crash is not run again after the restart
+    """
+    journal = kang.journal.Journal(str(tmp_path / "journal.db"))
+    sms = kang.sim.Sms(
+        "+33123456789", "Allumer l'église", datetime.datetime(2024, 1, 7, 8, 30)
+    )
+    key = journal.key(sms)
+    journal.received(key, sms)
+    journal.executing(key)
+    modem["1"] = sms
+    handle = MagicMock()
+    sent = []
+    pipeline = kang.pipeline.Pipeline(
+        MagicMock(), lambda number: True, handle, poll_interval=0.05, journal=journal
+    )
+    with patch.object(
+        kang.sim.Sms,
+        "send",
+        autospec=True,
+        side_effect=lambda sms, sim: sent.append(sms),
+    ):
+        pipeline.start()
+        try:
+            wait_for(lambda: not modem and sent)
+        finally:
+            pipeline.stop()
+
+    handle.assert_not_called()
+    assert journal.state(key) == kang.journal.FAILED
+    assert [reply.message for reply in sent] == [
+        "Commande interrompue, vérifier l'état avant de la renvoyer: Allumer l'église"
+    ]
+    journal.close()
@@ -0,0 +1,54 @@
+import threading
+import time
+
+import kang.profiling
+
+
+def busy_loop(stopping):
+    while not stopping.is_set():
+        sum(range(1000))
+
+
+def test_sampler():
+    """
+    Test that the stacks of the other threads are sampled
+    """
+    stopping = threading.Event()
+    thread = threading.Thread(target=busy_loop, args=(stopping,), name="Busy Thread")
+    thread.start()
+    try:
+        sampler = kang.profiling.Sampler(0.2, interval=0.005)
+        sampler.start()
+        sampler.join()
+    finally:
+        stopping.set()
+        thread.join()
+
+    assert sampler.samples > 0
+    assert sampler.threads["Busy Thread"] == sampler.samples
+    assert any(location.startswith("busy_loop ") for location in sampler.cumulative)
+    assert "Busy Thread" in sampler.report()
+
+
+def test_profiler(tmp_path):
+    """
+    Test the reports written by the profiler
+    """
+    assert kang.profiling.Profiler.from_config({}, environ={}) is None
+
+    profiler = kang.profiling.Profiler.from_config(
+        {"cpu_window": 0.1}, environ={"KANG_PROFILE_DIR": str(tmp_path)}
+    )
+    try:
+        data = [bytearray(1000) for _ in range(100)]
+        profiler.dump()
+        assert not profiler.start_cpu()
+        profiler._sampler.join()
+    finally:
+        profiler.stop()
+
+    reports = sorted(path.name.split("-")[0] for path in tmp_path.iterdir())
+    assert reports == ["cpu", "memory"]
+    memory = next(tmp_path.glob("memory-*.txt")).read_text()
+    assert "test_profiling.py" in memory
+    assert len(data) == 100
@@ -0,0 +1,182 @@
+from unittest.mock import patch
+import json
+import time
+import pytest
+
+import kang.gpio
+import kang.relays
+
+
+@pytest.fixture
+def backend():
+    """
+    In-memory GPIO backend
+    """
+    backend = kang.gpio.MockBackend()
+    with patch("kang.relays._backend", None):
+        kang.relays.setup(backend)
+        yield backend
+
+
+@pytest.fixture
+def driver(backend):
+    """
+    Fast pulse driver
+    """
+    driver = kang.relays.PulseDriver(width=0.01, window=0.05)
+    with patch("kang.relays._driver", driver), patch.dict(
+        "kang.relays._state", clear=True
+    ), patch("kang.relays._state_path", None):
+        yield driver
+    driver.stop()
+
+
+def levels(backend):
+    """
+    @return: the recorded pins levels changes, without their time
+    """
+    return [(pins, high) for _, pins, high in backend.history]
+
+
+def test_start_places_single_pulse(driver, backend):
+    """
+    Test that starting several places pulses all their pins at once
+    """
+    kang.relays.start(kang.relays.CHURCH, kang.relays.HALL).result()
+
+    assert levels(backend) == [
+        ([22, 24], False),
+        ([22, 24], True),
+    ]
+
+
+def test_concurrent_requests_batched(driver, backend):
+    """
+    Test that concurrent requests are pulsed together unless they conflict
+    """
+    futures = [
+        kang.relays.start(kang.relays.CHURCH),
+        kang.relays.stop(kang.relays.HALL),
+        kang.relays.stop(kang.relays.CHURCH),
+    ]
+    for future in futures:
+        future.result()
+
+    assert levels(backend) == [
+        ([22, 25], False),
+        ([22, 25], True),
+        ([23], False),
+        ([23], True),
+    ]
+
+
+def test_unknown_place(driver):
+    """
+    Test that unknown places are rejected
+    """
+    with pytest.raises(ValueError):
+        kang.relays.start(42)
+
+
+def test_removed_place_skipped(driver, backend):
+    """
+    Test that the places removed from the configuration are skipped
+    """
+    kang.relays.start(42, kang.relays.CHURCH).result()
+
+    assert levels(backend) == [([22], False), ([22], True)]
+
+
+def test_redundant_pulses_suppressed(driver, backend, tmp_path):
+    """
+    Test that places already in the requested state are not pulsed unless forced
+    """
+    state_file = str(tmp_path / "relays.json")
+    kang.relays.load_state(state_file)
+
+    kang.relays.start(kang.relays.CHURCH).result()
+    kang.relays.start(kang.relays.CHURCH, kang.relays.HALL).result()
+    kang.relays.start(kang.relays.HALL).result()
+    kang.relays.start(kang.relays.HALL, force=True).result()
+
+    assert levels(backend) == [
+        ([22], False),
+        ([22], True),
+        ([24], False),
+        ([24], True),
+        ([24], False),
+        ([24], True),
+    ]
+
+    with open(state_file, "r") as fd:
+        persisted = json.load(fd)
+    assert persisted["22"]["on"] and persisted["24"]["on"]
+
+    kang.relays.stop(kang.relays.CHURCH).result()
+    kang.relays.load_state(state_file)
+    state = kang.relays.state()
+    assert not state[kang.relays.CHURCH]["on"]
+    assert state[kang.relays.HALL]["on"]
+
+
+def test_driver_restart(driver, backend):
+    """
+    Test that a pulse requested once the thread exited starts a new one
+    """
+    kang.relays.start(kang.relays.CHURCH).result(timeout=1)
+    thread = driver._thread
+    with driver._condition:
+        driver._stopping = True
+        driver._condition.notify()
+    thread.join(timeout=1)
+    assert not thread.is_alive()
+
+    assert kang.relays.stop(kang.relays.CHURCH).result(timeout=1) == [23]
+    assert driver._thread is not thread
+
+
+def test_reconfigure_between_pulses(driver, backend):
+    """
+    Test that the pins are set up again only once the current pulse is done
+    """
+    slow = kang.relays.PulseDriver(width=0.2, window=0)
+    with patch("kang.relays._driver", slow):
+        future = kang.relays.start(kang.relays.CHURCH)
+        deadline = time.monotonic() + 5
+        while not backend.history and time.monotonic() < deadline:
+            time.sleep(0.01)
+        places = kang.relays.places()
+        try:
+            kang.relays.reconfigure(places + [kang.relays.Place("la salle", 5)])
+            assert future.done()
+            assert backend.levels[5] and backend.levels[6]
+        finally:
+            kang.relays.set_places(places)
+            slow.stop()
+
+    assert levels(backend) == [([22], False), ([22], True)]
+
+
+def test_mock_backend_pulses(driver, backend):
+    """
+    Test that the mock backend records the pulses duration
+    """
+    kang.relays.stop(kang.relays.CHURCH, kang.relays.HALL).result()
+
+    pulses = backend.pulses()
+    assert [pins for pins, _ in pulses] == [[23, 25]]
+    assert pulses[0][1] >= 0.01
+    assert backend.levels == {22: True, 23: True, 24: True, 25: True}
+
+
+def test_incomplete_backend():
+    """
+    Test that a backend missing a method can't be created
+    """
+
+    class Backend(kang.gpio.Backend):
+        def setup(self, pins):
+            pass
+
+    with pytest.raises(TypeError):
+        Backend()
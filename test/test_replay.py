@@ -0,0 +1,61 @@
+import json
+
+import kang.kang
+import kang.relays
+import kang.replay
+
+
+def test_replay(tmp_path):
+    """
+    Test that the recorded messages are processed with the simulated modem and clock
+    """
+    path = tmp_path / "traffic.jsonl"
+    records = [
+        {"number": "+33123456789", "message": "Arrêter", "date": 1704610800},
+        {
+            "number": "+33123456789",
+            "message": "Démarrer dans le hall le 7/01/2024 à 10h pendant 1h",
+            "date": 1704610860,
+        },
+        {"message": "Etat"},
+        {"body": "Bonjour"},
+        {"title": "No text"},
+    ]
+    path.write_text("\n".join(json.dumps(record) for record in records))
+    messages = kang.replay.load_messages(str(path), interval=60)
+    assert [when for when, _ in messages] == [
+        1704610800,
+        1704610860,
+        1704610920,
+        1704610980,
+    ]
+    assert messages[2][1].number == kang.replay.DEFAULT_NUMBER
+
+    # Let the scheduled events run before the last message
+    messages[-1] = (messages[-1][0] + 4 * 3600, messages[-1][1])
+    scheduler_thread = kang.kang.scheduler_thread
+    backend = kang.relays.set_backend(None)
+    state = kang.relays.set_state({kang.relays.HALL: {"on": True, "since": 0}})
+    try:
+        report = kang.replay.Replay().run(messages)
+
+        assert kang.kang.scheduler_thread is scheduler_thread
+        assert kang.relays.set_backend(None) is None
+        assert kang.relays.state() == {kang.relays.HALL: {"on": True, "since": 0}}
+    finally:
+        kang.relays.set_backend(backend)
+        kang.relays.set_state(*state)
+    assert report.messages == 4
+    assert report.errors == 0
+    assert sorted(report.latencies) == [
+        "schedule_heating",
+        "show_state",
+        "stop_heating",
+        "unknown",
+    ]
+    assert report.sms == 4
+    assert report.segments == 4
+    # Stopping both places, then the scheduled start and stop of the hall
+    assert report.pulses == 3
+    assert report.scheduled == 0
+    assert "Relay pulses: 3" in report.format()
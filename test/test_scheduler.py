@@ -3,6 +3,7 @@ import time
 import os
 
 from test.conftest import EVENTS_FILE, start, stop
+import kang.clock
 import kang.scheduler
 
 EVENTS_DATA = '''1706514300.0,10,start,[1],{"foo": "bar"}
@@ -91,3 +92,174 @@ def test_scheduler_thread_cancel(make_scheduler_thread):
 
     assert len(scheduler_thread.events) == 0
     assert_event_file("")
+
+
+def test_persisted_scheduler_events_snapshot(make_persisted_scheduler):
+    '''
+    Test that the events snapshot is only rebuilt when the queue changes
+    '''
+    scheduler = make_persisted_scheduler(EVENTS_DATA)
+
+    snapshot = scheduler.events
+    assert scheduler.events is snapshot
+
+    event = scheduler.enterabs(1706521500.0, 10, start, (2,))
+    assert scheduler.events is not snapshot
+    assert scheduler.events[-1] is event
+
+    snapshot = scheduler.events
+    scheduler.cancel(event)
+    assert scheduler.events is not snapshot
+    assert len(scheduler.events) == 2
+
+
+def test_persisted_scheduler_catch_up(make_persisted_scheduler):
+    '''
+    Test that the overdue events are coalesced into one action per place
+    '''
+    calls = []
+
+    def start(place):
+        calls.append(("start", place))
+
+    def stop(place):
+        calls.append(("stop", place))
+
+    with open(EVENTS_FILE, "w") as fd:
+        fd.write(
+            "100.0,0,start,[1],{}\n"
+            "200.0,0,stop,[1],{}\n"
+            "300.0,0,start,[1],{}\n"
+            "150.0,0,start,[2],{}\n"
+            "250.0,0,stop,[2],{}\n"
+            "500.0,0,stop,[1],{}\n"
+        )
+    scheduler = kang.scheduler.PersistedScheduler(EVENTS_FILE, [start, stop])
+
+    applied, skipped = scheduler.catch_up("coalesce", now=400.0)
+
+    assert calls == [("start", 1), ("stop", 2)]
+    assert [event.time for event in applied] == [300.0, 250.0]
+    assert [event.time for event in skipped] == [100.0, 150.0, 200.0]
+    assert [event.time for event in scheduler.events] == [500.0]
+    assert_event_file("500.0,0,stop,[1],{}\n")
+
+
+def test_persisted_scheduler_catch_up_skip(make_persisted_scheduler):
+    '''
+    Test that the overdue events are dropped with the skip policy
+    '''
+    scheduler = make_persisted_scheduler(EVENTS_DATA)
+
+    applied, skipped = scheduler.catch_up("skip", now=1706517900.0)
+
+    assert applied == []
+    assert len(skipped) == 2
+    assert len(scheduler.events) == 0
+
+
+def test_persisted_scheduler_select(make_persisted_scheduler):
+    '''
+    Test filtering and paging the scheduled events
+    '''
+    scheduler = make_persisted_scheduler("")
+    for i in range(10):
+        scheduler.enterabs(1000.0 + i * 100, 0, start, (i % 2,))
+
+    events, cursor = scheduler.select(argument=(1,), start=1200.0, limit=2)
+    assert [event.time for event in events] == [1300.0, 1500.0]
+
+    events, cursor = scheduler.select(argument=(1,), start=1200.0, limit=2, after=cursor)
+    assert [event.time for event in events] == [1700.0, 1900.0]
+    assert cursor is None
+
+    events, cursor = scheduler.select(start=1200.0, end=1500.0)
+    assert [event.time for event in events] == [1200.0, 1300.0, 1400.0]
+    assert cursor is None
+
+
+def test_persisted_scheduler_simulated_clock(tmp_path):
+    '''
+    Test running months of events on a simulated clock without waiting
+    '''
+    clock = kang.clock.SimulatedClock(1704067200.0)
+    runs = []
+
+    def start(place):
+        runs.append((clock.time(), "start", place))
+
+    def stop(place):
+        runs.append((clock.time(), "stop", place))
+
+    scheduler = kang.scheduler.PersistedScheduler(
+        str(tmp_path / "events.txt"), [start, stop], clock
+    )
+    for day in range(90):
+        when = 1704067200.0 + day * 86400 + 8 * 3600
+        scheduler.enterabs(when, 0, start, (22,))
+        scheduler.enterabs(when + 3600, 0, stop, (22,))
+
+    begin = time.monotonic()
+    scheduler.run_until(1704067200.0 + 45 * 86400)
+    assert time.monotonic() - begin < 5
+    assert len(runs) == 90
+    assert runs[0] == (1704067200.0 + 8 * 3600, "start", 22)
+    assert clock.time() == 1704067200.0 + 45 * 86400
+    assert len(scheduler.events) == 90
+
+    scheduler.run_until(1704067200.0 + 365 * 86400)
+    assert len(runs) == 180
+    assert scheduler.empty()
+
+
+
+def test_persisted_scheduler_future_failure(tmp_path, caplog):
+    '''
+    Test that the failures of the actions returning a Future are logged
+    '''
+    import concurrent.futures
+
+    def start(place):
+        future = concurrent.futures.Future()
+        future.set_exception(RuntimeError("GPIO busy"))
+        return future
+
+    clock = kang.clock.SimulatedClock(1704067200.0)
+    scheduler = kang.scheduler.PersistedScheduler(
+        str(tmp_path / "events.txt"), [start, stop], clock
+    )
+    scheduler.enterabs(1704067260.0, 0, start, (22,))
+    scheduler.run_until(1704067320.0)
+    assert "failed: RuntimeError: GPIO busy" in caplog.text
+
+
+def test_scheduler_thread_failing_event(tmp_path, caplog):
+    '''
+    Test that a failing event doesn't stop the scheduler thread
+    '''
+    runs = []
+
+    def start(place):
+        raise ValueError("Unknown places: [{}]".format(place))
+
+    def stop(place):
+        runs.append(place)
+
+    clock = kang.clock.SimulatedClock(1704067200.0)
+    thread = kang.scheduler.SchedulerThread(
+        str(tmp_path / "events.txt"), [start, stop], clock
+    )
+    thread.enterabs(1704067210.0, 0, start, (5,))
+    thread.enterabs(1704067220.0, 0, stop, (22,))
+    clock.advance(30)
+    thread.start()
+    try:
+        deadline = time.monotonic() + 5
+        while not runs and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert runs == [22]
+        assert thread.is_alive()
+    finally:
+        thread.stop()
+        thread.join()
+    assert "Unknown places: [5]" in caplog.text
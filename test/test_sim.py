@@ -1,8 +1,11 @@
+import datetime
 from unittest.mock import MagicMock, call
 import pytest
 
 from kang.cms_error import CmsError
 
+import kang.emulator
+import kang.encoding
 import kang.sim
 
 
@@ -91,3 +94,132 @@ def test_sendsms_valid():
     ]
 
     assert expected_writes == mock_sim.write.call_args_list
+
+
+def test_split_segments():
+    """
+    Test splitting long messages according to their alphabet
+    """
+    assert [160, 40] == [
+        len(chunk) for chunk in kang.encoding.split_segments("a" * 200)
+    ]
+    assert [70, 70, 10] == [
+        len(chunk) for chunk in kang.encoding.split_segments("ê" * 150)
+    ]
+    # Extension table characters use two septets
+    assert [80, 20] == [len(chunk) for chunk in kang.encoding.split_segments("€" * 100)]
+    assert [60, 10] == [
+        len(chunk) for chunk in kang.encoding.split_segments("ê" * 70, prefix="x" * 10)
+    ]
+
+
+def test_gettime():
+    """
+    Test reading the network time, with a negative time zone
+    """
+    mock_sim = MagicMock()
+    mock_sim.readline.side_effect = [
+        b"\r\n",
+        b'+CCLK: "24/01/07,09:58:42-12"\r\n',
+        b"\r\n",
+        b"OK\r\n",
+    ]
+    assert kang.sim.getTime(mock_sim) == datetime.datetime(2024, 1, 7, 9, 58, 42)
+
+    mock_sim.readline.side_effect = [b"+CME ERROR: 3\r\n"]
+    assert kang.sim.getTime(mock_sim) is None
+
+
+def test_read_all_sms():
+    """
+    Test reading all the messages from the listing
+    """
+    sim = kang.emulator.FakeModem()
+    sim.receive(
+        "07911326040000F0040B911346610089F60000208062917314080CC8F71D14969741F977FD07"
+    )
+    sim.receive("0041007200")
+    sim.receive(
+        "0791448720003023240DD0E474D81C0EBB010000111011315214000BE474D81C0EBB5DE3771B"
+    )
+
+    messages = kang.sim.readAllSms(sim)
+    assert [(idx, sms and sms.message) for idx, sms in messages] == [
+        ("1", "How are you?"),
+        ("2", None),
+        ("3", "diafaan.com"),
+    ]
+    assert messages[0][1].number == "+31641600986"
+
+    assert [idx for idx, _ in kang.sim.readAllSms(sim, skip={"1", "2"})] == ["3"]
+    assert kang.sim.Sms.read(sim, "3").number == "diafaan"
+
+
+def test_encode_pdus_cache():
+    """
+    Test that the replies sent again aren't encoded again
+    """
+    kang.sim.encode_pdus.cache_clear()
+    sim = kang.emulator.FakeModem()
+    for _ in range(3):
+        kang.sim.Sms("+33123456789", "De rien !").send(sim)
+    kang.sim.Sms("+33987654321", "De rien !").send(sim)
+
+    info = kang.sim.encode_pdus.cache_info()
+    assert (info.hits, info.misses) == (2, 2)
+    assert sim.segments[0] == sim.segments[2] != sim.segments[3]
+    assert kang.sim.encode_pdus("+33123456789", "De rien !") == (
+        ("0001000B913321436587F9000009C432489E2EBB4121", 21),
+    )
+
+
+class FailingModem(kang.emulator.FakeModem):
+    """
+    Fake modem failing to send the messages to a number
+    """
+
+    def __init__(self, address, code="21"):
+        super().__init__()
+        self.address = address
+        self.code = code
+
+    def write(self, data):
+        self.error = self.code if self.address.encode("ascii") in data else None
+        super().write(data)
+
+
+def test_send_all_sms():
+    """
+    Test that a message sent to several numbers gets the same PDUs as one by one
+    """
+    text = "Chauffage en panne, " * 10
+    numbers = ["+33123456789", "0612345678", "+447785322425"]
+    sim = FailingModem("0A816021436587")
+    results = list(kang.sim.sendAllSms(sim, numbers, text))
+
+    assert [(number, str(error)) for number, error in results] == [
+        ("+33123456789", "None"),
+        ("0612345678", "CMS error 21: Short message transfer rejected"),
+        ("+447785322425", "None"),
+    ]
+    expected = [
+        pdu
+        for number in [numbers[0], numbers[2]]
+        for pdu, _ in kang.sim.encode_pdus(number, text)
+    ]
+    # The remaining segments of a failed number are not sent
+    assert len(expected) == 4
+    assert sim.segments == expected
+
+
+def test_send_all_sms_network_error():
+    """
+    Test that the network errors stop the sending instead of failing each number
+    """
+    numbers = ["+33123456789", "0612345678", "+447785322425"]
+    sim = FailingModem("0A816021436587", "38")
+    results = kang.sim.sendAllSms(sim, numbers, "Chauffage en panne")
+    assert next(results) == ("+33123456789", None)
+    with pytest.raises(CmsError):
+        next(results)
+    assert len(sim.segments) == 1
@@ -0,0 +1,65 @@
+import datetime
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+import kang.clock
+import kang.scheduler
+import kang.timesync
+from test.conftest import start, stop
+
+
+def _network_time(offset):
+    return datetime.datetime.fromtimestamp(round(time.time() + offset))
+
+
+@patch("kang.timesync.step_time")
+@patch("kang.timesync.slew_time", return_value=True)
+@patch("kang.sim.getTime")
+def test_sync_slew(mock_get_time, mock_slew, mock_step):
+    """
+    Test that the small offsets are ignored or slewed
+    """
+    timesync = kang.timesync.TimeSync(MagicMock(), threading.Lock())
+
+    mock_get_time.return_value = _network_time(0)
+    assert abs(timesync.sync()) < 1
+    mock_slew.assert_not_called()
+
+    mock_get_time.return_value = _network_time(-3)
+    assert abs(timesync.sync() + 3) < 1
+    assert abs(mock_slew.call_args[0][0] + 3) < 1
+    mock_step.assert_not_called()
+
+    mock_get_time.return_value = None
+    assert timesync.sync() is None
+
+
+@patch("kang.sim.getTime")
+def test_sync_step(mock_get_time, tmp_path):
+    """
+    Test that the scheduler catches up with the events skipped by a time step
+    """
+    now = time.time()
+    clock = kang.clock.SimulatedClock(now)
+    scheduler_thread = kang.scheduler.SchedulerThread(
+        str(tmp_path / "events.txt"), [start, stop], clock
+    )
+    scheduler_thread.enterabs(now + 600, 0, start, argument=(1,))
+    scheduler_thread.enterabs(now + 1200, 0, stop, argument=(1,))
+    scheduler_thread.enterabs(now + 7200, 0, start, argument=(1,))
+    on_jump = MagicMock()
+
+    timesync = kang.timesync.TimeSync(
+        MagicMock(), threading.Lock(), scheduler_thread, on_jump=on_jump
+    )
+    mock_get_time.return_value = _network_time(3600)
+    with patch("kang.timesync.step_time", side_effect=clock.advance) as mock_step:
+        timesync.sync()
+
+    assert abs(mock_step.call_args[0][0] - 3600) < 1
+    offset, applied, skipped = on_jump.call_args[0]
+    assert abs(offset - 3600) < 1
+    assert [event.action for event in applied] == [stop]
+    assert [event.action for event in skipped] == [start]
+    assert len(scheduler_thread.events) == 1
@@ -0,0 +1,44 @@
+from unittest.mock import patch
+
+import kang.version
+
+
+def test_git_commit(tmp_path):
+    """
+    Test reading the checked out commit without running git
+    """
+    git_dir = tmp_path / ".git"
+    git_dir.mkdir()
+    (git_dir / "HEAD").write_text("ref: refs/heads/main\n")
+    (git_dir / "packed-refs").write_text(
+        "# pack-refs with: peeled fully-peeled sorted\n"
+        "0123456789abcdef0123456789abcdef01234567 refs/heads/main\n"
+    )
+    assert kang.version._git_commit(str(tmp_path)) == "0123456"
+
+    (git_dir / "refs" / "heads").mkdir(parents=True)
+    (git_dir / "refs" / "heads" / "main").write_text(
+        "fedcba9876543210fedcba9876543210fedcba98\n"
+    )
+    assert kang.version._git_commit(str(tmp_path)) == "fedcba9"
+
+    (git_dir / "HEAD").write_text("abcdef0123456789abcdef0123456789abcdef01\n")
+    assert kang.version._git_commit(str(tmp_path)) == "abcdef0"
+
+    assert kang.version._git_commit(str(tmp_path / "missing")) is None
+
+
+def test_describe():
+    """
+    Test the version text built from the available information
+    """
+    with patch.multiple(
+        "kang.version", VERSION="0.2.0", COMMIT="abc1234", BUILD_DATE="2024-01-07"
+    ):
+        assert kang.version.describe() == "0.2.0 (abc1234, construit le 2024-01-07)"
+    with patch.multiple(
+        "kang.version", VERSION=None, COMMIT="abc1234", BUILD_DATE=None
+    ):
+        assert kang.version.describe() == "abc1234"
+    with patch.multiple("kang.version", VERSION=None, COMMIT=None, BUILD_DATE=None):
+        assert kang.version.describe() == "unknown version"